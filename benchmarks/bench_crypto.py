@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+'''安全模式（AES加密）消息处理与明文消息处理的速度对比
+
+运行 ``python benchmarks/bench_crypto.py`` ，输出每秒处理的消息数和加密带来
+的额外开销
+'''
+
+from __future__ import unicode_literals, print_function
+import sys
+import timeit
+
+from yawxt import Dispatcher, MessageHandler, Message
+from yawxt.crypto import MessageCrypto
+
+APPID = "wx5823bf96d3bd56c7"
+
+
+class EchoHandler(MessageHandler):
+    __slots__ = ()
+
+    def on_text(self, text):
+        self.reply_text(text)
+
+
+def main(number=20000):
+    crypto = MessageCrypto(
+        "token", "jWmYm7qr5nMoAUwZRjGtBxmz3KA1tkAj3ykkR6q2B2C", APPID)
+    plain = Message(
+        APPID, "o9KLls80ReakhjsbmHUZxjbz9K8c", "text",
+        "<Content><![CDATA[你好，请问门店几点开门？]]></Content>",
+        6452117832549218721).build_bytes()
+    query = {"timestamp": "1502593490", "nonce": "1320562132"}
+    encrypt = crypto.encrypt(plain)
+    query["msg_signature"] = crypto.signature(
+        query["timestamp"], query["nonce"], encrypt)
+    encrypted = (
+        b"<xml><ToUserName><![CDATA[" + APPID.encode() +
+        b"]]></ToUserName><Encrypt><![CDATA[" + encrypt +
+        b"]]></Encrypt></xml>")
+
+    plain_dispatcher = Dispatcher(EchoHandler)
+    safe_dispatcher = Dispatcher(EchoHandler, crypto=crypto)
+    results = []
+    for name, dispatcher, body in (
+        ("plaintext", plain_dispatcher, plain),
+        ("aes", safe_dispatcher, encrypted),
+    ):
+        seconds = min(timeit.repeat(
+            lambda: dispatcher(body, query), number=number, repeat=3))
+        results.append(seconds)
+        print("%-10s %12.0f messages/s" % (name, number / seconds))
+    # 空处理类的开销比例偏高，实际业务中消息处理和数据库操作占主要时间，
+    # 以每条消息额外的微秒数为准
+    print("aes overhead: %.1f us/message (%.1f%% of an echo handler)" % (
+        (results[1] - results[0]) / number * 1e6,
+        (results[1] / results[0] - 1) * 100))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
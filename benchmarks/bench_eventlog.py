@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+'''消息事件日志的写入和读取速度
+
+运行 ``python benchmarks/bench_eventlog.py [消息数]`` ，输出每分钟写入和
+读取的消息数
+'''
+
+from __future__ import unicode_literals, print_function
+import sys
+import time
+import shutil
+import tempfile
+
+from yawxt import Message
+from yawxt.eventlog import EventLogWriter, EventLogReader
+
+
+def main(number=200000):
+    messages = [
+        Message(
+            "wx5823bf96d3bd56c7", "o9KLls80ReakhjsbmHUZxjbz%04d" % (i % 1000),
+            "text", "<Content><![CDATA[你好，请问门店几点开门？%d]]></Content>" % i,
+            6452117832549218721 + i, 1502593490 + i)
+        for i in range(number)]
+    for compress in (False, True):
+        directory = tempfile.mkdtemp()
+        try:
+            start = time.time()
+            with EventLogWriter(directory, compress=compress) as log:
+                for message in messages:
+                    log.append(message)
+            write = time.time() - start
+
+            start = time.time()
+            count = sum(1 for _ in EventLogReader(directory))
+            read = time.time() - start
+            assert count == number
+        finally:
+            shutil.rmtree(directory)
+        print("compress=%-5s write %10.0f/min  read %10.0f/min" % (
+            compress, number / write * 60, number / read * 60))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+'''附近用户查询的速度
+
+运行 ``python benchmarks/bench_geo.py [位置数] [sqlite文件]`` ，在中国范围内
+随机生成位置（一半集中在几个城市），比较按geohash索引查询
+:func:`~yawxt.persistence.users_near` 与全表扫描计算距离的耗时。给出已存在
+的sqlite文件时直接使用其中的数据，可以用于一亿行等大数据量的测试。
+'''
+
+from __future__ import unicode_literals, print_function
+import os
+import sys
+import time
+import random
+import tempfile
+
+from sqlalchemy import create_engine, select
+
+from yawxt.geo import haversine
+from yawxt.persistence import create_all, location_table, users_near
+
+CITIES = [(39.9042, 116.4074), (31.2304, 121.4737), (23.1291, 113.2644),
+          (30.5728, 104.0668), (22.5431, 114.0579)]
+NOW = 1502593490
+
+
+def _point(rnd):
+    if rnd.random() < 0.5:
+        lat, lon = rnd.choice(CITIES)
+        return lat + rnd.gauss(0, 0.1), lon + rnd.gauss(0, 0.1)
+    return rnd.uniform(20, 45), rnd.uniform(100, 122)
+
+
+def populate(engine, number, batch_size=50000):
+    rnd = random.Random(0)
+    insert = location_table.insert()
+    for start in range(0, number, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, number)):
+            lat, lon = _point(rnd)
+            rows.append({
+                "latitude": lat, "longitude": lon, "precision": 30,
+                "openid": "o9KLls80ReakhjsbmHUZxj%06d" % (i % 1000000),
+                "create_time": NOW - rnd.randint(0, 86400 * 30)})
+        engine.execute(insert, rows)
+
+
+def main(number=500000, path=None, queries=20):
+    tmp = None
+    if path is None:
+        tmp = path = tempfile.mktemp(suffix=".db")
+    engine = create_engine("sqlite:///%s" % path)
+    try:
+        if tmp is not None or not os.path.exists(path) or (
+                not engine.execute(select([location_table.c.id]).limit(1))
+                .first()):
+            create_all(engine)
+            start = time.time()
+            populate(engine, number)
+            print("insert %d locations: %.1fs" % (number, time.time() - start))
+
+        c = location_table.c
+        centers = [
+            (lat + random.gauss(0, 0.05), lon + random.gauss(0, 0.05))
+            for lat, lon in CITIES] * (queries // len(CITIES))
+        since = NOW - 86400
+        start = time.time()
+        found = 0
+        for lat, lon in centers:
+            found += len(users_near(engine, lat, lon, 2000, since=since))
+        indexed = (time.time() - start) / len(centers)
+        print("users_near (2km, 1 day): %8.2fms/query, %d users/query" % (
+            indexed * 1000, found // len(centers)))
+
+        lat, lon = centers[0]
+        start = time.time()
+        nearby = set(
+            openid for openid, lat2, lon2 in engine.execute(
+                select([c.openid, c.latitude, c.longitude])
+                .where(c.create_time >= since))
+            if haversine(lat, lon, lat2, lon2) <= 2000)
+        scan = time.time() - start
+        assert nearby == set(
+            openid for openid, _ in users_near(engine, lat, lon, 2000,
+                                               since=since))
+        print("full scan:               %8.2fms/query" % (scan * 1000))
+    finally:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(int(args[0]) if args else 500000, *args[1:2])
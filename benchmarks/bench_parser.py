@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+'''各xml解析后端处理微信推送消息的速度对比
+
+运行 ``python benchmarks/bench_parser.py`` ，输出每个后端每秒解析的消息数
+'''
+
+from __future__ import unicode_literals, print_function
+import sys
+import timeit
+
+from yawxt.parser import available_backends, get_backend, parse_xml
+
+PAYLOADS = {
+    "text": '''<xml>
+<ToUserName><![CDATA[gh_3f8a9c2b1d4e]]></ToUserName>
+<FromUserName><![CDATA[o9KLls80ReakhjsbmHUZxjbz9K8c]]></FromUserName>
+<CreateTime>1502593490</CreateTime>
+<MsgType><![CDATA[text]]></MsgType>
+<Content><![CDATA[你好，请问门店几点开门？]]></Content>
+<MsgId>6452117832549218721</MsgId>
+</xml>''',
+    "event_LOCATION": '''<xml>
+<ToUserName><![CDATA[gh_3f8a9c2b1d4e]]></ToUserName>
+<FromUserName><![CDATA[o9KLls80ReakhjsbmHUZxjbz9K8c]]></FromUserName>
+<CreateTime>1502593490</CreateTime>
+<MsgType><![CDATA[event]]></MsgType>
+<Event><![CDATA[LOCATION]]></Event>
+<Latitude>23.137466</Latitude>
+<Longitude>113.352425</Longitude>
+<Precision>119.385040</Precision>
+</xml>''',
+    "event_CLICK": '''<xml>
+<ToUserName><![CDATA[gh_3f8a9c2b1d4e]]></ToUserName>
+<FromUserName><![CDATA[o9KLls80ReakhjsbmHUZxjbz9K8c]]></FromUserName>
+<CreateTime>1502593490</CreateTime>
+<MsgType><![CDATA[event]]></MsgType>
+<Event><![CDATA[CLICK]]></Event>
+<EventKey><![CDATA[MENU_1]]></EventKey>
+</xml>''',
+}
+
+
+def main(number=20000):
+    payloads = [p.encode("utf8") for p in PAYLOADS.values()]
+    print("%-8s %15s" % ("backend", "messages/s"))
+    for name in available_backends():
+        backend = get_backend(name)
+
+        def run():
+            for payload in payloads:
+                parse_xml(payload, backend)
+
+        seconds = min(timeit.repeat(run, number=number, repeat=3))
+        print("%-8s %15.0f" % (name, number * len(payloads) / seconds))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+''':class:`yawxt.wsgi.WechatApp` 与 ``examples/flask_wechat.py`` 写法的
+Flask应用处理速度对比
+
+运行 ``python benchmarks/bench_wsgi.py`` ，两个应用都直接以WSGI方式调用，
+不经过网络和WSGI服务器，使用不访问数据库的同一个消息处理类。
+'''
+
+from __future__ import unicode_literals, print_function
+import io
+import sys
+import time
+import timeit
+import hashlib
+
+from yawxt import MessageHandler, Message, check_signature
+from yawxt.wsgi import WechatApp
+
+TOKEN = "token"
+
+
+class EchoHandler(MessageHandler):
+    __slots__ = ()
+
+    def on_text(self, text):
+        self.reply_text(text)
+
+
+def flask_app():
+    from flask import Flask, request
+
+    app = Flask(__name__)
+
+    @app.route('/wechat', methods=["GET", "POST"])
+    def wechat():
+        signature = request.args.get('signature')
+        timestamp = request.args.get('timestamp')
+        nonce = request.args.get('nonce')
+        if not check_signature(TOKEN, timestamp, nonce, signature):
+            return "Messages not From Wechat"
+        if request.method == "GET":
+            return request.args.get('echostr')
+
+        msg = EchoHandler(request.data)
+        return msg.reply()
+
+    return app
+
+
+def main(number=20000):
+    body = Message(
+        "wx5823bf96d3bd56c7", "o9KLls80ReakhjsbmHUZxjbz9K8c", "text",
+        "<Content><![CDATA[你好，请问门店几点开门？]]></Content>",
+        6452117832549218721).build_bytes()
+    timestamp = str(int(time.time()))
+    signature = hashlib.sha1("".join(
+        sorted([TOKEN, timestamp, "1320562132"])).encode()).hexdigest()
+    environ = {
+        "REQUEST_METHOD": str("POST"),
+        "PATH_INFO": str("/wechat"),
+        "SCRIPT_NAME": str(""),
+        "QUERY_STRING": str("signature=%s&timestamp=%s&nonce=1320562132" % (
+            signature, timestamp)),
+        "CONTENT_TYPE": str("text/xml"),
+        "CONTENT_LENGTH": str(len(body)),
+        "SERVER_NAME": str("localhost"),
+        "SERVER_PORT": str("80"),
+        "SERVER_PROTOCOL": str("HTTP/1.1"),
+        "wsgi.url_scheme": str("http"),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    apps = [("yawxt.wsgi", WechatApp(EchoHandler, TOKEN))]
+    try:
+        apps.append(("flask", flask_app()))
+    except ImportError:
+        print("flask is not installed, skipped")
+
+    def request(app):
+        env = dict(environ)
+        env["wsgi.input"] = io.BytesIO(body)
+        result = app(env, start_response)
+        b"".join(result)
+        if hasattr(result, "close"):
+            result.close()
+
+    for name, app in apps:
+        seconds = min(timeit.repeat(
+            lambda: request(app), number=number, repeat=3))
+        print("%-12s %10.0f requests/s" % (name, number / seconds))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -2,9 +2,14 @@
 
 from __future__ import unicode_literals
 import os
+import sys
 
 import pytest
 
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append("tests/test_asgi.py")
+
 
 @pytest.fixture(scope="session")
 def client():
@@ -6,8 +6,9 @@ import string
 import hashlib
 
 import pytest
-from yawxt import Message, User, Location
-from yawxt.persistence import create_all
+from yawxt import Message
+from yawxt.persistence import (
+    create_all, MessageRecord, UserRecord, LocationRecord)
 
 from flask_wechat import app, db, token
 import flask_wechat
@@ -64,15 +65,15 @@ def test_message(app_client, args, openid, client, xml_builder):
 <Precision>40.0</Precision>''')
     rv = app_client.post("/wechat", query_string=args, data=data)
     location = (
-        db.session.query(Location)
+        db.session.query(LocationRecord)
         .filter_by(openid=openid)
-        .order_by(Location.create_time.desc()).first())
+        .order_by(LocationRecord.create_time.desc()).first())
     assert location.latitude == 39.120232
     assert location.longitude == 117.529915
     assert location.precision == 40.0
-    msg_count = db.session.query(Message).count()
+    msg_count = db.session.query(MessageRecord).count()
     assert msg_count >= 2
-    user = db.session.query(User).filter_by(openid=openid).first()
+    user = db.session.query(UserRecord).filter_by(openid=openid).first()
     assert user is not None
     message = Message.from_string(rv.data)
     assert message.msg_type == "text"
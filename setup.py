@@ -33,6 +33,12 @@ setup(
         'requests_oauthlib',
         'pyOpenSSL;python_version=="2.6"'
     ],
+    extras_require={
+        # yawxt.persistence 使用sqlalchemy 1.4的接口，还不支持2.0
+        'persistence': ['SQLAlchemy>=1.4,<2.0'],
+    },
+    # yawxt.asgi 和 yawxt.async_persistence 使用 async def ，需要python3.5以上
+    python_requires='>=2.6, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*',
     url='http://github.com/lspvic/yawxt',
     license='MIT License',
     description='又一个微信公众号开发工具箱 Yet Another WeiXin(wechat) Tookit',
@@ -49,5 +55,6 @@ setup(
         'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
+        'Framework :: AsyncIO',
     ],
     )
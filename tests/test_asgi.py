@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for asyncio handlers and the ASGI application'''
+
+import time
+import asyncio
+import hashlib
+
+import pytest
+from yawxt import MessageHandler, Message
+from yawxt.asgi import AsyncMessageHandler, WechatApp
+from yawxt.spool import Spool
+
+TOKEN = "token"
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class SleepHandler(AsyncMessageHandler):
+    __slots__ = ()
+
+    async def before(self):
+        await asyncio.sleep(0)
+
+    async def on_text(self, text):
+        await asyncio.sleep(0.2)
+        self.reply_text("async %s" % text)
+
+    async def event_click(self, click_key):
+        user = await self.get_user()
+        self.reply_text("click %s" % user)
+
+
+class SyncHandler(MessageHandler):
+    __slots__ = ()
+
+    def on_text(self, text):
+        self.reply_text("sync %s" % text)
+
+
+def signed_query(extra=""):
+    timestamp = str(int(time.time()))
+    signature = hashlib.sha1(
+        "".join(sorted([TOKEN, timestamp, "nonce"])).encode()).hexdigest()
+    return ("signature=%s&timestamp=%s&nonce=nonce%s" % (
+        signature, timestamp, extra)).encode()
+
+
+def call(app, method="POST", query=b"", body=b"", chunk=None):
+    chunk = chunk or len(body) or 1
+    messages = [
+        {"type": "http.request", "body": body[i:i + chunk],
+         "more_body": i + chunk < len(body)}
+        for i in range(0, max(len(body), 1), chunk)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "query_string": query,
+             "headers": []}
+    run(app(scope, receive, send))
+    return sent[0]["status"], sent[1]["body"]
+
+
+def test_concurrent_handlers(xml_builder, openid):
+    async def handle_all():
+        handlers = [SleepHandler() for _ in range(200)]
+        await asyncio.gather(*[
+            handler.process(xml_builder("text", "<Content>%d</Content>" % i))
+            for i, handler in enumerate(handlers)])
+        return [await handler.reply() for handler in handlers]
+
+    start = time.time()
+    replies = run(handle_all())
+    assert time.time() - start < 2
+    message = Message.from_string(replies[7])
+    assert message.to_id == openid
+    assert "async 7" in message.content
+
+
+def test_async_keyword_reply(xml_builder):
+    from yawxt.keywords import KeywordEngine, KeywordRule
+
+    async def answer(handler, text):
+        await asyncio.sleep(0.01)
+        handler.reply_text("async %s" % text)
+
+    class Handler(AsyncMessageHandler):
+        __slots__ = ()
+        keywords = KeywordEngine([
+            KeywordRule("ask", answer, match="prefix"),
+            KeywordRule("hi", "hello")])
+
+    async def handle(text):
+        handler = Handler()
+        await handler.process(
+            xml_builder("text", "<Content>%s</Content>" % text))
+        return await handler.reply()
+
+    assert "async ask me" in Message.from_string(run(handle("ask me"))).content
+    assert "hello" in Message.from_string(run(handle("hi"))).content
+
+
+def test_get_user(client, xml_builder, openid):
+    async def handle():
+        handler = SleepHandler(client)
+        await handler.process(
+            xml_builder("event_CLICK", "<EventKey>KEY</EventKey>"))
+        return await handler.reply()
+
+    message = Message.from_string(run(handle()))
+    assert openid in message.content
+
+
+@pytest.mark.parametrize("handler_cls,prefix", [
+    (SleepHandler, "async"), (SyncHandler, "sync")])
+def test_app(handler_cls, prefix, xml_builder):
+    app = WechatApp(handler_cls, TOKEN, max_body_size=1024)
+    status, body = call(app, "GET", signed_query("&echostr=1234"))
+    assert (status, body) == (200, b"1234")
+    assert call(app, "GET", b"echostr=1234")[0] == 403
+    assert call(app, "PUT", signed_query())[0] == 405
+
+    content = xml_builder("text", "<Content>asgi</Content>", 1).encode()
+    status, body = call(app, query=signed_query(), body=content, chunk=50)
+    assert status == 200
+    assert "%s asgi" % prefix in Message.from_string(body).content
+    status, body = call(
+        app, query=signed_query(), body=content + b" " * 1024)
+    assert status == 413
+
+
+def test_app_spool(xml_builder, tmpdir):
+    spool = Spool(str(tmpdir.join("spool.db")), max_pending=1)
+    app = WechatApp(SleepHandler, TOKEN, spool=spool)
+    content = xml_builder("text", "<Content>asgi</Content>", 1).encode()
+    assert call(app, query=signed_query(), body=content) == (200, b"")
+    assert call(app, query=signed_query(), body=content)[0] == 503
+    assert spool.fetch()[0].content == content
+    spool.close()
+
+
+def test_async_persist(client, xml_builder, DB_Session, db_session, openid):
+    from concurrent.futures import ThreadPoolExecutor
+    from yawxt.async_persistence import AsyncPersistMessageHandler
+    from yawxt.persistence import MessageRecord
+
+    class Handler(AsyncPersistMessageHandler):
+        __slots__ = ()
+        # sqlite的连接只能在创建它的线程中使用
+        executor = ThreadPoolExecutor(1)
+
+    async def handle():
+        handler = Handler(
+            client, DB_Session, debug_to_wechat=True)
+        await handler.process(
+            xml_builder("text", "<Content>persist</Content>", 4455667788))
+        user = await handler.get_user()
+        location = await handler.get_user_location()
+        assert user.openid == openid
+        assert location.openid == openid
+        return await handler.reply()
+
+    raw = run(handle())
+    assert Message.from_string(raw).to_id == openid
+    assert (
+        db_session.query(MessageRecord)
+        .filter_by(msg_id=4455667788).count() == 2)
+
+
+def test_async_session_persist(client, xml_builder, openid, tmpdir):
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    from sqlalchemy.orm import sessionmaker
+    from yawxt.async_persistence import AsyncSessionPersistMessageHandler
+    from yawxt.persistence import (
+        create_all, message_table, latest_location_table, LocationPolicy)
+
+    path = tmpdir.join("async.db")
+    sync_engine = create_engine("sqlite:///%s" % path)
+    create_all(sync_engine)
+
+    cached = []
+
+    class Handler(AsyncSessionPersistMessageHandler):
+        __slots__ = ()
+
+        async def on_text(self, text):
+            cached.append(self.user_location)
+            location = await self.get_user_location()
+            cached.append(self.user_location)
+            self.reply_text("%s %s" % (text, location.latitude))
+
+    async def handle():
+        engine = create_async_engine("sqlite+aiosqlite:///%s" % path)
+        Session = sessionmaker(engine, class_=AsyncSession)
+        try:
+            for lat in ("30.5", "30.50001"):
+                handler = Handler(
+                    client, Session, location_policy=LocationPolicy())
+                await handler.process(xml_builder(
+                    "event_LOCATION", "<Latitude>%s</Latitude><Longitude>"
+                    "120.1</Longitude><Precision>20</Precision>" % lat))
+                await handler.reply()
+            handler = Handler(client, Session)
+            await handler.process(
+                xml_builder("text", "<Content>where</Content>", 998877))
+            user = await handler.get_user()
+            assert user.openid == openid
+            raw = await handler.reply()
+            handler = Handler(client, Session)
+            await handler.process(xml_builder("event_unsubscribe", ""))
+            await handler.reply()
+            return raw
+        finally:
+            await engine.dispose()
+
+    raw = run(handle())
+    assert Message.from_string(raw).content == (
+        "<xml><Content>where 30.5</Content></xml>")
+    # user_location 不查询数据库， get_user_location 查询后才有值
+    assert cached[0] is None and cached[1].latitude == 30.5
+    rows = sync_engine.execute(
+        select([message_table.c.msg_type, message_table.c.text])
+        .order_by(message_table.c.id)).fetchall()
+    assert [tuple(row) for row in rows] == [
+        ("event_LOCATION", None), ("text", "where"),
+        ("text", "where 30.5"), ("event_unsubscribe", None)]
+    row = sync_engine.execute(latest_location_table.select()).first()
+    assert (row.openid, row.latitude) == (openid, 30.5)
+    assert sync_engine.execute(
+        "SELECT COUNT(*) FROM wechat_location").scalar() == 1
+    assert sync_engine.execute(
+        "SELECT openid FROM wechat_user").scalar() == openid
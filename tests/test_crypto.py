@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for safe mode message encryption'''
+
+from __future__ import unicode_literals
+import time
+import xml.etree.ElementTree as ET
+
+import pytest
+from yawxt import Dispatcher, MessageHandler, Message, MessageCryptoError
+from yawxt.crypto import MessageCrypto
+
+ENCODING_AES_KEY = "abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG"
+
+
+@pytest.fixture
+def crypto(client):
+    return MessageCrypto("token", ENCODING_AES_KEY, client.appid)
+
+
+@pytest.fixture
+def encrypted(crypto, xml_builder):
+    def func(*args):
+        xml = xml_builder(*args)
+        query = {"timestamp": "1502593490", "nonce": "nonce"}
+        encrypt = crypto.encrypt(xml)
+        query["msg_signature"] = crypto.signature(
+            query["timestamp"], query["nonce"], encrypt)
+        envelope = (
+            "<xml><ToUserName><![CDATA[to]]></ToUserName>"
+            "<Encrypt><![CDATA[%s]]></Encrypt></xml>" % encrypt.decode())
+        return envelope, query
+    return func
+
+
+class EchoHandler(MessageHandler):
+
+    def on_text(self, text):
+        self.reply_text("echo %s" % text)
+
+
+def test_round_trip(crypto):
+    xml = "<xml><Content>中文</Content></xml>".encode("utf8")
+    for size in (0, 11, 12, 100):
+        data = xml + b" " * size
+        assert crypto.decrypt(crypto.encrypt(data)) == data
+
+
+def test_decrypt_message(crypto, encrypted, openid):
+    envelope, query = encrypted("text", "<Content>safe</Content>", 1)
+    message = Message.from_string(envelope, crypto=crypto, query=query)
+    assert message.from_id == openid
+    assert message.content == "<xml><Content>safe</Content></xml>"
+
+    # 格式化过的信封
+    pretty = envelope.replace("<Encrypt>", "\n  <Encrypt>\n")
+    assert crypto.find_encrypt(pretty) == crypto.find_encrypt(envelope)
+    assert b"<Content>safe</Content>" in crypto.decrypt_message(
+        pretty, query["msg_signature"], query["timestamp"], query["nonce"])
+
+    query["msg_signature"] = "0" * 40
+    with pytest.raises(MessageCryptoError):
+        Message.from_string(envelope, crypto=crypto, query=query)
+
+    other = MessageCrypto("token", ENCODING_AES_KEY, "other_appid")
+    with pytest.raises(MessageCryptoError):
+        other.decrypt(crypto.encrypt(b"<xml />"))
+
+
+def test_message_time_error(client, xml_builder):
+    crypto = MessageCrypto(
+        "token", ENCODING_AES_KEY, client.appid, time_error=600)
+    encrypt = crypto.encrypt(xml_builder("text", "<Content>a</Content>", 1))
+
+    def decrypt(timestamp):
+        signature = crypto.signature(timestamp, "nonce", encrypt)
+        return crypto.decrypt_fields(encrypt, {
+            "msg_signature": signature, "timestamp": timestamp,
+            "nonce": "nonce"})
+
+    assert decrypt(str(int(time.time()) - 60))["Content"] == "a"
+    # 签名正确但超过时间误差的消息被拒绝，防止重放
+    for timestamp in ("1502593490", str(int(time.time()) + 3600), "now"):
+        with pytest.raises(MessageCryptoError):
+            decrypt(timestamp)
+    crypto.time_error = 0
+    assert decrypt("1502593490")["Content"] == "a"
+
+
+def test_encrypted_reply(crypto, encrypted, openid):
+    envelope, query = encrypted("text", "<Content>safe</Content>", 1)
+    dispatcher = Dispatcher(EchoHandler, crypto=crypto)
+    raw = dispatcher(envelope, query=query)
+    xml = ET.fromstring(raw)
+    assert xml.find("Nonce").text == "nonce"
+    assert xml.find("TimeStamp").text == "1502593490"
+    assert xml.find("MsgSignature").text == crypto.signature(
+        "1502593490", "nonce", xml.find("Encrypt").text)
+    reply = Message.from_string(crypto.decrypt(xml.find("Encrypt").text))
+    assert reply.to_id == openid
+    assert "echo safe" in reply.content
+
+
+def test_plain_message_with_crypto(crypto, xml_builder):
+    handler = EchoHandler(
+        xml_builder("text", "<Content>plain</Content>", 1), crypto=crypto)
+    assert b"<Encrypt>" not in handler.reply()
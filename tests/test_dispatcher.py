@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for Dispatcher'''
+
+from __future__ import unicode_literals
+import xml.etree.ElementTree as ET
+
+from yawxt import Dispatcher, MessageHandler, Message
+
+
+class SlottedHandler(MessageHandler):
+    __slots__ = ("count",)
+
+    def before(self):
+        self.count = 0
+
+    def on_text(self, text):
+        self.count += 1
+        self.reply_text("echo %s" % text)
+
+    def event_click(self, click_key):
+        self.reply_text("click %s" % self.user)
+
+
+def test_dispatch(xml_builder, openid):
+    dispatcher = Dispatcher(SlottedHandler)
+    for i in range(3):
+        handler = dispatcher.handle(xml_builder(
+            "text", "<Content>%d</Content>" % i, i))
+        assert not hasattr(handler, "__dict__")
+        assert handler.count == 1
+        assert handler.openid == openid
+        xml = ET.fromstring(handler.reply())
+        assert xml.find("Content").text == "echo %d" % i
+
+    raw = dispatcher(xml_builder("event_CLICK", "<EventKey>KEY</EventKey>"))
+    assert ET.fromstring(raw).find("Content").text == "click None"
+
+
+def test_dispatch_persist(client, xml_builder, DB_Session, db_session,
+                          openid):
+    from yawxt.persistence import PersistMessageHandler, MessageRecord
+
+    dispatcher = Dispatcher(
+        PersistMessageHandler, client, debug_to_wechat=True,
+        db_session_maker=DB_Session, user_refresh_days=1)
+    raw = dispatcher(xml_builder(
+        "text", "<Content>dispatcher</Content>", 9876543210))
+    assert Message.from_string(raw).to_id == openid
+    assert (
+        db_session.query(MessageRecord)
+        .filter_by(msg_id=9876543210).count() == 2)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for reply encoder'''
+
+from __future__ import unicode_literals
+import xml.etree.ElementTree as ET
+
+from yawxt import MessageHandler, Message
+from yawxt.encoder import cdata, encode_message, render_text, render_news
+
+welcome = render_news([{
+    "title": "欢迎", "description": "desc ]]> end",
+    "picurl": "http://qq.com/a.png", "url": "http://qq.com"}])
+
+
+class WelcomeHandler(MessageHandler):
+
+    def on_text(self, text):
+        self.reply_text(text)
+
+    def event_subscribe(self):
+        self.reply_rendered(welcome)
+
+
+def test_cdata_escape():
+    assert cdata("a]]>b") == b"a]]]]><![CDATA[>b"
+    assert cdata(123) == b"123"
+    body = render_text("x]]>y<z").body
+    assert (
+        ET.fromstring(b"<xml>" + body + b"</xml>")
+        .find("Content").text == "x]]>y<z")
+
+
+def test_encode_message():
+    raw = encode_message("to", "from", 1502593490, "event_CLICK",
+                         b"<EventKey><![CDATA[KEY]]></EventKey>")
+    message = Message.from_string(raw)
+    assert message.to_id == "to"
+    assert message.from_id == "from"
+    assert message.msg_type == "event_CLICK"
+    assert message.create_time == 1502593490
+    assert message.msg_id is None
+
+
+def test_reply_bytes(xml_builder, openid):
+    data = xml_builder("text", "<Content><![CDATA[a]]]]><![CDATA[>b]]>"
+                       "</Content>", 1234)
+    handler = WelcomeHandler(data)
+    raw = handler.reply()
+    assert isinstance(raw, bytes)
+    xml = ET.fromstring(raw)
+    assert xml.find("Content").text == "a]]>b"
+    assert xml.find("ToUserName").text == openid
+    assert handler.reply_message.content == (
+        "<Content><![CDATA[a]]]]><![CDATA[>b]]></Content>")
+
+
+def test_reply_rendered(xml_builder):
+    handler = WelcomeHandler(xml_builder(
+        "event_subscribe", "<EventKey><![CDATA[]]></EventKey>"))
+    xml = ET.fromstring(handler.reply())
+    assert xml.find("MsgType").text == "news"
+    assert xml.find("ArticleCount").text == "1"
+    item = xml.find("Articles").find("item")
+    assert item.find("Description").text == "desc ]]> end"
+    assert handler.reply_message.msg_type == "news"
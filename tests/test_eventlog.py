@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for the message event log'''
+
+from __future__ import unicode_literals
+
+import pytest
+from yawxt import Dispatcher, MessageHandler, Message
+from yawxt.eventlog import EventLogWriter, EventLogReader, REPLY
+
+
+class EchoHandler(MessageHandler):
+    __slots__ = ()
+
+    def on_text(self, text):
+        self.reply_text("echo %s" % text)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_write_and_read(tmpdir, compress):
+    path = str(tmpdir.join("log"))
+    with EventLogWriter(path, segment_size=1024, compress=compress) as log:
+        for i in range(100):
+            message = Message(
+                "appid", "openid_%d" % (i % 3), "text",
+                "<Content><![CDATA[中文\n%d]]></Content>" % i, i,
+                1500000000 + i)
+            log.append(message, wait=(i % 10 == 0))
+    assert len(EventLogReader(path).segments()) > 1
+
+    messages = list(EventLogReader(path))
+    assert [m.msg_id for m in messages] == list(range(100))
+    assert messages[5].from_id == "openid_2"
+    assert messages[5].create_time == 1500000005
+    assert "中文\n5" in messages[5].content
+
+    # 重新打开时写入新的文件
+    with EventLogWriter(path, flush_interval=None, compress=compress) as log:
+        log.append(messages[0], REPLY)
+    direction, message = list(EventLogReader(path).records())[-1]
+    assert direction == message.direction == "reply"
+    assert message.msg_id == messages[0].msg_id
+    replies = list(EventLogReader(path, direction=REPLY))
+    assert [m.msg_id for m in replies] == [messages[0].msg_id]
+
+
+def test_truncated_segment(tmpdir):
+    path = str(tmpdir.join("log"))
+    with EventLogWriter(path, flush_interval=None) as log:
+        for i in range(3):
+            log.append(Message("appid", "openid", "text", "", i))
+    segment = EventLogReader(path).segments()[0]
+    with open(segment, "ab") as fp:
+        fp.write(b'["inbound","appid"')
+    assert len(list(EventLogReader(path))) == 3
+
+
+def test_handler_event_log(tmpdir, xml_builder, DB_Session, openid):
+    from yawxt.persistence import load_event_log, message_table
+
+    path = str(tmpdir.join("log"))
+    log = EventLogWriter(path)
+    dispatcher = Dispatcher(EchoHandler, event_log=log)
+    for i in range(5):
+        dispatcher(xml_builder("text", "<Content>%d</Content>" % i,
+                               7700000000 + i))
+    log.close()
+    records = list(EventLogReader(path).records())
+    assert [d for d, _ in records] == ["inbound", "reply"] * 5
+    assert records[1][1].to_id == openid
+    assert "echo 0" in records[1][1].content
+
+    engine = DB_Session.kw["bind"]
+    assert load_event_log(engine, EventLogReader(path), batch_size=3) == 10
+    rows = engine.execute(
+        message_table.select()
+        .where(message_table.c.msg_id.between(7700000000, 7700000004))
+    ).fetchall()
+    assert len(rows) == 10
+
+
+def test_write_failure(tmpdir, monkeypatch):
+    path = str(tmpdir.join("log"))
+    log = EventLogWriter(path, flush_interval=0.01)
+    write = log._write
+    failures = []
+
+    def fail_once(data):
+        if not failures:
+            failures.append(data)
+            raise IOError("disk full")
+        write(data)
+
+    monkeypatch.setattr(log, "_write", fail_once)
+    with pytest.raises(IOError):
+        log.append(Message("appid", "openid", "text", "", 1), wait=True)
+    # 失败的消息在下一次写入时重试
+    log.append(Message("appid", "openid", "text", "", 2), wait=True)
+    log.close()
+    assert [m.msg_id for m in EventLogReader(path)] == [1, 2]
+
+
+def test_multiple_writers(tmpdir):
+    path = str(tmpdir.join("log"))
+    first = EventLogWriter(path, flush_interval=None, segment_size=1)
+    second = EventLogWriter(path, flush_interval=None, segment_size=1)
+    for i in range(6):
+        (first if i % 2 else second).append(
+            Message("appid", "openid", "text", "", i))
+    first.close()
+    second.close()
+    segments = EventLogReader(path).segments()
+    assert len(segments) == 6
+    assert sorted(m.msg_id for m in EventLogReader(path)) == list(range(6))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import io
+import csv
+import gzip
+import json
+
+import pytest
+from sqlalchemy import create_engine
+
+from yawxt.export import export_table, iter_rows
+from yawxt.persistence import (
+    create_all, message_table, user_table, location_table,
+    keyword_table)
+
+
+@pytest.fixture()
+def engine(tmpdir):
+    engine = create_engine("sqlite:///%s" % tmpdir.join("export.db"))
+    create_all(engine)
+    engine.execute(message_table.insert(), [
+        dict(to_id="gh_1", from_id="o%d" % (i % 3), msg_type="text",
+             content="<Content>第%d条</Content>" % i, create_time=1000 + i)
+        for i in range(25)])
+    return engine
+
+
+def test_iter_rows(engine):
+    batches = list(iter_rows(
+        engine, message_table, columns=["create_time"], batch_size=10))
+    assert [len(rows) for rows in batches] == [10, 10, 5]
+    # 不在导出列中的id放在最后
+    assert batches[0][0] == (1000, 1)
+    rows = [row for rows in iter_rows(
+        engine, message_table, since=1005, until=1010,
+        columns=["create_time", "id"], batch_size=2) for row in rows]
+    assert [row[0] for row in rows] == list(range(1005, 1010))
+
+    engine.execute(user_table.insert(), [
+        dict(openid="o1", update_time=10), dict(openid="o2", update_time=20)])
+    rows = [row for rows in iter_rows(
+        engine, user_table, since=15, columns=["openid"]) for row in rows]
+    assert rows == [("o2", 2)]
+    with pytest.raises(ValueError):
+        list(iter_rows(engine, keyword_table, since=1))
+
+
+def test_export_jsonl(engine, tmpdir):
+    path = str(tmpdir.join("messages.jsonl.gz"))
+    result = export_table(
+        engine, message_table, path, until=1020, batch_size=7)
+    assert result == (20, 1020)
+    with gzip.open(path, "rb") as fp:
+        rows = [json.loads(line.decode("utf8")) for line in fp]
+    assert len(rows) == 20
+    assert rows[3]["content"] == "<Content>第3条</Content>"
+    assert rows[3]["text"] == "第3条"
+
+    # 从上一次的watermark增量导出
+    path = str(tmpdir.join("messages-2.jsonl"))
+    result = export_table(
+        engine, message_table, path, since=result.watermark, lag=0)
+    assert result.rows == 5
+    with io.open(path, encoding="utf8") as fp:
+        assert [json.loads(line)["create_time"] for line in fp] == list(
+            range(1020, 1025))
+
+
+def test_export_csv(engine, tmpdir):
+    path = str(tmpdir.join("messages.csv"))
+    export_table(
+        engine, message_table, path, columns=["from_id", "create_time"],
+        lag=0)
+    with io.open(path, encoding="utf8", newline="") as fp:
+        rows = list(csv.reader(fp))
+    assert rows[0] == ["from_id", "create_time"]
+    assert rows[1:3] == [["o0", "1000"], ["o1", "1001"]]
+    assert len(rows) == 26
+
+    path = str(tmpdir.join("locations.csv"))
+    assert export_table(engine, location_table, path).rows == 0
+    with pytest.raises(ValueError):
+        export_table(engine, message_table, str(tmpdir.join("messages.xml")))
+
+
+def test_export_parquet(engine, tmpdir):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    path = str(tmpdir.join("messages.parquet"))
+    assert export_table(
+        engine, message_table, path, lag=0, batch_size=10).rows == 25
+    table = parquet.read_table(path)
+    assert table.num_rows == 25
+    assert table.column("create_time").to_pylist()[-1] == 1024
+
+
+def test_incremental_seek(engine):
+    from sqlalchemy import event
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, many):
+        statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        rows = [row for rows in iter_rows(
+            engine, message_table, since=1020, columns=["create_time"],
+            batch_size=2) for row in rows]
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert [row[0] for row in rows] == list(range(1020, 1025))
+    # id范围由create_time的索引确定，分段查询都从id开始
+    statement, parameters = statements[0]
+    plan = " ".join(
+        str(row[-1]) for row in engine.execute(
+            "EXPLAIN QUERY PLAN " + statement, parameters))
+    assert "ix_wechat_message_create_time" in plan
+    assert all("wechat_message.id >" in statement
+               for statement, _ in statements[1:])
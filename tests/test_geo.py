@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import pytest
+
+from yawxt.geo import (
+    haversine, encode_geohash, decode_geohash, bounding_box, geohash_cover)
+
+
+def test_haversine():
+    # 北京到上海约1067公里
+    assert haversine(39.9042, 116.4074, 31.2304, 121.4737) == pytest.approx(
+        1067e3, rel=0.01)
+    assert haversine(30.0, 120.0, 30.0, 120.0) == 0
+
+
+def test_geohash():
+    assert encode_geohash(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert encode_geohash(39.9042, 116.4074, 5) == "wx4g0"
+    min_lat, min_lon, max_lat, max_lon = decode_geohash("wx4g0")
+    assert min_lat <= 39.9042 <= max_lat
+    assert min_lon <= 116.4074 <= max_lon
+
+
+def test_geohash_cover():
+    box = bounding_box(39.9042, 116.4074, 2000)
+    assert haversine(39.9042, 116.4074, box[2], 116.4074) == pytest.approx(
+        2000)
+    assert haversine(39.9042, 116.4074, 39.9042, box[3]) >= 2000
+    cells = geohash_cover(*box)
+    assert 0 < len(cells) <= 16
+    # 范围的四个角都在某个前缀内
+    for lat in box[0], box[2]:
+        for lon in box[1], box[3]:
+            geohash = encode_geohash(lat, lon)
+            assert any(geohash.startswith(cell) for cell in cells)
+    assert len(geohash_cover(-90, -180, 90, 180)) == 32
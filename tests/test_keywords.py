@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for keyword auto reply engine'''
+
+from __future__ import unicode_literals
+import io
+import os
+import json
+import time
+import xml.etree.ElementTree as ET
+
+import pytest
+from yawxt import MessageHandler
+from yawxt.keywords import KeywordEngine, KeywordRule
+
+
+@pytest.fixture
+def engine():
+    return KeywordEngine([
+        KeywordRule("hello", "exact hello"),
+        KeywordRule("he", "prefix he", match="prefix"),
+        KeywordRule("llo", "contains llo", match="contains"),
+        KeywordRule("优惠", "contains 优惠", match="contains", priority=5),
+        KeywordRule(r"^\d{11}$", "phone", match="regex", priority=1),
+        KeywordRule(r"\d+", "number", match="regex"),
+    ])
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("hello", "exact hello"),
+    ("help", "prefix he"),
+    ("yellow", "contains llo"),
+    ("the", None),
+    ("hello 优惠", "contains 优惠"),
+    ("13800138000", "phone"),
+    ("room 1024", "number"),
+    ("", None),
+])
+def test_match(engine, text, expected):
+    rule = engine.match(text)
+    if expected is None:
+        assert rule is None
+    else:
+        assert rule.reply.content == (
+            "<Content><![CDATA[%s]]></Content>" % expected)
+
+
+def test_priority_order():
+    engine = KeywordEngine([
+        KeywordRule("abc", "first", match="contains"),
+        KeywordRule("b", "second", match="contains"),
+        KeywordRule("b", "third", match="regex"),
+    ])
+    assert engine.match("xabcx").reply.content.endswith(
+        "[first]]></Content>")
+    engine = KeywordEngine(
+        [KeywordRule("ABC", "upper", match="prefix")], ignore_case=True)
+    assert engine.match("abcd") is not None
+
+
+def test_regex_rules():
+    engine = KeywordEngine([
+        KeywordRule(r"(\w)\1", "double", match="regex", priority=2),
+        KeywordRule(r"b+", "b", match="regex", priority=1),
+        KeywordRule(r"a(b)c", "abc", match="regex"),
+        KeywordRule(r"^z", "start", match="regex", priority=3),
+    ])
+
+    def reply(text):
+        rule = engine.match(text)
+        return rule and rule.reply.content[18:-13]
+
+    # 优先级高的规则在后面的位置匹配
+    assert reply("abc bb") == "double"
+    assert reply("xabcx") == "b"
+    assert reply("ac") is None
+    assert reply("zz") == "start"
+    assert reply("az") is None
+
+
+def test_regex_literal_ignore_case():
+    engine = KeywordEngine([
+        KeywordRule(r"order-(\d+)", "order", match="regex", priority=1),
+        KeywordRule(r"vip\w*", "vip", match="regex"),
+    ], ignore_case=True)
+    compiled = engine._compiled
+    assert [literal for _, _, literal in compiled.regexes] == [0, 1]
+
+    searched = []
+
+    class Spy(object):
+        def __init__(self, regex):
+            self.regex = regex
+
+        def search(self, text):
+            searched.append(self.regex.pattern)
+            return self.regex.search(text)
+
+    compiled.regexes = [
+        (Spy(regex), rank, literal)
+        for regex, rank, literal in compiled.regexes]
+    assert engine.match("ORDER-42").reply.content[18:-13] == "order"
+    assert engine.match("Vip member").reply.content[18:-13] == "vip"
+    assert searched == [r"order-(\d+)", r"vip\w*"]
+    # 字面量没有出现的正则不执行
+    del searched[:]
+    assert engine.match("hello world") is None
+    assert searched == []
+    # ſ 忽略大小写时匹配 s ，不能被筛掉
+    engine = KeywordEngine(
+        [KeywordRule("sale", "sale", match="regex")], ignore_case=True)
+    assert engine.match("\u017fale") is not None
+
+
+def test_load_file(tmpdir):
+    path = str(tmpdir.join("rules.json"))
+
+    def write(rules):
+        with io.open(path, "w", encoding="utf8") as fp:
+            fp.write(json.dumps(rules, ensure_ascii=False))
+
+    write([{"keyword": "hi", "reply": "hi there"}])
+    engine = KeywordEngine(check_interval=0)
+    engine.load_file(path)
+    assert len(engine) == 1
+    assert engine.match("hi") is not None
+
+    write([
+        {"keyword": "news", "reply_type": "news", "reply": [{
+            "title": "t", "description": "d", "picurl": "p", "url": "u"}]},
+        {"keyword": "img", "reply_type": "image", "reply": "media_id"},
+    ])
+    mtime = time.time() + 10
+    os.utime(path, (mtime, mtime))
+    assert engine.match("hi") is None
+    assert engine.match("news").reply.msg_type == "news"
+    assert engine.match("img").reply.msg_type == "image"
+
+
+class KeywordHandler(MessageHandler):
+    keywords = KeywordEngine([
+        KeywordRule("hi", "hello from rules"),
+        KeywordRule("#", lambda handler, text: handler.reply_text(
+            "command %s" % text[1:]), match="prefix"),
+    ])
+
+
+@pytest.mark.parametrize("text,expected", [
+    ("hi", "hello from rules"),
+    ("#menu", "command menu"),
+])
+def test_handler_reply(xml_builder, text, expected):
+    handler = KeywordHandler(xml_builder(
+        "text", "<Content><![CDATA[%s]]></Content>" % text, 1))
+    assert ET.fromstring(handler.reply()).find("Content").text == expected
+
+
+def test_load_from_db(db_session):
+    from yawxt.persistence import keyword_table, load_keyword_rules
+    for row in [
+        {"keyword": "db", "reply": "from db"},
+        {"keyword": "off", "reply": "disabled", "enabled": 0},
+        {"keyword": "img", "match_type": "prefix", "reply_type": "image",
+         "reply": "media_id", "priority": 3},
+    ]:
+        db_session.execute(keyword_table.insert().values(**row))
+    db_session.commit()
+    engine = KeywordEngine()
+    engine.load(load_keyword_rules(db_session))
+    assert engine.match("db") is not None
+    assert engine.match("off") is None
+    assert engine.match("imgs").reply.msg_type == "image"
@@ -7,7 +7,7 @@ import time
 import xml.etree.ElementTree as ET
 
 import pytest
-from yawxt import MessageHandler, check_signature, Message
+from yawxt import MessageHandler, check_signature, Message, route
 
 
 class MessageHandlerTester(MessageHandler):
@@ -311,3 +311,54 @@ def test_reply_news(xml_builder):
     assert video_xml.find("Description").text == "news description"
     assert video_xml.find("PicUrl").text == "http://qq.com"
     assert video_xml.find("Url").text == "http://qq.com"
+
+
+class RouteHandler(MessageHandlerTester):
+
+    @route("event_CLICK", key="MENU_1")
+    def menu_1(self, click_key):
+        self.state = "menu 1"
+
+    @route("text", prefix="#")
+    def command(self, text):
+        self.state = "command %s" % text[1:]
+
+    @route("text", pattern=r"^\d+$")
+    @route("text", content="number")
+    def number(self, text):
+        self.state = "number"
+
+    @route("event_MASSSENDJOBFINISH")
+    def mass_send_finished(self):
+        self.state = "mass send finished"
+
+    def _helper(self):
+        self.state = "private helper"
+
+
+class SubRouteHandler(RouteHandler):
+
+    @route("text", prefix="#sub")
+    def sub_command(self, text):
+        self.state = "sub command"
+
+
+@pytest.mark.parametrize("handler_cls,content,expected", [
+    (RouteHandler, ("event_CLICK", "<EventKey>MENU_1</EventKey>"), "menu 1"),
+    (RouteHandler, ("event_CLICK", "<EventKey>MENU_2</EventKey>"),
+     "pull MENU_2"),
+    (RouteHandler, ("text", "<Content>#help</Content>", 1), "command help"),
+    (RouteHandler, ("text", "<Content>123</Content>", 1), "number"),
+    (RouteHandler, ("text", "<Content>number</Content>", 1), "number"),
+    (RouteHandler, ("text", "<Content>hello</Content>", 1), "hello"),
+    (RouteHandler, ("event_MASSSENDJOBFINISH", ""), "mass send finished"),
+    (RouteHandler, ("event_UNKNOWN", ""), None),
+    (RouteHandler, ("event_helper", ""), None),
+    (SubRouteHandler, ("text", "<Content>#sub</Content>", 1),
+     "sub command"),
+    (SubRouteHandler, ("text", "<Content>#help</Content>", 1),
+     "command help"),
+])
+def test_route(xml_builder, handler_cls, content, expected):
+    handler = handler_cls(xml_builder(*content))
+    assert handler.state == expected
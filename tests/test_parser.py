@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for xml parser backends'''
+
+from __future__ import unicode_literals
+
+import pytest
+from yawxt import Message
+from yawxt.parser import (
+    available_backends, get_backend, parse_xml, dump_xml, RawXML)
+
+
+@pytest.fixture(params=available_backends())
+def backend(request):
+    return get_backend(request.param)
+
+
+def test_parse_flat(backend):
+    fields = parse_xml('''<xml>
+<ToUserName><![CDATA[toUser]]></ToUserName>
+<CreateTime>1348831860</CreateTime>
+<Content><![CDATA[a < b & c]]></Content>
+<Label>a &amp; b</Label>
+<EventKey><![CDATA[]]></EventKey>
+<Ticket />
+</xml>'''.encode("utf8"), backend)
+    assert list(fields.keys()) == [
+        "ToUserName", "CreateTime", "Content", "Label", "EventKey", "Ticket"]
+    assert fields["ToUserName"] == "toUser"
+    assert fields["CreateTime"] == "1348831860"
+    assert fields["Content"] == "a < b & c"
+    assert fields["Label"] == "a & b"
+    assert fields["EventKey"] is None
+    assert fields["Ticket"] is None
+
+
+def test_parse_nested(backend):
+    fields = parse_xml('''<xml>
+<Event><![CDATA[scancode_push]]></Event>
+<ScanCodeInfo><ScanType><![CDATA[qrcode]]></ScanType></ScanCodeInfo>
+</xml>''', backend)
+    assert fields["Event"] == "scancode_push"
+    assert isinstance(fields["ScanCodeInfo"], RawXML)
+    assert "<ScanType>qrcode</ScanType>" in dump_xml(fields)
+
+
+def test_parse_comment(backend):
+    data = '''<xml>
+<ToUserName><![CDATA[toUser]]></ToUserName><!-- comment -->
+<?pi target?><Content>hi</Content>
+</xml>'''
+    fields = parse_xml(data, backend)
+    assert fields == parse_xml(data, get_backend("etree"))
+    assert list(fields.keys()) == ["ToUserName", "Content"]
+
+
+def test_message_from_string(backend, xml_builder):
+    from yawxt import parser
+    old_backend = parser._backend
+    parser._backend = backend
+    try:
+        message = Message.from_string(xml_builder(
+            "text", "<Content><![CDATA[中文 & <b>]]></Content>", 1234))
+    finally:
+        parser._backend = old_backend
+    assert message.msg_type == "text"
+    assert message.msg_id == 1234
+    assert message.content == (
+        "<xml><Content>中文 &amp; &lt;b&gt;</Content></xml>")
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import time
+import calendar
+
+import pytest
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.orm import sessionmaker
+
+from yawxt.models import Message, Location
+from yawxt.partition import MonthlyPartitions, read_archive
+from yawxt.persistence import (
+    create_all, message_table, location_table, PersistMessageHandler,
+    WriteBehindBuffer, users_near, users_in_bbox, purge_locations,
+    backfill_payload, backfill_geohash)
+
+AUGUST = calendar.timegm((2017, 8, 13, 0, 0, 0))
+JULY = calendar.timegm((2017, 7, 13, 0, 0, 0))
+
+
+@pytest.fixture()
+def engine(tmpdir):
+    engine = create_engine("sqlite:///%s" % tmpdir.join("partition.db"))
+    create_all(engine)
+    return engine
+
+
+def test_partition_routing(engine, tmpdir, client, xml_builder, openid):
+    partitions = MonthlyPartitions(engine, archive_dir=str(tmpdir))
+    month = time.strftime("%Y%m", time.gmtime())
+    assert month in partitions.months(message_table)
+    indexes = set(
+        i["name"] for i in inspect(engine).get_indexes(
+            "wechat_location_%s" % month))
+    assert "ix_wechat_location_%s_geohash_create_time" % month in indexes
+
+    Session = sessionmaker(bind=engine)
+    PersistMessageHandler(
+        xml_builder("text", "<Content>hello</Content>"), client,
+        db_session_maker=Session, partitions=partitions).reply()
+    PersistMessageHandler(
+        xml_builder("event_LOCATION", '''<Latitude>30.1</Latitude>
+<Longitude>120.1</Longitude><Precision>20</Precision>'''), client,
+        db_session_maker=Session, partitions=partitions).reply()
+    assert engine.execute(message_table.select()).fetchall() == []
+    messages = list(partitions.messages())
+    assert [m.msg_type for m in messages] == ["text", "event_LOCATION"]
+    assert messages[0].from_id == openid
+    locations = list(partitions.locations())
+    assert [(loc.latitude, loc.openid) for loc in locations] == [
+        (30.1, openid)]
+
+    buffer = WriteBehindBuffer(engine, partitions=partitions)
+    buffer.add_message(Message("gh_1", openid, "text", "old", 1, AUGUST))
+    buffer.close()
+    assert partitions.months(message_table)[0] == "201708"
+
+
+def test_partition_archive(engine, tmpdir):
+    partitions = MonthlyPartitions(engine, archive_dir=str(tmpdir))
+    with engine.begin() as conn:
+        partitions.insert(conn, message_table, [
+            {"to_id": "gh_1", "from_id": "user", "msg_type": "text",
+             "content": "消息%d" % i, "create_time": AUGUST + i,
+             "direction": "inbound"} for i in range(5)])
+        partitions.insert(conn, location_table, [
+            {"latitude": 30.0, "longitude": 120.0, "openid": "user",
+             "create_time": AUGUST}])
+
+    paths = partitions.archive_before(calendar.timegm((2017, 9, 1, 0, 0, 0)))
+    assert len(paths) == 2
+    assert "201708" not in partitions.months(message_table)
+    assert partitions.archived_months(message_table) == ["201708"]
+
+    messages = list(read_archive(paths[0]))
+    assert [m.content for m in messages] == ["消息%d" % i for i in range(5)]
+    assert isinstance(messages[0], Message)
+    assert messages[0].direction == "inbound"
+    assert isinstance(next(read_archive(paths[1])), Location)
+
+    assert [m.content for m in partitions.messages(
+        since=AUGUST + 1, until=AUGUST + 3)] == ["消息1", "消息2"]
+    assert list(partitions.messages(until=AUGUST)) == []
+    with pytest.raises(ValueError):
+        partitions.archive(message_table, "201708")
+
+    # 归档后又写入的数据追加到已有的归档文件
+    with engine.begin() as conn:
+        partitions.insert(conn, message_table, [
+            {"to_id": "gh_1", "from_id": "user", "msg_type": "text",
+             "content": "迟到%d" % i, "create_time": AUGUST,
+             "direction": "inbound"} for i in range(2)])
+    export = partitions._export
+    late = []
+
+    def export_and_write(partition, fp, last_id, batch_size):
+        # 导出和删除月表之间写入的数据
+        result = export(partition, fp, last_id, batch_size)
+        if not late:
+            late.append(partition.name)
+            engine.execute(partition.insert(), {
+                "to_id": "gh_1", "from_id": "user", "msg_type": "text",
+                "content": "迟到2", "create_time": AUGUST})
+        return result
+
+    partitions._export = export_and_write
+    assert partitions.archive(message_table, "201708") == paths[0]
+    assert "201708" not in partitions.months(message_table)
+    assert [m.content for m in read_archive(paths[0])] == [
+        "消息%d" % i for i in range(5)] + ["迟到%d" % i for i in range(3)]
+    assert not tmpdir.join("wechat_message_201708.jsonl.gz.tmp").exists()
+
+
+def test_partition_queries(engine, client, xml_builder, openid):
+    partitions = MonthlyPartitions(engine)
+
+    def location(openid, create_time, latitude=39.9042, longitude=116.4074):
+        return {"latitude": latitude, "longitude": longitude,
+                "openid": openid, "create_time": create_time}
+
+    with engine.begin() as conn:
+        # 启用分表前写入原表的数据
+        conn.execute(location_table.insert(), [location("before", 1000)])
+        partitions.insert(conn, location_table, [
+            location("july", JULY), location("august", AUGUST),
+            location("august", AUGUST + 60), location(openid, AUGUST + 120),
+            location("far", AUGUST, 31.2304, 121.4737)])
+        partitions.insert(conn, message_table, [
+            {"to_id": "gh_1", "from_id": "august", "msg_type": msg_type,
+             "content": content, "create_time": AUGUST}
+            for msg_type, content in [
+                ("text", "<Content>分表</Content>"),
+                ("event_LOCATION", "<Latitude>39.9042</Latitude>")]])
+
+    assert [o for o, _ in users_near(engine, 39.9042, 116.4074, 2000)] == [
+        "before"]
+    assert set(o for o, _ in users_near(
+        engine, 39.9042, 116.4074, 2000, partitions=partitions)) == set(
+            ["before", "july", "august", openid])
+    assert users_in_bbox(
+        engine, 39.8, 116.3, 40.0, 116.5, since=AUGUST,
+        partitions=partitions) == set(["august", openid])
+
+    july = partitions.table(location_table, JULY)
+    engine.execute(july.update().values(geohash=None))
+    assert backfill_geohash(engine, partitions=partitions) == 1
+    assert engine.execute(select([july.c.geohash])).scalar() is not None
+    august = partitions.table(message_table, AUGUST)
+    engine.execute(august.update().values(text=None, location_x=None))
+    assert backfill_payload(engine, partitions=partitions) == 2
+    assert engine.execute(
+        select([august.c.text]).where(august.c.msg_type == "text")
+    ).scalar() == "分表"
+
+    # 没有最新位置时从月表中查询历史位置
+    handler = PersistMessageHandler(
+        xml_builder("text", "<Content>hello</Content>"), client,
+        db_session_maker=sessionmaker(bind=engine), partitions=partitions)
+    assert handler.user_location.create_time == AUGUST + 120
+    handler.reply()
+
+    deleted = purge_locations(
+        engine, AUGUST + 3600, keep_every=3600, partitions=partitions)
+    assert deleted == {"locations": 1, "messages": 1}
+    deleted = purge_locations(engine, AUGUST + 3600, partitions=partitions)
+    assert deleted == {"locations": 5, "messages": 0}
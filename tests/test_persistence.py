@@ -6,7 +6,9 @@ import time
 import pytest
 import requests
 
-from yawxt.persistence import PersistMessageHandler
+from yawxt.persistence import (
+    PersistMessageHandler, WriteBehindBuffer, MessageRecord, UserRecord,
+    LocationRecord)
 from yawxt.models import User, Location, Message
 
 
@@ -31,11 +33,11 @@ def test_message_save(client, xml_builder, DB_Session, db_session, openid):
         db_session_maker=DB_Session, debug_to_wechat=True)
     handler.reply()
     message = (
-        db_session.query(Message)
+        db_session.query(MessageRecord)
         .filter_by(msg_id=234567890, from_id=openid).first())
     assert message is not None
     reply_message = (
-        db_session.query(Message)
+        db_session.query(MessageRecord)
         .filter_by(msg_id=234567890, to_id=openid)
         .first())
     assert reply_message is not None
@@ -45,19 +47,52 @@ def test_handler_user(handler, db_session, client, openid):
     left = handler.user
     right = client.get_user(openid)
     assert left == right
-    user = db_session.query(User).filter_by(openid=openid).first()
+    user = db_session.query(UserRecord).filter_by(openid=openid).first()
     assert user == client.get_user(openid)
 
 
+def test_record_conversion(handler, db_session, openid):
+    user = handler.user
+    assert isinstance(user, UserRecord)
+    plain = user.to_model()
+    assert type(plain) is User and not hasattr(plain, "__dict__")
+    assert plain == user and plain.update_time == user.update_time
+    assert UserRecord.from_model(user) is user
+
+    message = Message("gh_1", openid, "text", "<Content>a</Content>", 42)
+    assert not hasattr(message, "__dict__")
+    record = MessageRecord.from_model(message)
+    db_session.add(record)
+    db_session.commit()
+    assert record.id and record.text == "a"
+    assert record == message and record.to_model() == message
+    assert (
+        db_session.query(UserRecord)
+        .filter_by(tagid_list=user.tagid_list).count() == 1)
+
+
+def test_query_model_deprecated(handler, db_session):
+    with pytest.deprecated_call():
+        user = db_session.query(User).filter_by(openid=handler.openid).first()
+    assert isinstance(user, UserRecord) and user.openid == handler.openid
+    with pytest.deprecated_call():
+        location = (
+            db_session.query(Location)
+            .order_by(Location.create_time.desc()).first())
+    assert location.latitude == 39.1353
+    with pytest.deprecated_call():
+        assert db_session.query(Message).count() >= 1
+
+
 def test_location_reported(handler, db_session):
     assert handler.user_location.latitude == 39.1353
     assert handler.user_location.longitude == 117.518
     assert handler.user_location.precision == 30
 
     location = (
-        db_session.query(Location)
+        db_session.query(LocationRecord)
         .filter_by(openid=handler.openid)
-        .order_by(Location.create_time.desc()).first())
+        .order_by(LocationRecord.create_time.desc()).first())
     assert location.latitude == 39.1353
     assert location.longitude == 117.518
     assert location.precision == 30
@@ -65,7 +100,7 @@ def test_location_reported(handler, db_session):
 
 def test_refresh_user(xml_builder, db_session, DB_Session,
                       client, openid, monkeypatch):
-    user = db_session.query(User).filter_by(openid=openid).first()
+    user = db_session.query(UserRecord).filter_by(openid=openid).first()
     assert user is not None
 
     old_time_func = time.time
@@ -114,7 +149,7 @@ def test_refresh_user(xml_builder, db_session, DB_Session,
 
 def test_event_subscribe(client, openid,
                          xml_builder, db_session, DB_Session):
-    user = db_session.query(User).filter_by(openid=openid).first()
+    user = db_session.query(UserRecord).filter_by(openid=openid).first()
     print("first user:", user.update_time)
     assert user is not None
     time.sleep(2)
@@ -130,7 +165,7 @@ def test_event_subscribe(client, openid,
     assert handler.user.subscribe == 1
 
     db_session.expire_all()
-    user2 = db_session.query(User).filter_by(openid=openid).first()
+    user2 = db_session.query(UserRecord).filter_by(openid=openid).first()
     assert user2 == handler.user
     # user will update automatically so next assertion will False
     # assert user2.update_time != user.update_time
@@ -151,7 +186,7 @@ def test_event_subscribe(client, openid,
     assert handler2.user.subscribe == 1
 
     db_session.expire_all()
-    user3 = db_session.query(User).filter_by(openid=openid).first()
+    user3 = db_session.query(UserRecord).filter_by(openid=openid).first()
     assert user3 == handler2.user
     assert user3.update_time == handler2.user.update_time
 
@@ -159,7 +194,7 @@ def test_event_subscribe(client, openid,
 def test_event_unsubscribe(client, openid, monkeypatch,
                            xml_builder, db_session, DB_Session):
 
-    user = db_session.query(User).filter_by(openid=openid).first()
+    user = db_session.query(UserRecord).filter_by(openid=openid).first()
     assert user is not None
 
     time.sleep(2)
@@ -183,6 +218,473 @@ def test_event_unsubscribe(client, openid, monkeypatch,
     assert handler.user.language is not None
 
     db_session.expire_all()
-    user2 = db_session.query(User).filter_by(openid=openid).first()
+    user2 = db_session.query(UserRecord).filter_by(openid=openid).first()
     assert user2 == handler.user
     assert user2.update_time == handler.user.update_time
+
+
+def test_write_behind(client, xml_builder, DB_Session, db_session, openid):
+    from yawxt.persistence import WriteBehindBuffer, latest_location_table
+
+    buffer = WriteBehindBuffer(
+        DB_Session.kw["bind"], batch_size=2, flush_interval=0.05)
+    for msg_id in (345678901, 345678902, 345678903):
+        handler = PersistMessageHandler(
+            xml_builder("text", "<Content>write behind</Content>", msg_id),
+            client, db_session_maker=DB_Session, debug_to_wechat=True,
+            write_behind=buffer)
+        handler.reply()
+        assert handler.user.openid == openid
+    handler = PersistMessageHandler(
+        xml_builder("event_LOCATION", '''<Latitude>30.1</Latitude>
+<Longitude>120.2</Longitude><Precision>10</Precision>'''),
+        client, db_session_maker=DB_Session, write_behind=buffer)
+    handler.reply()
+    # 地理位置也由缓冲区写入，会话中没有需要提交的数据
+    assert not handler._session_writes
+    buffer.close()
+
+    # 6条消息，地理位置事件消息，历史位置和最新位置
+    assert buffer.flushed == 9
+    assert (
+        db_session.query(MessageRecord)
+        .filter(MessageRecord.msg_id.between(345678901, 345678903))
+        .count() == 6)
+    assert handler.user_location.latitude == 30.1
+    assert (
+        db_session.query(LocationRecord)
+        .filter_by(openid=openid, latitude=30.1).count() == 1)
+    latest = db_session.execute(
+        latest_location_table.select()
+        .where(latest_location_table.c.openid == openid)).fetchone()
+    assert latest.latitude == 30.1
+    with pytest.raises(ValueError):
+        buffer.add_message(handler.message)
+
+
+def test_migrate(tmpdir):
+    from sqlalchemy import create_engine, inspect
+    from yawxt.persistence import migrate, message_table
+
+    engine = create_engine("sqlite:///%s" % tmpdir.join("v1.db"))
+    with engine.begin() as conn:
+        for sql in (
+            "CREATE TABLE wechat_message (id INTEGER PRIMARY KEY, "
+            "to_id VARCHAR(100), from_id VARCHAR(100), msg_id BIGINT, "
+            "msg_type VARCHAR(50), create_time INTEGER, content TEXT)",
+            "CREATE TABLE wechat_user (id INTEGER PRIMARY KEY, "
+            "openid VARCHAR(100), nickname VARCHAR(50))",
+            "INSERT INTO wechat_user (openid) VALUES ('a'), ('a'), ('b')",
+            "INSERT INTO wechat_message (to_id, from_id, msg_type) VALUES "
+            "('gh_1', 'user', 'text'), ('user', 'gh_1', 'text')",
+        ):
+            conn.exec_driver_sql(sql)
+
+    actions = migrate(engine, account_ids=["gh_1"], dedupe_users=True,
+                      batch_size=1)
+    assert "add column wechat_message.direction" in actions
+    assert "create index ux_wechat_user_openid" in actions
+    assert "delete 1 duplicated users" in actions
+    assert "create table wechat_location" in actions
+    assert "set direction of 2 messages" in actions
+    indexes = set(
+        i["name"] for i in inspect(engine).get_indexes("wechat_message"))
+    assert indexes == set([
+        "ix_wechat_message_from_id_create_time", "ix_wechat_message_msg_id",
+        "ix_wechat_message_msg_type_event_key", "ix_wechat_message_media_id",
+        "ix_wechat_message_create_time"])
+    rows = engine.execute(
+        message_table.select().order_by(message_table.c.id)).fetchall()
+    assert [row.direction for row in rows] == ["inbound", "reply"]
+    assert migrate(engine) == []
+
+
+def test_message_direction(handler, db_session):
+    messages = (
+        db_session.query(MessageRecord)
+        .filter_by(msg_id=handler.message.msg_id).all())
+    assert set(m.direction for m in messages) == set(["inbound", "reply"])
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_upsert_users(tmpdir, monkeypatch, native):
+    from sqlalchemy import create_engine
+    from yawxt import persistence
+    from yawxt.persistence import create_all, upsert_users, user_table
+
+    engine = create_engine("sqlite:///%s" % tmpdir.join("upsert.db"))
+    create_all(engine)
+    if not native:
+        monkeypatch.setitem(persistence._upsert_statements, "sqlite", None)
+
+    users = [
+        {"openid": "openid_%d" % i, "nickname": "user %d" % i,
+         "subscribe": 1, "tagid_list": [1, i]}
+        for i in range(5)]
+    assert upsert_users(engine, users, update_time=100, batch_size=2) == 5
+    assert upsert_users(engine, [
+        User(openid="openid_1", subscribe=0),
+        {"openid": "openid_9", "nickname": "new"}], update_time=200) == 2
+
+    rows = dict(
+        (row.openid, row) for row in engine.execute(user_table.select()))
+    assert len(rows) == 6
+    assert rows["openid_1"].subscribe == 0
+    assert rows["openid_1"].nickname == "user 1"
+    assert rows["openid_1"].tagid_list == "1,1"
+    assert rows["openid_1"].update_time == 200
+    assert rows["openid_2"].update_time == 100
+    assert rows["openid_9"].nickname == "new"
+
+
+def test_user_tags(tmpdir):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from yawxt.persistence import (
+        create_all, migrate, upsert_users, user_tag_table, user_tags,
+        tag_members, tag_intersection, tag_counts, rebuild_user_tags)
+
+    engine = create_engine("sqlite:///%s" % tmpdir.join("tags.db"))
+    create_all(engine)
+    upsert_users(engine, [
+        {"openid": "a", "tagid_list": [1, 2, 2]},
+        {"openid": "b", "tagid_list": "2,3"},
+        {"openid": "c", "tagid_list": []},
+        {"openid": "d"}])
+    assert user_tags(engine, "a") == [1, 2]
+    assert tag_members(engine, 2) == ["a", "b"]
+    assert tag_intersection(engine, [2, 3]) == ["b"]
+    assert tag_intersection(engine, []) == []
+    assert tag_counts(engine) == {1: 1, 2: 2, 3: 1}
+    assert tag_counts(engine, [3]) == {3: 1}
+
+    # tagid_list为None时不修改，为空时删除全部标签
+    upsert_users(engine, [
+        {"openid": "a"}, {"openid": "b", "tagid_list": []}])
+    assert user_tags(engine, "a") == [1, 2]
+    assert user_tags(engine, "b") == []
+
+    user = sessionmaker(bind=engine)().query(UserRecord).filter_by(
+        openid="a").one()
+    assert user.tagids == [1, 2, 2] and user.tagid_list == "1,2,2"
+    user.tagid_list = [5]
+    assert user.tagids == [5] and user._tagid_list == "5"
+
+    engine.execute(user_tag_table.delete())
+    assert rebuild_user_tags(engine, batch_size=1) == 3
+    assert tag_counts(engine) == {1: 1, 2: 1}
+    user_tag_table.drop(engine)
+    assert "rebuild tags of 3 users" in migrate(engine)
+    assert tag_members(engine, 1) == ["a"]
+
+
+def test_user_cache(client, xml_builder, DB_Session, openid):
+    from yawxt.persistence import UserCache
+
+    cache = UserCache(max_size=2)
+    for msg_id in (456789011, 456789012, 456789013):
+        handler = PersistMessageHandler(
+            xml_builder("text", "<Content>cached</Content>", msg_id),
+            client, db_session_maker=DB_Session, user_cache=cache)
+        handler.reply()
+        assert handler.user.openid == openid
+    assert (cache.hits, cache.misses) == (2, 1)
+    cached_time = cache.get(openid).update_time
+
+    time.sleep(1)
+    handler = PersistMessageHandler(
+        xml_builder("event_unsubscribe", "<EventKey />"),
+        client, db_session_maker=DB_Session, user_cache=cache)
+    handler.reply()
+    assert cache.get(openid).update_time != cached_time
+    assert cache.get(openid, max_age=-1) is None
+
+    cache.put(User(openid="a"))
+    cache.put(User(openid="b"))
+    assert len(cache) == 2
+    assert cache.get(openid) is None
+    cache.invalidate("a")
+    assert cache.get("a") is None
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_latest_location(client, xml_builder, DB_Session, db_session, openid):
+    from yawxt.persistence import (
+        LocationCache, latest_location_table, rebuild_latest_locations,
+        save_latest_location)
+
+    engine = DB_Session.kw["bind"]
+    PersistMessageHandler(
+        xml_builder("event_LOCATION", '''<Latitude>31.5</Latitude>
+<Longitude>121.5</Longitude><Precision>20</Precision>'''),
+        client, db_session_maker=DB_Session).reply()
+    row = engine.execute(latest_location_table.select().where(
+        latest_location_table.c.openid == openid)).first()
+    assert (row.latitude, row.longitude) == (31.5, 121.5)
+
+    # 比已保存的位置旧，不更新
+    save_latest_location(engine, Location(1.0, 2.0, 10, openid, 1000))
+    cache = LocationCache(max_size=10)
+    handler = PersistMessageHandler(
+        xml_builder("text", "<Content>where</Content>"), client,
+        db_session_maker=DB_Session, location_cache=cache)
+    location = handler.user_location
+    assert isinstance(location, Location)
+    assert (location.latitude, location.longitude) == (31.5, 121.5)
+    handler.reply()
+    assert cache.get(openid).precision == 20
+
+    cache.put(Location(1.0, 2.0, 10, openid, 1000))
+    assert cache.get(openid).latitude == 31.5
+    assert cache.get("nobody") is None
+
+    assert rebuild_latest_locations(engine) >= 1
+    row = engine.execute(latest_location_table.select().where(
+        latest_location_table.c.openid == openid)).first()
+    assert (row.latitude, row.longitude) == (31.5, 121.5)
+
+
+def test_location_policy(client, xml_builder, DB_Session, db_session, openid):
+    from yawxt.persistence import LocationCache, LocationPolicy
+
+    # 按整点计数，避免测试时间跨过整点
+    now = int(time.time()) // 3600 * 3600
+    policy = LocationPolicy(min_distance=50, min_interval=60, max_per_hour=2)
+    last = Location(30.0, 120.0, 10, "user", now)
+    near = Location(30.0001, 120.0001, 10, "user", now + 5)
+    far = Location(30.01, 120.0, 10, "user", now + 5)
+    assert policy.check(near, last) == policy.DROP
+    assert policy.check(far, last) == policy.KEEP
+    assert policy.check(Location(30.0, 120.0, 10, "user", now + 100),
+                        last) == policy.KEEP
+    # 每小时最多保存2个
+    assert policy.check(far, None) == policy.DROP
+    assert LocationPolicy(merge=True).check(near, last) == policy.MERGE
+
+    def report(policy, lat):
+        PersistMessageHandler(
+            xml_builder("event_LOCATION", '''<Latitude>%s</Latitude>
+<Longitude>100.0</Longitude><Precision>20</Precision>''' % lat),
+            client, db_session_maker=DB_Session, location_cache=cache,
+            location_policy=policy).reply()
+
+    def count(model, **kwargs):
+        return db_session.query(model).filter_by(**kwargs).count()
+
+    cache = LocationCache()
+    report(None, 20.0)
+    locations = count(LocationRecord, openid=openid)
+    messages = count(MessageRecord, from_id=openid, msg_type="event_LOCATION")
+
+    report(LocationPolicy(), 20.0001)
+    assert count(LocationRecord, openid=openid) == locations
+    assert count(MessageRecord, from_id=openid,
+                 msg_type="event_LOCATION") == messages
+    assert cache.get(openid).latitude == 20.0
+
+    report(LocationPolicy(merge=True, save_messages=True), 20.0002)
+    assert count(LocationRecord, openid=openid) == locations
+    assert count(MessageRecord, from_id=openid,
+                 msg_type="event_LOCATION") == messages + 1
+    assert cache.get(openid).latitude == 20.0
+
+    report(LocationPolicy(), 21.0)
+    assert count(LocationRecord, openid=openid) == locations + 1
+    assert cache.get(openid).latitude == 21.0
+
+
+def test_purge_locations(tmpdir):
+    from sqlalchemy import create_engine
+    from yawxt.persistence import (
+        create_all, location_table, message_table, purge_locations)
+
+    engine = create_engine("sqlite:///%s" % tmpdir.join("purge.db"))
+    create_all(engine)
+    engine.execute(location_table.insert(), [
+        {"openid": openid, "latitude": 1.0, "longitude": 2.0,
+         "create_time": t}
+        for openid in ("a", "b") for t in range(0, 7200, 600)])
+    engine.execute(location_table.insert(), [
+        {"openid": "a", "latitude": 1.0, "longitude": 2.0,
+         "create_time": 10000}])
+    engine.execute(message_table.insert(), [
+        {"from_id": "a", "msg_type": "event_LOCATION", "create_time": 100},
+        {"from_id": "a", "msg_type": "text", "create_time": 100},
+        {"from_id": "a", "msg_type": "event_LOCATION", "create_time": 10000},
+    ])
+
+    deleted = purge_locations(engine, 7200, keep_every=3600, batch_size=5)
+    assert deleted == {"locations": 20, "messages": 1}
+    rows = engine.execute(
+        location_table.select().order_by(location_table.c.id)).fetchall()
+    assert [(r.openid, r.create_time) for r in rows] == [
+        ("a", 0), ("a", 3600), ("b", 0), ("b", 3600), ("a", 10000)]
+
+    deleted = purge_locations(engine, 7200, messages=False)
+    assert deleted == {"locations": 4, "messages": 0}
+    assert len(engine.execute(message_table.select()).fetchall()) == 2
+
+
+def test_users_near(tmpdir):
+    from sqlalchemy import create_engine
+    from yawxt.persistence import (
+        migrate, location_table, users_near, users_in_bbox)
+
+    engine = create_engine("sqlite:///%s" % tmpdir.join("geo.db"))
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE wechat_location (id INTEGER PRIMARY KEY, "
+            "latitude FLOAT, longitude FLOAT, precision FLOAT, "
+            "create_time INTEGER, openid VARCHAR(100))")
+        conn.exec_driver_sql(
+            "INSERT INTO wechat_location (latitude, longitude, create_time, "
+            "openid) VALUES (39.9100, 116.4074, 100, 'old')")
+    actions = migrate(engine)
+    assert "add column wechat_location.geohash" in actions
+    assert "set geohash of 1 locations" in actions
+
+    engine.execute(location_table.insert(), [
+        # 约1.1公里
+        {"openid": "near", "latitude": 39.9142, "longitude": 116.4074,
+         "create_time": 200},
+        {"openid": "near", "latitude": 39.9050, "longitude": 116.4074,
+         "create_time": 300},
+        # 约2.5公里
+        {"openid": "far", "latitude": 39.9042, "longitude": 116.4370,
+         "create_time": 200},
+        {"openid": "other", "latitude": 31.2304, "longitude": 121.4737,
+         "create_time": 200},
+    ])
+    assert engine.execute(
+        location_table.select().where(location_table.c.openid == "far")
+    ).first().geohash.startswith("wx4g")
+
+    result = users_near(engine, 39.9042, 116.4074, 2000)
+    assert [openid for openid, _ in result] == ["near", "old"]
+    assert result[0][1] == pytest.approx(89, abs=1)
+    assert [openid for openid, _ in users_near(
+        engine, 39.9042, 116.4074, 2000, since=150, until=250)] == ["near"]
+    assert [openid for openid, _ in users_near(
+        engine, 39.9042, 116.4074, 3000)] == ["near", "old", "far"]
+
+    assert users_in_bbox(engine, 39.9, 116.4, 39.92, 116.45) == set(
+        ["near", "old", "far"])
+    assert users_in_bbox(
+        engine, 39.9, 116.4, 39.92, 116.45, since=250) == set(["near"])
+
+
+def test_message_payload(client, xml_builder, DB_Session, db_session, openid,
+                         tmpdir):
+    from sqlalchemy import create_engine
+    from yawxt.persistence import (
+        extract_payload, backfill_payload, create_all, message_table)
+
+    payload = extract_payload(
+        "<xml><MediaId>m1</MediaId><PicUrl>http://a/b.jpg</PicUrl></xml>")
+    assert payload["media_id"] == "m1"
+    assert payload["pic_url"] == "http://a/b.jpg"
+    assert payload["text"] is None
+    payload = extract_payload(
+        "<Latitude>23.1</Latitude><Longitude>113.3</Longitude>")
+    assert (payload["location_x"], payload["location_y"]) == (23.1, 113.3)
+    assert extract_payload(None)["status"] is None
+
+    class Handler(PersistMessageHandler):
+        def on_text(self, text):
+            self.reply_text("reply: " + text)
+
+    engine = DB_Session.kw["bind"]
+    c = message_table.c
+    for raw_content in (True, False):
+        Handler(
+            xml_builder("text", "<Content>payload %s</Content>" % raw_content),
+            client, db_session_maker=DB_Session,
+            raw_content=raw_content).reply()
+        row = engine.execute(message_table.select().where(
+            c.text == "payload %s" % raw_content)).first()
+        assert row.from_id == openid
+        assert (row.content is not None) == raw_content
+        assert engine.execute(message_table.select().where(
+            c.text == "reply: payload %s" % raw_content)).first() is not None
+    PersistMessageHandler(
+        xml_builder("event_CLICK", "<EventKey>MENU_1</EventKey>"), client,
+        db_session_maker=DB_Session).reply()
+    assert engine.execute(message_table.select().where(
+        (c.msg_type == "event_CLICK") & (c.event_key == "MENU_1"))).first()
+
+    engine = create_engine("sqlite:///%s" % tmpdir.join("payload.db"))
+    create_all(engine)
+    engine.execute(message_table.insert(), [
+        {"msg_type": "text", "content": "<xml><Content>a</Content></xml>",
+         "text": None},
+        {"msg_type": "event_subscribe", "content": "<xml></xml>",
+         "text": None},
+    ])
+    assert backfill_payload(engine) == 1
+    assert backfill_payload(engine, raw_content=False) == 1
+    rows = engine.execute(
+        message_table.select().order_by(c.id)).fetchall()
+    assert [(r.text, r.content) for r in rows] == [
+        ("a", "<xml><Content>a</Content></xml>"), (None, None)]
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_message_stats(tmpdir, monkeypatch, native, client, xml_builder,
+                       openid):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from yawxt.persistence import (
+        create_all, message_table, update_message_stats,
+        rebuild_message_stats, message_stats, subscribe_stats)
+    from yawxt import persistence
+
+    if not native:
+        monkeypatch.setitem(persistence._stats_statements, "sqlite", None)
+    engine = create_engine("sqlite:///%s" % tmpdir.join("stats.db"))
+    create_all(engine)
+    day = 1502553600  # 2017-08-13 00:00 +08:00
+    engine.execute(message_table.insert(), [
+        {"to_id": "gh_1", "from_id": "u%d" % i, "msg_type": msg_type,
+         "create_time": day + hour * 3600 + i, "direction": direction}
+        for i, (msg_type, hour, direction) in enumerate([
+            ("text", 0, "inbound"), ("text", 0, None), ("image", 1, None),
+            ("event_subscribe", 1, "inbound"),
+            ("event_subscribe", 25, "inbound"),
+            ("event_unsubscribe", 26, "inbound"),
+        ])])
+    engine.execute(message_table.insert(), [
+        {"to_id": "u0", "from_id": "gh_1", "msg_type": "text",
+         "create_time": day + 10, "direction": "reply"}])
+
+    assert rebuild_message_stats(engine) == 7
+    # 重复执行结果相同
+    assert rebuild_message_stats(engine, since=day) == 7
+    since, until = day, day + 2 * 86400
+    assert message_stats(engine, since, until) == [
+        (day, "event_subscribe", 1), (day, "image", 1), (day, "text", 2),
+        (day + 86400, "event_subscribe", 1),
+        (day + 86400, "event_unsubscribe", 1)]
+    assert message_stats(
+        engine, since, until, interval="hour", msg_types=["text"],
+        direction=None) == [(day, "text", 3)]
+    assert message_stats(engine, since, until, account="gh_2") == []
+    assert subscribe_stats(engine, since, until) == [
+        (day, 1, 0), (day + 86400, 1, 1)]
+
+    update_message_stats(engine, [
+        Message("gh_1", "u9", "text", "", create_time=day + 100,
+                direction="inbound")])
+    buffer = WriteBehindBuffer(engine, message_stats=True)
+    buffer.add_message(Message("gh_1", "u9", "text", "", None, day + 200))
+    buffer.close()
+    assert message_stats(engine, since, until, msg_types=["text"]) == [
+        (day, "text", 4)]
+
+    Session = sessionmaker(bind=engine)
+    PersistMessageHandler(
+        xml_builder("event_subscribe", "<EventKey></EventKey>"), client,
+        db_session_maker=Session, message_stats=True).reply()
+    now = int(time.time())
+    assert subscribe_stats(engine, now - 86400, now + 3600) == [
+        (now - (now + 28800) % 86400, 1, 0)]
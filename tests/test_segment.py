@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import pytest
+from sqlalchemy import create_engine
+
+from yawxt.persistence import create_all, upsert_users
+from yawxt.segment import Segment
+
+
+@pytest.fixture()
+def engine(tmpdir):
+    engine = create_engine("sqlite:///%s" % tmpdir.join("segment.db"))
+    create_all(engine)
+    upsert_users(engine, [
+        {"openid": "u%02d" % i, "subscribe": 0 if i == 9 else 1,
+         "sex": 2 if i % 2 else 1,
+         "province": "广东" if i < 6 else "浙江",
+         "city": "广州" if i < 3 else "深圳",
+         "language": "zh_CN", "subscribe_time": 1000 + i,
+         "tagid_list": [12, 30] if i == 1 else [12] if i % 2 else []}
+        for i in range(12)])
+    return engine
+
+
+def test_segment(engine):
+    segment = Segment(
+        sex=2, province="广东", subscribed_since=1001, tags=[12],
+        exclude_tags=[30])
+    assert list(segment.openids(engine)) == ["u03", "u05"]
+    assert segment.count(engine) == 2
+
+    assert Segment(city=["广州", "深圳"], sex=[1, 2]).count(engine) == 11
+    assert Segment(subscribed=False).count(engine) == 12
+    assert list(Segment(tags=[12, 30]).openids(engine)) == ["u01"]
+    assert Segment(
+        subscribed_since=1002, subscribed_until=1004).count(engine) == 2
+    assert Segment(exclude_tags=[12]).count(engine) == 6
+
+
+def test_segment_batches(engine):
+    segment = Segment(subscribed=False)
+    batches = list(segment.batches(engine, batch_size=5))
+    assert [len(openids) for openids in batches] == [5, 5, 2]
+    assert batches[1][0] == "u05"
+    assert list(segment.openids(engine, batch_size=4)) == [
+        "u%02d" % i for i in range(12)]
+    assert list(Segment(tags=[99]).batches(engine)) == []
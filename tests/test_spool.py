@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for the inbound message spool'''
+
+from __future__ import unicode_literals
+import io
+import time
+import hashlib
+import threading
+
+import pytest
+from yawxt import MessageHandler, Message, SpoolFullError
+from yawxt.spool import Spool, SpoolWorkerPool
+from yawxt.wsgi import WechatApp
+
+
+def build(openid, i):
+    return Message(
+        "appid", openid, "text", "<Content>%d</Content>" % i, i).build_xml()
+
+
+class RecordHandler(MessageHandler):
+    __slots__ = ()
+    lock = threading.Lock()
+    received = {}
+
+    def on_text(self, text):
+        if text == "boom":
+            raise ValueError(text)
+        time.sleep(0.001)
+        with self.lock:
+            self.received.setdefault(self.openid, []).append(int(text))
+        self.reply_text(text)
+
+
+@pytest.fixture
+def spool(tmpdir):
+    s = Spool(str(tmpdir.join("spool.db")))
+    yield s
+    s.close()
+
+
+def test_spool(spool, tmpdir):
+    first = spool.put(build("user_a", 1))
+    spool.put(build("user_b", 2), {"openid": "from_query"})
+    assert len(spool) == 2
+    items = spool.fetch()
+    assert [item.partition_key for item in items] == ["user_a", "from_query"]
+    assert items[1].query == {"openid": "from_query"}
+    assert spool.fetch(first)[0].id == items[1].id
+
+    spool.ack([first])
+    spool.fail([items[1].id])
+    stats = spool.stats()
+    assert (stats["pending"], stats["failed"]) == (0, 1)
+    assert spool.retry_failed() == 1
+    assert spool.fetch(items[1].id)[0].partition_key == "from_query"
+
+    reopened = Spool(str(tmpdir.join("spool.db")), max_pending=1)
+    assert len(reopened) == 1
+    assert reopened.stats()["lag"] > 0
+    with pytest.raises(SpoolFullError):
+        reopened.put(build("user_a", 3))
+    reopened.close()
+
+
+def test_worker_pool(spool):
+    RecordHandler.received.clear()
+    users = ["user_%d" % i for i in range(5)]
+    for i in range(200):
+        spool.put(build(users[i % 5], i))
+    spool.put(Message(
+        "appid", "user_0", "text", "<Content>boom</Content>").build_xml())
+    pool = SpoolWorkerPool(spool, RecordHandler, workers=3, batch_size=16)
+    pool.start()
+    for i in range(200, 300):
+        spool.put(build(users[i % 5], i))
+    pool.stop()
+
+    for n, user in enumerate(users):
+        assert RecordHandler.received[user] == list(range(n, 300, 5))
+    stats = pool.stats()
+    assert stats["processed"] == 300
+    assert (stats["pending"], stats["failed"]) == (0, 1)
+    assert stats["queued"] == [0, 0, 0]
+
+
+def test_accept_fast(tmpdir):
+    spool = Spool(str(tmpdir.join("fast.db")), max_pending=1)
+    app = WechatApp(RecordHandler, "token", spool=spool)
+    timestamp = str(int(time.time()))
+    signature = hashlib.sha1("".join(
+        sorted(["token", timestamp, "nonce"])).encode()).hexdigest()
+    body = build("user_a", 1).encode("utf8")
+    statuses = []
+    for _ in range(2):
+        environ = {
+            "REQUEST_METHOD": "POST",
+            "QUERY_STRING": "signature=%s&timestamp=%s&nonce=nonce" % (
+                signature, timestamp),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+        }
+        result = app(environ, lambda status, headers: statuses.append(status))
+        assert result == []
+    assert statuses == ["200 OK", "503 Service Unavailable"]
+    assert spool.fetch()[0].content == body
+    spool.close()
+
+
+def test_max_pending_concurrent(tmpdir):
+    spool = Spool(str(tmpdir.join("full.db")), max_pending=5)
+    accepted = []
+
+    def put(i):
+        for j in range(3):
+            try:
+                accepted.append(spool.put(build("user_%d" % i, j)))
+            except SpoolFullError:
+                pass
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(accepted) == len(spool) == len(spool.fetch()) == 5
+    spool.close()
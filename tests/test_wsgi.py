@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for the WSGI application'''
+
+from __future__ import unicode_literals
+import io
+import time
+import hashlib
+
+import pytest
+from yawxt import MessageHandler, Message
+from yawxt.crypto import MessageCrypto
+from yawxt.parser import parse_xml
+from yawxt.wsgi import WechatApp
+
+TOKEN = "token"
+
+
+class EchoHandler(MessageHandler):
+    __slots__ = ()
+
+    def on_text(self, text):
+        self.reply_text("echo %s" % text)
+
+
+def signed_query(extra=""):
+    timestamp = str(int(time.time()))
+    nonce = "nonce"
+    signature = hashlib.sha1(
+        "".join(sorted([TOKEN, timestamp, nonce])).encode()).hexdigest()
+    return "signature=%s&timestamp=%s&nonce=%s%s" % (
+        signature, timestamp, nonce, extra)
+
+
+def call(app, method="POST", query="", body=b"", length=None):
+    environ = {
+        "REQUEST_METHOD": method,
+        "QUERY_STRING": query,
+        "CONTENT_LENGTH": str(len(body) if length is None else length),
+        "wsgi.input": io.BytesIO(body),
+    }
+    result = {}
+
+    def start_response(status, headers):
+        result["status"] = status
+        result["headers"] = dict(headers)
+
+    result["body"] = b"".join(app(environ, start_response))
+    return result
+
+
+@pytest.fixture
+def app():
+    return WechatApp(EchoHandler, TOKEN, max_body_size=1024)
+
+
+def test_echostr(app):
+    rv = call(app, "GET", signed_query("&echostr=12%2034"))
+    assert rv["status"] == "200 OK"
+    assert rv["body"] == b"12 34"
+    assert rv["headers"]["Content-Length"] == "5"
+
+    rv = call(app, "GET", "echostr=1234")
+    assert rv["status"].startswith("403")
+    rv = call(app, "PUT", signed_query())
+    assert rv["status"].startswith("405")
+
+
+def test_message(app, xml_builder, openid):
+    body = xml_builder("text", "<Content>hello</Content>", 1).encode("utf8")
+    rv = call(app, query=signed_query(), body=body)
+    assert rv["status"] == "200 OK"
+    assert rv["headers"]["Content-Length"] == str(len(rv["body"]))
+    message = Message.from_string(rv["body"])
+    assert message.to_id == openid
+    assert "echo hello" in message.content
+
+    rv = call(app, query=signed_query(), body=body, length=2048)
+    assert rv["status"].startswith("413")
+    rv = call(app, query=signed_query(), body=body, length="")
+    assert rv["status"].startswith("411")
+    rv = call(app, query=signed_query(), body=body, length=len(body) + 1)
+    assert rv["status"].startswith("400")
+
+
+def test_encrypted_message(client, xml_builder, openid):
+    crypto = MessageCrypto(
+        TOKEN, "abcdefghijklmnopqrstuvwxyz0123456789ABCDEFG", client.appid)
+    app = WechatApp(EchoHandler, TOKEN, crypto=crypto)
+    query = signed_query()
+    timestamp = query.split("timestamp=")[1].split("&")[0]
+    encrypt = crypto.encrypt(xml_builder("text", "<Content>aes</Content>", 1))
+    body = b"<xml><Encrypt><![CDATA[" + encrypt + b"]]></Encrypt></xml>"
+    msg_signature = crypto.signature(timestamp, "nonce", encrypt)
+
+    rv = call(app, query=query + "&encrypt_type=aes&msg_signature=" +
+              msg_signature, body=body)
+    assert rv["status"] == "200 OK"
+    fields = parse_xml(rv["body"])
+    reply = Message.from_string(crypto.decrypt(fields["Encrypt"]))
+    assert reply.to_id == openid
+    assert "echo aes" in reply.content
+
+    rv = call(app, query=query + "&encrypt_type=aes&msg_signature=0",
+              body=body)
+    assert rv["status"].startswith("400")
@@ -4,7 +4,8 @@ import logging
 import sys
 
 from .client import WxClient
-from .message import MessageHandler, check_signature
+from .message import MessageHandler, check_signature, route
+from .dispatcher import Dispatcher
 from .models import Message, User, Location
 from .exceptions import *  # noqa: F405, F403
 
@@ -14,8 +15,9 @@ logger.addHandler(logging.StreamHandler(sys.stdout))
 logger.setLevel(logging.INFO)
 
 __all__ = [  # noqa: F405
-    "WxClient", "MessageHandler", "Message", "User", "Location",
-    "check_signature", "APIError", "SemanticAPIError", ]
+    "WxClient", "MessageHandler", "Dispatcher", "Message", "User", "Location",
+    "check_signature", "route", "APIError", "SemanticAPIError",
+    "MessageCryptoError", "SpoolFullError", ]
 __all__.extend(map(
     lambda cls: cls.__name__,
     default_exceptions.values()))    # noqa
@@ -0,0 +1,265 @@
+# -*- coding:utf-8 -*-
+
+'''asyncio消息处理类和ASGI应用，需要python3.5以上版本
+
+:class:`AsyncMessageHandler` 的 ``on_`` , ``event_`` , :meth:`before` ,
+:meth:`finish` 等方法可以是协程，处理消息时会等待其完成；阻塞的公众号
+API调用（如获取用户信息）在线程池中执行，不会阻塞事件循环，一个进程可以
+同时处理大量消息：
+
+.. code-block:: python
+
+    from yawxt.asgi import AsyncMessageHandler, WechatApp
+
+    class Handler(AsyncMessageHandler):
+
+        async def on_text(self, text):
+            user = await self.get_user()
+            answer = await query_answer(text)
+            self.reply_text("%s: %s" % (user.nickname, answer))
+
+    app = WechatApp(Handler, "token", client)
+
+    # uvicorn module:app
+
+保存消息到数据库请使用
+:class:`~yawxt.async_persistence.AsyncPersistMessageHandler` 。
+'''
+
+import asyncio
+import inspect
+import logging
+import functools
+
+from .dispatcher import Dispatcher
+from .exceptions import MessageCryptoError, SpoolFullError
+from .message import MessageHandler, check_signature
+from .wsgi import _parse_query
+
+__all__ = ["AsyncMessageHandler", "WechatApp"]
+
+logger = logging.getLogger(__name__)
+
+
+async def _resolve(result):
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+class AsyncMessageHandler(MessageHandler):
+    '''asyncio微信消息处理基类，使用方法与 :class:`~yawxt.MessageHandler` 相同，
+    区别在于：
+
+    #. ``on_`` , ``event_`` , :func:`~yawxt.route` 路由的方法，
+       :meth:`before` 和 :meth:`finish` 可以定义为协程
+
+    #. 使用 ``await self.get_user()`` 获取用户信息，不要使用会阻塞的
+       :attr:`user`
+
+    #. 使用 ``await handler.process(content)`` 处理消息，
+       ``await handler.reply()`` 得到回复内容
+
+    :param client: 微信公众号账号, :class:`~yawxt.WxClient` 对象
+    :param debug_to_wechat: 使用 reply_debug_text 可以将调试信息发送到用户微信
+    :param options: 其他参数，如安全模式的 ``crypto``
+
+    :cvar executor: 执行阻塞调用的 ``concurrent.futures.Executor`` ，
+        默认为 ``None`` ，使用事件循环默认的线程池
+    '''
+
+    __slots__ = ()
+
+    executor = None
+
+    def __init__(self, client=None, debug_to_wechat=False, **options):
+        self._setup(client, debug_to_wechat, **options)
+
+    async def process(self, content, query=None):
+        '''处理一条消息
+
+        :param content: 从微信服务器接收的xml格式的消息
+        :param query: 请求url的query_string参数字典，安全模式下用于检查签名
+        '''
+        self._parse(content, query)
+        await _resolve(self._before())
+        await _resolve(self._dispatch())
+
+    def run_sync(self, func, *args):
+        '''在 :attr:`executor` 中执行阻塞的函数
+
+        :returns: 可以await的 ``asyncio.Future``
+        '''
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self.executor, functools.partial(func, *args))
+
+    async def get_user(self):
+        '''获取发送消息的用户信息，结果与 :attr:`user` 相同
+
+        :rtype: :class:`~yawxt.User`
+        '''
+        if self.client is not None and self._user is None:
+            self._user = await self.run_sync(
+                self.client.get_user, self.openid)
+        return self._user
+
+    async def on_text(self, text):
+        '''接收到文本消息处理方法，与 :meth:`MessageHandler.on_text
+        <yawxt.MessageHandler.on_text>` 相同，关键词规则的回复可以是协程
+        '''
+        keywords = self.keywords
+        if keywords is not None:
+            rule = keywords.match(text)
+            if rule is not None:
+                await _resolve(keywords.apply(rule, self, text))
+                return
+        if self._debug_to_wechat:
+            self.reply_text(text)
+
+    async def reply(self):
+        ''':returns: 事件或消息处理完成后最终回复给微信的UTF-8编码的xml内容
+        :rtype: bytes
+
+        .. note:: 此方法只允许调用一次'''
+        reply_raw = self._render()
+        await _resolve(self._finish())
+        return reply_raw
+
+
+_HEADERS_XML = [
+    (b"content-type", b"application/xml; charset=utf-8")]
+_HEADERS_TEXT = [
+    (b"content-type", b"text/plain; charset=utf-8")]
+
+
+class WechatApp(object):
+    '''微信消息接口的ASGI应用，参数与 :class:`yawxt.wsgi.WechatApp` 相同
+
+    :param handler_cls: :class:`AsyncMessageHandler` 或其子类；
+        同步的 :class:`~yawxt.MessageHandler` 子类也可以使用，整条消息
+        在线程池中处理
+    :param token: 公众号后台填写的token
+    :param client: 微信公众号账号, :class:`~yawxt.WxClient` 对象
+    :param debug_to_wechat: 使用 reply_debug_text 可以将调试信息发送到用户微信
+    :param max_body_size: 消息体的最大字节数，超过时返回413，默认为64KB
+    :param time_error: 与微信服务器时间的误差允许秒数
+    :param executor: 同步消息处理类使用的 ``concurrent.futures.Executor``
+    :param spool: 快速接收模式的消息队列 :class:`~yawxt.spool.Spool`
+    :param options: 消息处理类的其他参数
+    '''
+
+    def __init__(self, handler_cls, token, client=None, debug_to_wechat=False,
+                 max_body_size=65536, time_error=600, executor=None,
+                 spool=None, **options):
+        self.handler_cls = handler_cls
+        self.token = token
+        self.client = client
+        self.debug_to_wechat = debug_to_wechat
+        self.max_body_size = max_body_size
+        self.time_error = time_error
+        self.executor = executor
+        self.spool = spool
+        self.options = options
+        self._dispatcher = None
+        if not issubclass(handler_cls, AsyncMessageHandler):
+            self._dispatcher = Dispatcher(
+                handler_cls, client, debug_to_wechat, **options)
+
+    def check(self, query):
+        '''检查请求url中的签名
+
+        :param query: url query_string参数字典
+        :rtype: bool
+        '''
+        try:
+            return check_signature(
+                self.token, query.get("timestamp"), query.get("nonce"),
+                query.get("signature"), self.time_error)
+        except ValueError:
+            return False
+
+    async def handle(self, content, query=None):
+        '''处理一条消息并返回回复内容
+
+        :rtype: bytes
+        '''
+        if self._dispatcher is not None:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self.executor, self._dispatcher, content, query)
+        handler_cls = self.handler_cls
+        handler = handler_cls.__new__(handler_cls)
+        handler._setup(self.client, self.debug_to_wechat, **self.options)
+        await handler.process(content, query)
+        return await handler.reply()
+
+    async def read_body(self, scope, receive):
+        '''读取消息体，返回 ``(status, body)`` ，读取失败时body为 ``None``'''
+        for name, value in scope.get("headers", ()):
+            if name == b"content-length":
+                try:
+                    if int(value) > self.max_body_size:
+                        return 413, None
+                except ValueError:
+                    return 400, None
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return 400, None
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body_size:
+                return 413, None
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                break
+        return 200, chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            raise ValueError("unsupported scope type: %s" % scope["type"])
+
+        query = _parse_query(scope.get("query_string", b"").decode("latin1"))
+        status, body, headers = 200, b"", _HEADERS_TEXT
+        method = scope["method"]
+        if not self.check(query):
+            status = 403
+        elif method == "POST":
+            status, content = await self.read_body(scope, receive)
+            if content is not None and self.spool is not None:
+                loop = asyncio.get_event_loop()
+                try:
+                    # 写入sqlite并提交是阻塞调用
+                    await loop.run_in_executor(
+                        self.executor, self.spool.put, content, query)
+                except SpoolFullError as e:
+                    logger.warning("message rejected: %s", e)
+                    status = 503
+            elif content is not None:
+                try:
+                    body = await self.handle(content, query)
+                    headers = _HEADERS_XML
+                except MessageCryptoError as e:
+                    logger.warning("invalid encrypted message: %s", e)
+                    status = 400
+        elif method == "GET":
+            body = query.get("echostr", "").encode("utf8")
+        else:
+            status = 405
+        await send({
+            "type": "http.response.start", "status": status,
+            "headers": headers + [
+                (b"content-length", str(len(body)).encode("ascii"))],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,235 @@
+# -*- coding:utf-8 -*-
+
+'''微信消息加解密（安全模式）
+
+公众号后台设置为安全模式或兼容模式后，微信推送的消息放在 ``Encrypt`` 字段中，
+回复的消息也需要加密。每个公众号创建一个 :class:`MessageCrypto` 对象，
+EncodingAESKey的解码和AES密钥对象只在创建时生成一次，之后所有消息复用：
+
+.. code-block:: python
+
+    crypto = MessageCrypto(token, encoding_aes_key, appid)
+    dispatcher = Dispatcher(Handler, client, crypto=crypto)
+
+    @app.route('/wechat', methods=["POST"])
+    def wechat():
+        return dispatcher(request.data, query=request.args)
+
+需要安装 ``cryptography``
+'''
+
+from __future__ import unicode_literals
+import os
+import re
+import hmac
+import time
+import base64
+import struct
+import hashlib
+import logging
+import threading
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import (
+        Cipher, algorithms, modes)
+except ImportError:
+    logging.error(
+        "please install cryptography "
+        "if you want to use safe mode(aes) messages")
+    raise
+
+from .exceptions import MessageCryptoError
+from .parser import parse_xml
+
+__all__ = ["MessageCrypto"]
+
+# 微信使用32字节的PKCS7填充
+_BLOCK_SIZE = 32
+_PADDINGS = [
+    struct.pack("B", n) * n for n in range(_BLOCK_SIZE + 1)]
+
+
+_ENCRYPT_RE = re.compile(
+    br"<Encrypt>\s*<!\[CDATA\[([A-Za-z0-9+/=]+)\]\]>\s*</Encrypt>")
+
+# python2的int没有from_bytes，使用每条消息一个CBC解密对象
+_INT_BYTES = hasattr(int, "from_bytes")
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode("utf8")
+
+
+class MessageCrypto(object):
+    '''公众号消息加解密
+
+    :param token: 公众号后台填写的token
+    :param encoding_aes_key: 公众号后台的EncodingAESKey，43个字符
+    :param appid: 公众号的appid
+    :param time_error: 与 :func:`~yawxt.check_signature` 相同，
+        消息timestamp参数与当前时间的误差允许秒数，超过时拒绝解密，
+        防止截获的消息被重放，默认为0，不检查
+    '''
+
+    def __init__(self, token, encoding_aes_key, appid, time_error=0):
+        key = base64.b64decode(_to_bytes(encoding_aes_key) + b"=")
+        if len(key) != 32:
+            raise ValueError("invalid EncodingAESKey")
+        self.token = token
+        self.appid = appid
+        self.time_error = time_error
+        self._appid = _to_bytes(appid)
+        self._iv = key[:16]
+        self._cipher = Cipher(
+            algorithms.AES(key), modes.CBC(self._iv),
+            backend=default_backend())
+        # ECB解密对象没有跨块的状态，每个线程创建一次后重复使用，
+        # CBC的异或在解密后一次完成
+        self._ecb = Cipher(
+            algorithms.AES(key), modes.ECB(), backend=default_backend())
+        self._local = threading.local()
+
+    def signature(self, timestamp, nonce, encrypt):
+        '''计算加密消息的签名msg_signature
+
+        :rtype: str
+        '''
+        if isinstance(encrypt, bytes):
+            encrypt = encrypt.decode("ascii")
+        return hashlib.sha1("".join(sorted([
+            self.token, timestamp, nonce, encrypt])).encode()).hexdigest()
+
+    def decrypt(self, encrypt):
+        '''解密 ``Encrypt`` 字段的内容
+
+        :param encrypt: base64编码的密文
+        :returns: 消息明文的xml
+        :rtype: bytes
+        '''
+        try:
+            plain = self._decrypt_cbc(base64.b64decode(_to_bytes(encrypt)))
+            pad = bytearray(plain[-1:])[0]
+            length = struct.unpack_from(">I", plain, 16)[0]
+        except Exception as e:
+            raise MessageCryptoError("decrypt message failed: %s" % e)
+        end = 20 + length
+        if not 0 < pad <= _BLOCK_SIZE or end > len(plain) - pad:
+            raise MessageCryptoError("invalid message padding")
+        if memoryview(plain)[end:len(plain) - pad] != self._appid:
+            raise MessageCryptoError("appid of message does not match")
+        return plain[20:end]
+
+    def _decrypt_cbc(self, data):
+        if not _INT_BYTES:
+            decryptor = self._cipher.decryptor()
+            plain = decryptor.update(data)
+            decryptor.finalize()
+            return plain
+        if not data or len(data) % 16:
+            raise ValueError("invalid ciphertext length")
+        decryptor = getattr(self._local, "decryptor", None)
+        if decryptor is None:
+            decryptor = self._local.decryptor = self._ecb.decryptor()
+        size = len(data)
+        return (
+            int.from_bytes(decryptor.update(data), "big") ^
+            int.from_bytes(self._iv + data[:-16], "big")).to_bytes(
+                size, "big")
+
+    def find_encrypt(self, xml):
+        '''不解析整个xml，直接取出 ``Encrypt`` 字段
+
+        :param xml: 微信推送的xml
+        :returns: ``Encrypt`` 的内容，没有找到时为 ``None``
+        :rtype: bytes
+        '''
+        m = _ENCRYPT_RE.search(_to_bytes(xml))
+        return m.group(1) if m is not None else None
+
+    def encrypt(self, xml):
+        '''加密回复消息
+
+        :param xml: 消息明文的xml
+        :returns: base64编码的密文
+        :rtype: bytes
+        '''
+        xml = _to_bytes(xml)
+        length = 20 + len(xml) + len(self._appid)
+        encryptor = self._cipher.encryptor()
+        encrypted = encryptor.update(b"".join([
+            os.urandom(16), struct.pack(">I", len(xml)), xml, self._appid,
+            _PADDINGS[_BLOCK_SIZE - length % _BLOCK_SIZE]]))
+        encryptor.finalize()
+        return base64.b64encode(encrypted)
+
+    def decrypt_message(self, xml, msg_signature, timestamp, nonce):
+        '''检查签名并解密微信推送的加密消息
+
+        :param xml: 微信推送的xml，或 :func:`~yawxt.parser.parse_xml`
+            解析后的字段字典
+        :param msg_signature: 从url query_string获取的msg_signature参数
+        :param timestamp: 从url query_string获取的timestamp参数
+        :param nonce: 从url query_string获取的nonce参数
+        :returns: 消息明文的xml
+        :rtype: bytes
+        '''
+        if isinstance(xml, dict):
+            encrypt = xml.get("Encrypt")
+        else:
+            encrypt = self.find_encrypt(xml)
+            if encrypt is None:
+                encrypt = parse_xml(xml).get("Encrypt")
+        if not encrypt:
+            raise MessageCryptoError("no Encrypt element found")
+        if None in (msg_signature, timestamp, nonce) or (
+                not hmac.compare_digest(
+                    _to_bytes(self.signature(timestamp, nonce, encrypt)),
+                    _to_bytes(msg_signature))):
+            raise MessageCryptoError("message signature does not match")
+        if self.time_error > 0:
+            try:
+                expired = abs(int(timestamp) - time.time()) > self.time_error
+            except ValueError:
+                expired = True
+            if expired:
+                raise MessageCryptoError("message timestamp expired")
+        return self.decrypt(encrypt)
+
+    def decrypt_fields(self, fields, query):
+        '''解密已解析的加密消息字段，返回明文消息的字段字典
+
+        :param fields: :func:`~yawxt.parser.parse_xml` 解析后的字段字典，
+            或 :meth:`find_encrypt` 取出的 ``Encrypt`` 内容
+        :param query: url query_string参数字典，包含 ``msg_signature`` ,
+            ``timestamp`` , ``nonce``
+        :rtype: dict
+        '''
+        query = query or {}
+        if not isinstance(fields, dict):
+            fields = {"Encrypt": fields}
+        return parse_xml(self.decrypt_message(
+            fields, query.get("msg_signature"), query.get("timestamp"),
+            query.get("nonce")))
+
+    def encrypt_message(self, xml, nonce, timestamp=None):
+        '''加密回复消息并生成回复给微信服务器的xml
+
+        :param xml: 回复消息明文的xml
+        :param nonce: 随机数，一般使用请求url中的nonce参数
+        :param timestamp: 时间戳，默认为当前时间
+        :rtype: bytes
+        '''
+        if timestamp is None:
+            timestamp = str(int(time.time()))
+        encrypt = self.encrypt(xml)
+        signature = self.signature(timestamp, nonce, encrypt)
+        return b"".join([
+            b"<xml><Encrypt><![CDATA[", encrypt,
+            b"]]></Encrypt><MsgSignature><![CDATA[",
+            signature.encode("ascii"),
+            b"]]></MsgSignature><TimeStamp>", _to_bytes(timestamp),
+            b"</TimeStamp><Nonce><![CDATA[", _to_bytes(nonce),
+            b"]]></Nonce></xml>"])
@@ -0,0 +1,66 @@
+# -*- coding:utf-8 -*-
+
+from __future__ import unicode_literals
+
+__all__ = ["Dispatcher"]
+
+
+class Dispatcher(object):
+    '''长期存在的消息分发器，只在创建时配置一次公众号、消息处理类和数据库
+    session等参数，之后每条消息只创建一个消息处理类的实例保存消息状态，
+    不再经过 ``__init__`` 的参数处理。消息分发表在消息处理类创建时编译，
+    所有消息共用；声明了 ``__slots__`` 的实例就是每条消息的上下文，
+    ``on_`` 等方法通过 ``self`` 访问本条消息，因此不能在消息之间共用实例
+
+    .. code-block:: python
+
+        dispatcher = Dispatcher(
+            Handler, client, db_session_maker=Session)
+
+        @app.route('/wechat', methods=["POST"])
+        def wechat():
+            return dispatcher(request.data)
+
+    消息处理类的 ``on_`` , ``event_`` , ``reply_`` 等方法与直接使用
+    :class:`~yawxt.MessageHandler` 时完全相同，但不会调用 ``__init__`` ，
+    每条消息的初始化请放在 :meth:`~yawxt.MessageHandler.before` 中。
+
+    :param handler_cls: :class:`~yawxt.MessageHandler` 或其子类
+    :param client: 微信公众号账号, :class:`~yawxt.WxClient` 对象
+    :param debug_to_wechat: 使用 reply_debug_text 可以将调试信息发送到用户微信
+    :param options: 消息处理类的其他参数，如
+        :class:`~yawxt.persistence.PersistMessageHandler` 的
+        ``db_session_maker`` , ``user_refresh_days`` ，或安全模式的
+        ``crypto``
+    '''
+
+    def __init__(self, handler_cls, client=None, debug_to_wechat=False,
+                 **options):
+        self.handler_cls = handler_cls
+        self.client = client
+        self.debug_to_wechat = debug_to_wechat
+        self.options = options
+
+    def handle(self, content, query=None):
+        '''处理一条消息
+
+        :param content: 从微信服务器接收的xml格式的消息
+        :param query: 请求url的query_string参数字典，安全模式下用于检查签名
+        :returns: 处理完成的消息处理类实例，可以调用其
+            :meth:`~yawxt.MessageHandler.reply` 得到回复内容
+        '''
+        handler_cls = self.handler_cls
+        handler = handler_cls.__new__(handler_cls)
+        handler._setup(self.client, self.debug_to_wechat, **self.options)
+        handler._process(content, query)
+        return handler
+
+    def __call__(self, content, query=None):
+        '''处理一条消息并返回回复内容
+
+        :param content: 从微信服务器接收的xml格式的消息
+        :param query: 请求url的query_string参数字典，安全模式下用于检查签名
+        :returns: 回复给微信服务器的UTF-8编码的xml内容
+        :rtype: bytes
+        '''
+        return self.handle(content, query).reply()
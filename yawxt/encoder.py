@@ -0,0 +1,228 @@
+# -*- coding:utf-8 -*-
+
+'''回复消息的xml编码
+
+回复消息直接由预先编码好的UTF-8字节片段拼接而成，每种回复类型的消息体
+由 ``render_*`` 函数生成为 :class:`RenderedReply` 对象，消息头部由
+:func:`encode_message` 在回复时拼接。CDATA中的 ``]]>`` 会被拆分为
+``]]]]><![CDATA[>`` 。
+
+不变的回复内容（如固定的欢迎图文）可以预先渲染一次，之后每次回复只需要
+拼接头部，例如：
+
+.. code-block:: python
+
+    from yawxt.encoder import render_news
+
+    class Handler(MessageHandler):
+
+        welcome = render_news([{
+            "title": "欢迎关注", "description": "...",
+            "picurl": "http://...", "url": "http://..."}])
+
+        def event_subscribe(self):
+            self.reply_rendered(self.welcome)
+'''
+
+from __future__ import unicode_literals
+
+__all__ = [
+    "RenderedReply", "cdata", "encode_message", "render_text",
+    "render_image", "render_voice", "render_video", "render_music",
+    "render_news"]
+
+try:
+    text_type = unicode  # noqa: F821
+except NameError:
+    text_type = str
+
+
+def cdata(value):
+    '''把值编码为可以放入CDATA的UTF-8字节串
+
+    :param value: 文本、字节串或数字
+    :rtype: bytes
+    '''
+    if not isinstance(value, bytes):
+        value = text_type(value).encode("utf8")
+    if b"]]>" in value:
+        value = value.replace(b"]]>", b"]]]]><![CDATA[>")
+    return value
+
+
+class RenderedReply(object):
+    '''预先渲染的回复消息体
+
+    :ivar msg_type: 回复消息的类型，如 ``text`` , ``news``
+    :ivar body: 消息体的UTF-8字节串，不包括消息头部
+    '''
+
+    __slots__ = ("msg_type", "body", "_content")
+
+    def __init__(self, msg_type, body):
+        self.msg_type = msg_type
+        self.body = body
+        self._content = None
+
+    @property
+    def content(self):
+        '''消息体的文本，作为回复 :class:`~yawxt.Message` 的 ``content``'''
+        if self._content is None:
+            self._content = self.body.decode("utf8")
+        return self._content
+
+    def __repr__(self):
+        return "RenderedReply(%r, %r)" % (self.msg_type, self.body)
+
+
+_HEAD_TO = b"<xml><ToUserName><![CDATA["
+_HEAD_FROM = b"]]></ToUserName><FromUserName><![CDATA["
+_HEAD_TIME = b"]]></FromUserName><CreateTime>"
+_HEAD_MSG_ID = b"<MsgId>"
+_TAIL_MSG_ID = b"</MsgId>"
+_TAIL = b"</xml>"
+
+_msg_type_fragments = {}
+
+
+def _msg_type_fragment(msg_type):
+    fragment = _msg_type_fragments.get(msg_type)
+    if fragment is None:
+        if msg_type.startswith("event_"):
+            fragment = (
+                b"</CreateTime><MsgType><![CDATA[event]]></MsgType>"
+                b"<Event><![CDATA[" + cdata(msg_type[6:]) + b"]]></Event>")
+        else:
+            fragment = (
+                b"</CreateTime><MsgType><![CDATA[" + cdata(msg_type) +
+                b"]]></MsgType>")
+        _msg_type_fragments[msg_type] = fragment
+    return fragment
+
+
+def encode_message(to_id, from_id, create_time, msg_type, body,
+                   msg_id=None):
+    '''拼接消息头部和消息体，生成完整的xml消息
+
+    :param to_id: 接收方
+    :param from_id: 发送方
+    :param create_time: 消息创建时间
+    :param msg_type: 消息类型，事件消息为event_加事件类型
+    :param body: 消息体的UTF-8字节串
+    :param msg_id: 消息id，为 ``None`` 时不输出
+    :rtype: bytes
+    '''
+    parts = [
+        _HEAD_TO, cdata(to_id), _HEAD_FROM, cdata(from_id), _HEAD_TIME,
+        text_type(create_time).encode("ascii"), _msg_type_fragment(msg_type),
+    ]
+    if msg_id is not None:
+        parts.append(_HEAD_MSG_ID)
+        parts.append(text_type(msg_id).encode("ascii"))
+        parts.append(_TAIL_MSG_ID)
+    parts.append(body)
+    parts.append(_TAIL)
+    return b"".join(parts)
+
+
+def render_text(text):
+    '''渲染文本消息
+
+    :param text: 回复的文本字符串
+    :rtype: RenderedReply
+    '''
+    return RenderedReply("text", b"".join([
+        b"<Content><![CDATA[", cdata(text), b"]]></Content>"]))
+
+
+def render_image(image_id):
+    '''渲染图片消息
+
+    :param image_id: 图片的media_id
+    :rtype: RenderedReply
+    '''
+    return RenderedReply("image", b"".join([
+        b"<Image><MediaId><![CDATA[", cdata(image_id),
+        b"]]></MediaId></Image>"]))
+
+
+def render_voice(voice_id):
+    '''渲染语音消息
+
+    :param voice_id: 语音的media_id
+    :rtype: RenderedReply
+    '''
+    return RenderedReply("voice", b"".join([
+        b"<Voice><MediaId><![CDATA[", cdata(voice_id),
+        b"]]></MediaId></Voice>"]))
+
+
+def render_video(video_id, title=None, desc=None):
+    '''渲染视频消息
+
+    :param video_id: 视频的media_id
+    :param title: 视频的标题，可不填
+    :param desc: 视频的描述，可不填
+    :rtype: RenderedReply
+    '''
+    parts = [b"<Video><MediaId><![CDATA[", cdata(video_id), b"]]></MediaId>"]
+    if title:
+        parts.extend([b"<Title><![CDATA[", cdata(title), b"]]></Title>"])
+    if desc:
+        parts.extend([
+            b"<Description><![CDATA[", cdata(desc), b"]]></Description>"])
+    parts.append(b"</Video>")
+    return RenderedReply("video", b"".join(parts))
+
+
+def render_music(music_id, title=None, description=None, url=None,
+                 hqurl=None):
+    '''渲染音乐消息
+
+    :param music_id: 音乐缩略图的media_id
+    :param title: 音乐的标题
+    :param description: 音乐的描述
+    :param url: 音乐的url地址
+    :param hqurl: 音乐的高清url地址
+    :rtype: RenderedReply
+    '''
+    parts = [b"<Music>"]
+    if title:
+        parts.extend([b"<Title><![CDATA[", cdata(title), b"]]></Title>"])
+    if description:
+        parts.extend([
+            b"<Description><![CDATA[", cdata(description),
+            b"]]></Description>"])
+    if url:
+        parts.extend([b"<MusicUrl><![CDATA[", cdata(url), b"]]></MusicUrl>"])
+    if hqurl:
+        parts.extend([
+            b"<HQMusicUrl><![CDATA[", cdata(hqurl), b"]]></HQMusicUrl>"])
+    parts.extend([
+        b"<ThumbMediaId><![CDATA[", cdata(music_id),
+        b"]]></ThumbMediaId></Music>"])
+    return RenderedReply("music", b"".join(parts))
+
+
+def render_news(articles):
+    '''渲染图文消息
+
+    :param articles: 类型为 ``list`` , 每一个图文为一个 ``dict`` ，必须包含
+        ``title`` , ``description`` , ``picurl`` , ``url`` 四个字段。
+        消息最多包含8条，多余的会自动过滤。
+    :rtype: RenderedReply
+    '''
+    articles = articles[:8]
+    parts = [
+        b"<ArticleCount>", text_type(len(articles)).encode("ascii"),
+        b"</ArticleCount><Articles>"]
+    for article in articles:
+        parts.extend([
+            b"<item><Title><![CDATA[", cdata(article["title"]),
+            b"]]></Title><Description><![CDATA[",
+            cdata(article["description"]),
+            b"]]></Description><PicUrl><![CDATA[", cdata(article["picurl"]),
+            b"]]></PicUrl><Url><![CDATA[", cdata(article["url"]),
+            b"]]></Url></item>"])
+    parts.append(b"</Articles>")
+    return RenderedReply("news", b"".join(parts))
@@ -0,0 +1,284 @@
+# -*- coding:utf-8 -*-
+
+'''消息事件日志
+
+:class:`EventLogWriter` 把每条接收和回复的 :class:`~yawxt.Message` 追加写入
+分段的日志文件，多条消息合并为一次写入和 ``fsync`` （group commit），
+不需要每条消息一个数据库事务；:class:`EventLogReader` 按时间顺序读回
+:class:`~yawxt.Message` 对象，用于统计分析、重新处理或使用
+:func:`yawxt.persistence.load_event_log` 批量导入 ``wechat_message`` 表：
+
+.. code-block:: python
+
+    event_log = EventLogWriter("/var/log/wechat", compress=True)
+    dispatcher = Dispatcher(Handler, client, event_log=event_log)
+
+    for direction, message in EventLogReader("/var/log/wechat").records():
+        ...
+
+日志文件为每行一个json数组的文本，启用压缩时为gzip格式。
+'''
+
+from __future__ import unicode_literals
+import os
+import re
+import errno
+import gzip
+import json
+import zlib
+import logging
+import threading
+
+from .models import Message, INBOUND, REPLY
+
+__all__ = ["EventLogWriter", "EventLogReader", "INBOUND", "REPLY"]
+
+logger = logging.getLogger(__name__)
+
+_SEGMENT_RE = re.compile(r"^(\d{8})\.jsonl(\.gz)?$")
+
+
+def _segment_files(directory):
+    segments = []
+    for name in os.listdir(directory):
+        m = _SEGMENT_RE.match(name)
+        if m:
+            segments.append((int(m.group(1)), os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+class EventLogWriter(object):
+    '''消息事件日志写入，可以在多个线程中同时使用
+
+    :param directory: 日志目录，不存在时自动创建
+    :param segment_size: 每个日志文件写入的最大字节数（压缩前），
+        超过后写入新的文件，默认为64MB
+    :param compress: 是否使用gzip压缩
+    :param flush_interval: 后台线程写入文件的间隔秒数，为 ``None`` 时不启动
+        后台线程，每次 :meth:`append` 后调用 :meth:`flush` 写入
+    :param fsync: 每次写入后是否调用 ``os.fsync``
+
+    写入失败时消息保留在缓存中，下一次写入时重试，等待写入的
+    :meth:`append` 抛出写入的异常。多个进程可以使用同一个目录，
+    每个日志文件只由一个进程创建和写入。
+    '''
+
+    def __init__(self, directory, segment_size=64 << 20, compress=False,
+                 flush_interval=0.05, fsync=True):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        segments = _segment_files(directory)
+        # 每次打开都写入新的文件，不追加到可能不完整的旧文件
+        self._index = segments[-1][0] if segments else 0
+        self._raw = None
+        self._file = None
+        self._written = 0
+
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._buffer = []
+        self._appended = 0
+        self._flushed = 0
+        self._error = None
+        self._failures = 0
+        self._closed = False
+        self._thread = None
+        if flush_interval is not None:
+            self._thread = threading.Thread(
+                target=self._run, name="yawxt-event-log")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def append(self, message, direction=None, wait=False):
+        '''追加一条消息
+
+        :param message: :class:`~yawxt.Message` 对象
+        :param direction: 接收的消息为 :data:`~yawxt.models.INBOUND` ，
+            回复的消息为 :data:`~yawxt.models.REPLY` ，默认使用消息的
+            :attr:`~yawxt.Message.direction` ，未设置时为接收的消息
+        :param wait: 是否等待写入文件后返回，写入失败时抛出异常
+        '''
+        line = json.dumps([
+            direction or message.direction or INBOUND, message.to_id,
+            message.from_id, message.msg_type, message.create_time,
+            message.msg_id, message.content,
+        ], ensure_ascii=False, separators=(",", ":"))
+        with self._cond:
+            if self._closed:
+                raise ValueError("event log is closed")
+            self._buffer.append(line.encode("utf8") + b"\n")
+            self._appended += 1
+            seq = self._appended
+            failures = self._failures
+        if self._thread is None:
+            self.flush()
+        elif wait:
+            with self._cond:
+                while self._flushed < seq:
+                    if self._failures != failures:
+                        # 追加后有写入失败，消息仍在缓存中等待重试
+                        raise self._error
+                    self._cond.wait()
+
+    def flush(self):
+        '''将缓存的消息写入文件'''
+        with self._io_lock:
+            with self._cond:
+                lines, self._buffer = self._buffer, []
+                seq = self._appended
+            if lines:
+                try:
+                    self._write(b"".join(lines))
+                except Exception as e:
+                    # 放回缓存重试，可能已写入一部分，重试时写入新的文件
+                    self._abort_segment()
+                    with self._cond:
+                        self._buffer[:0] = lines
+                        self._error = e
+                        self._failures += 1
+                        self._cond.notify_all()
+                    raise
+            with self._cond:
+                self._flushed = seq
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                self._cond.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("write event log failed")
+
+    def _create_segment(self):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(
+            os, "O_BINARY", 0)
+        while True:
+            self._index += 1
+            name = "%08d.jsonl" % self._index
+            if os.path.exists(os.path.join(self.directory, name + (
+                    "" if self.compress else ".gz"))):
+                continue
+            path = os.path.join(
+                self.directory, name + (".gz" if self.compress else ""))
+            try:
+                # O_EXCL保证其它进程不会写入同一个文件
+                return os.fdopen(os.open(path, flags, 0o644), "wb")
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _roll(self):
+        self._close_segment()
+        self._raw = self._create_segment()
+        self._file = self._raw
+        if self.compress:
+            self._file = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        self._written = 0
+
+    def _write(self, data):
+        if self._file is None or self._written >= self.segment_size:
+            self._roll()
+        self._file.write(data)
+        self._written += len(data)
+        if self.compress:
+            self._file.flush(zlib.Z_SYNC_FLUSH)
+        self._raw.flush()
+        if self.fsync:
+            os.fsync(self._raw.fileno())
+
+    def _close_segment(self):
+        if self._file is not None:
+            if self._file is not self._raw:
+                self._file.close()
+            self._raw.close()
+            self._file = self._raw = None
+
+    def _abort_segment(self):
+        try:
+            self._close_segment()
+        except Exception:
+            logger.exception("close event log segment failed")
+        self._file = self._raw = None
+
+    def close(self):
+        '''写入所有缓存的消息并关闭文件'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        finally:
+            with self._io_lock:
+                self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EventLogReader(object):
+    '''按写入顺序读取消息事件日志
+
+    :param directory: 日志目录
+    :param direction: 只读取 :data:`~yawxt.models.INBOUND` 或
+        :data:`~yawxt.models.REPLY` 的消息，默认为 ``None`` ，读取全部
+    '''
+
+    def __init__(self, directory, direction=None):
+        self.directory = directory
+        self.direction = direction
+
+    def segments(self):
+        '''日志文件路径列表，按写入顺序排列'''
+        return [path for _, path in _segment_files(self.directory)]
+
+    def _lines(self, path):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as fp:
+            try:
+                for line in fp:
+                    yield line
+            except (EOFError, IOError, zlib.error):
+                # 进程退出时未写完的压缩文件
+                logger.warning("event log %s is truncated", path)
+
+    def records(self):
+        '''读取日志，每条消息为 ``(direction, message)``
+
+        :rtype: iterator of ``(str, Message)``
+        '''
+        loads = json.loads
+        only = self.direction
+        for path in self.segments():
+            for line in self._lines(path):
+                try:
+                    (direction, to_id, from_id, msg_type, create_time,
+                     msg_id, content) = loads(line.decode("utf8"))
+                except ValueError:
+                    logger.warning("skip broken record in %s", path)
+                    continue
+                if only is not None and direction != only:
+                    continue
+                yield direction, Message(
+                    to_id, from_id, msg_type, content, msg_id, create_time,
+                    direction)
+
+    def __iter__(self):
+        '''读取日志中的 :class:`~yawxt.Message` 对象'''
+        for _, message in self.records():
+            yield message
@@ -2,7 +2,9 @@
 
 from __future__ import unicode_literals
 
-__all__ = ["APIError", "SemanticAPIError", "default_exceptions"]
+__all__ = [
+    "APIError", "SemanticAPIError", "MessageCryptoError", "SpoolFullError",
+    "default_exceptions"]
 
 
 class APIError(Exception):
@@ -60,6 +62,20 @@ class SemanticAPIError(APIError):
     errmsg = "semantic api error"
 
 
+class MessageCryptoError(Exception):
+    '''安全模式下加密消息签名错误或无法解密时抛出
+
+    .. seealso:: :class:`yawxt.crypto.MessageCrypto`
+    '''
+
+
+class SpoolFullError(Exception):
+    '''消息暂存队列中待处理的消息数达到上限时抛出
+
+    .. seealso:: :class:`yawxt.spool.Spool`
+    '''
+
+
 default_exceptions = {}
 
 
@@ -0,0 +1,233 @@
+# -*- coding:utf-8 -*-
+
+'''数据表的流式导出
+
+:func:`export_table` 按主键分段（keyset pagination）读取数据表，每段一条
+``WHERE id > ? ORDER BY id LIMIT ?`` 查询，不使用ORM对象，内存占用只与每段的
+行数有关，结果写入CSV、JSON lines或Parquet（需要安装 ``pyarrow`` ）文件。
+按 ``create_time`` 的增量导出：
+
+.. code-block:: python
+
+    from yawxt.export import export_table
+    from yawxt.persistence import message_table
+
+    result = export_table(
+        engine, message_table, "messages-0001.jsonl.gz", since=watermark)
+    watermark = result.watermark  # 下一次导出的since
+
+默认只导出 ``lag`` 秒之前的数据，避免漏掉延迟写入（如
+:class:`~yawxt.persistence.WriteBehindBuffer` ）的行。增量导出先用
+``create_time`` （或 ``update_time`` ）的索引查询一次时间范围内的id范围，
+之后只按主键在这个范围内分段读取，不会扫描整个表。
+'''
+
+from __future__ import unicode_literals
+import io
+import csv
+import gzip
+import json
+import time
+import logging
+from collections import namedtuple
+
+from sqlalchemy import select, func
+
+__all__ = ["ExportResult", "iter_rows", "export_table"]
+
+logger = logging.getLogger(__name__)
+
+ExportResult = namedtuple("ExportResult", ["rows", "watermark"])
+'''导出结果， ``rows`` 为导出的行数， ``watermark`` 为导出范围的结束时间，
+作为下一次增量导出的 ``since``'''
+
+
+def _watermark_column(table):
+    for name in ("create_time", "update_time"):
+        if name in table.c:
+            return table.c[name]
+    return None
+
+
+def iter_rows(bind, table, since=None, until=None, columns=None,
+              batch_size=10000):
+    '''按主键顺序分段读取数据表
+
+    :param bind: sqlalchemy ``Engine`` 或 ``Connection`` 对象
+    :param table: sqlalchemy ``Table`` 对象，需要整数主键 ``id``
+    :param since: 开始时间戳，包含此时间；按 ``create_time`` 过滤，没有此列
+        时按 ``update_time`` （如 ``wechat_user`` ）
+    :param until: 结束时间戳，不包含此时间
+    :param columns: 导出的列名列表，默认为全部列
+    :param batch_size: 每段读取的行数
+    :returns: 每段为一个元组列表的迭代器
+    '''
+    c = table.c
+    selected = [c[name] for name in columns] if columns else list(c)
+    if c.id not in selected:
+        # 分段需要id，不在导出的列中时放在最后，写入时去掉
+        selected.append(c.id)
+    id_index = selected.index(c.id)
+    cond = None
+    watermark = _watermark_column(table)
+    if since is not None or until is not None:
+        if watermark is None:
+            raise ValueError(
+                "%s has no create_time or update_time" % table.name)
+        if since is not None:
+            cond = watermark >= since
+        if until is not None:
+            upper = watermark < until
+            cond = upper if cond is None else cond & upper
+    last_id = None
+    if cond is not None:
+        # 使用时间列的索引确定一次id范围，之后按主键分段
+        low, high = bind.execute(
+            select([func.min(c.id), func.max(c.id)]).where(cond)).first()
+        if low is None:
+            return
+        cond = cond & (c.id <= high)
+        last_id = low - 1
+    stream = bind.execution_options(stream_results=True)
+    while True:
+        query = select(selected)
+        page = cond
+        if last_id is not None:
+            page = c.id > last_id if page is None else page & (
+                c.id > last_id)
+        if page is not None:
+            query = query.where(page)
+        rows = stream.execute(
+            query.order_by(c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][id_index]
+        yield [tuple(row) for row in rows]
+
+
+def _open_text(path):
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(
+            gzip.open(path, "wb"), encoding="utf8", newline="")
+    return io.open(path, "w", encoding="utf8", newline="")
+
+
+class _JSONLinesWriter(object):
+
+    def __init__(self, path, names):
+        self.names = names
+        self.fp = _open_text(path)
+
+    def write(self, rows):
+        names = self.names
+        self.fp.write("".join(
+            json.dumps(
+                dict(zip(names, row)), ensure_ascii=False,
+                separators=(",", ":")) + "\n"
+            for row in rows))
+
+    def close(self):
+        self.fp.close()
+
+
+class _CSVWriter(object):
+
+    def __init__(self, path, names):
+        self.fp = _open_text(path)
+        self.writer = csv.writer(self.fp)
+        self.writer.writerow(names)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.fp.close()
+
+
+class _ParquetWriter(object):
+
+    def __init__(self, path, names, table):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logging.error(
+                "please install pyarrow if you want to export parquet files")
+            raise
+        self.pa = pyarrow
+        self.names = names
+        types = []
+        for name in names:
+            python_type = table.c[name].type.python_type
+            types.append(
+                pyarrow.int64() if python_type is int else
+                pyarrow.float64() if python_type is float else
+                pyarrow.string())
+        self.schema = pyarrow.schema(list(zip(names, types)))
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(self.pa.Table.from_arrays(
+            [self.pa.array(column, type=field.type)
+             for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def _format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    for ext, fmt in ((".csv", "csv"), (".jsonl", "jsonl"),
+                     (".json", "jsonl"), (".parquet", "parquet")):
+        if name.endswith(ext):
+            return fmt
+    raise ValueError("can not infer export format from %s" % path)
+
+
+def export_table(bind, table, path, format=None, since=None, until=None,
+                 lag=60, columns=None, batch_size=10000):
+    '''把数据表流式导出到文件
+
+    :param bind: sqlalchemy ``Engine`` 或 ``Connection`` 对象
+    :param table: sqlalchemy ``Table`` 对象，如
+        :data:`~yawxt.persistence.message_table` ，或按月分表的月表
+    :param path: 导出的文件路径，以 ``.gz`` 结尾时CSV和JSON lines使用gzip
+        压缩
+    :param format: ``"csv"`` , ``"jsonl"`` 或 ``"parquet"`` ，默认从文件
+        扩展名判断
+    :param since: 增量导出的开始时间戳，一般为上一次导出结果的
+        ``watermark``
+    :param until: 结束时间戳，不包含此时间，默认为当前时间减去 ``lag``
+    :param lag: 默认结束时间比当前时间早的秒数
+    :param columns: 导出的列名列表，默认为全部列
+    :param batch_size: 每段读取和写入的行数
+    :rtype: :class:`ExportResult`
+    '''
+    if format is None:
+        format = _format(path)
+    if until is None and _watermark_column(table) is not None:
+        until = int(time.time()) - lag
+    names = list(columns) if columns else [c.name for c in table.c]
+    if format == "csv":
+        writer = _CSVWriter(path, names)
+    elif format == "jsonl":
+        writer = _JSONLinesWriter(path, names)
+    elif format == "parquet":
+        writer = _ParquetWriter(path, names, table)
+    else:
+        raise ValueError("unsupported export format: %s" % format)
+    width = len(names)
+    count = 0
+    try:
+        for rows in iter_rows(
+                bind, table, since, until, names, batch_size):
+            if len(rows[0]) != width:
+                rows = [row[:width] for row in rows]
+            writer.write(rows)
+            count += len(rows)
+    finally:
+        writer.close()
+    logger.info("export %d rows of %s to %s", count, table.name, path)
+    return ExportResult(count, until)
@@ -0,0 +1,157 @@
+# -*- coding:utf-8 -*-
+
+'''地理位置计算
+
+``wechat_location`` 表的 ``geohash`` 列保存每个位置的geohash，按geohash
+前缀建立索引后，附近用户的查询先用覆盖查询范围的几个geohash前缀缩小范围，
+再计算精确距离，见 :func:`yawxt.persistence.users_near` 。
+'''
+
+from __future__ import unicode_literals
+import math
+
+__all__ = [
+    "EARTH_RADIUS", "GEOHASH_PRECISION", "haversine", "encode_geohash",
+    "decode_geohash", "bounding_box", "geohash_cover"]
+
+EARTH_RADIUS = 6371008.8
+'''地球平均半径，单位为米'''
+
+GEOHASH_PRECISION = 9
+'''保存到数据库的geohash长度，精度约为5米'''
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_DECODE = dict((c, i) for i, c in enumerate(_BASE32))
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''两个经纬度坐标之间的球面距离
+
+    :param lat1: 第一个点的纬度
+    :param lon1: 第一个点的经度
+    :param lat2: 第二个点的纬度
+    :param lon2: 第二个点的经度
+    :returns: 距离，单位为米
+    :rtype: float
+    '''
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = (math.sin(dphi / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell_size(precision):
+    bits = precision * 5
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    '''计算经纬度坐标的geohash
+
+    :param latitude: 纬度
+    :param longitude: 经度
+    :param precision: geohash的长度
+    :rtype: str
+    '''
+    lat_low, lat_high = -90.0, 90.0
+    lon_low, lon_high = -180.0, 180.0
+    chars = []
+    value = 0
+    even = True
+    for bit in range(precision * 5):
+        if even:
+            mid = (lon_low + lon_high) / 2
+            if longitude >= mid:
+                value = value * 2 + 1
+                lon_low = mid
+            else:
+                value *= 2
+                lon_high = mid
+        else:
+            mid = (lat_low + lat_high) / 2
+            if latitude >= mid:
+                value = value * 2 + 1
+                lat_low = mid
+            else:
+                value *= 2
+                lat_high = mid
+        even = not even
+        if bit % 5 == 4:
+            chars.append(_BASE32[value])
+            value = 0
+    return "".join(chars)
+
+
+def decode_geohash(geohash):
+    '''geohash对应的范围
+
+    :returns: ``(min_lat, min_lon, max_lat, max_lon)``
+    '''
+    lat_low, lat_high = -90.0, 90.0
+    lon_low, lon_high = -180.0, 180.0
+    even = True
+    for c in geohash:
+        value = _DECODE[c]
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            if even:
+                mid = (lon_low + lon_high) / 2
+                if bit:
+                    lon_low = mid
+                else:
+                    lon_high = mid
+            else:
+                mid = (lat_low + lat_high) / 2
+                if bit:
+                    lat_low = mid
+                else:
+                    lat_high = mid
+            even = not even
+    return lat_low, lon_low, lat_high, lon_high
+
+
+def bounding_box(latitude, longitude, radius):
+    '''包含以某点为中心的圆的经纬度范围
+
+    :param radius: 半径，单位为米
+    :returns: ``(min_lat, min_lon, max_lat, max_lon)``
+    '''
+    angle = radius / EARTH_RADIUS
+    dlat = math.degrees(angle)
+    cos_lat = math.cos(math.radians(latitude))
+    if latitude + dlat >= 90 or latitude - dlat <= -90 or (
+            math.sin(angle) >= cos_lat):
+        # 包含极点
+        dlon = 180.0
+    else:
+        dlon = math.degrees(math.asin(math.sin(angle) / cos_lat))
+    return (
+        max(latitude - dlat, -90.0), max(longitude - dlon, -180.0),
+        min(latitude + dlat, 90.0), min(longitude + dlon, 180.0))
+
+
+def geohash_cover(min_lat, min_lon, max_lat, max_lon, max_cells=16):
+    '''覆盖经纬度范围的geohash前缀列表，使用不超过 ``max_cells`` 个前缀的
+    最大精度，不支持跨越180度经线的范围
+
+    :rtype: list of str
+    '''
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = _cell_size(precision)
+        rows = range(
+            int((min_lat + 90) // height),
+            int((min(max_lat, 90 - 1e-9) + 90) // height) + 1)
+        cols = range(
+            int((min_lon + 180) // width),
+            int((min(max_lon, 180 - 1e-9) + 180) // width) + 1)
+        if len(rows) * len(cols) <= max_cells or precision == 1:
+            return sorted(
+                encode_geohash(
+                    (i + 0.5) * height - 90, (j + 0.5) * width - 180,
+                    precision)
+                for i in rows for j in cols)
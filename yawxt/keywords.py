@@ -0,0 +1,402 @@
+# -*- coding:utf-8 -*-
+
+'''关键词自动回复
+
+:class:`KeywordEngine` 把大量关键词规则编译为一个Aho-Corasick自动机
+（精确前缀和包含匹配）和一个字典（完全匹配），正则规则先用其必须包含的字面量
+组成的自动机筛选，每条文本消息只需扫描一遍，多条规则同时匹配时按优先级选择。
+
+.. code-block:: python
+
+    from yawxt.keywords import KeywordEngine, KeywordRule
+
+    engine = KeywordEngine([
+        KeywordRule("营业时间", "每天9:00-21:00"),
+        KeywordRule("优惠", "本周全场八折", match="contains", priority=10),
+        KeywordRule(r"^\\d{11}$", bind_phone, match="regex"),
+    ])
+
+    class Handler(MessageHandler):
+        keywords = engine
+
+规则可以使用 :meth:`KeywordEngine.load` 、 :meth:`KeywordEngine.load_file`
+或 :func:`yawxt.persistence.load_keyword_rules` 热更新，编译完成后整体替换，
+正在处理的消息不受影响，也不需要重新创建消息处理类。
+'''
+
+from __future__ import unicode_literals
+import io
+import os
+import re
+import json
+import time
+import logging
+from collections import deque
+
+from .encoder import (
+    RenderedReply, render_text, render_image, render_voice, render_video,
+    render_music, render_news)
+
+__all__ = ["KeywordRule", "KeywordEngine", "rule_from_dict"]
+
+logger = logging.getLogger(__name__)
+
+MATCH_TYPES = ("exact", "prefix", "contains", "regex")
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+try:
+    _unichr = unichr  # noqa: F821
+except NameError:
+    _unichr = chr
+
+
+def _required_literal(pattern, flags):
+    # 正则表达式匹配时必须出现的最长字面量，不能确定时为None
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except (re.error, TypeError):
+        return None
+    if parsed.state.flags & (
+            sre_constants.SRE_FLAG_IGNORECASE | sre_constants.SRE_FLAG_LOCALE):
+        return None
+    best = run = ""
+    for op, av in parsed.data:
+        if op is sre_constants.LITERAL:
+            run += _unichr(av)
+            if len(run) > len(best):
+                best = run
+        elif op is not sre_constants.AT:
+            run = ""
+    return best or None
+
+
+class KeywordRule(object):
+    '''一条关键词回复规则
+
+    :param keyword: 关键词，正则匹配时为正则表达式
+    :param reply: 回复内容，可以是文本字符串、
+        :class:`~yawxt.encoder.RenderedReply` 对象或可调用对象，可调用对象
+        以 ``reply(handler, text)`` 的形式调用
+    :param match: 匹配方式， ``exact`` 完全匹配， ``prefix`` 前缀匹配，
+        ``contains`` 包含匹配， ``regex`` 正则匹配（ ``re.search`` ），
+        默认为 ``exact``
+    :param priority: 优先级，多条规则同时匹配时选择优先级最大的，
+        优先级相同时选择先加入的规则
+    '''
+
+    __slots__ = ("keyword", "reply", "match", "priority")
+
+    def __init__(self, keyword, reply, match="exact", priority=0):
+        if match not in MATCH_TYPES:
+            raise ValueError("unknown match type: %s" % match)
+        if not keyword:
+            raise ValueError("keyword must not be empty")
+        if not isinstance(reply, RenderedReply) and not callable(reply):
+            reply = render_text(reply)
+        self.keyword = keyword
+        self.reply = reply
+        self.match = match
+        self.priority = priority
+
+    def __repr__(self):
+        return "KeywordRule(%r, match=%r, priority=%r)" % (
+            self.keyword, self.match, self.priority)
+
+
+_renderers = {
+    "text": lambda value: render_text(value),
+    "image": lambda value: render_image(value),
+    "voice": lambda value: render_voice(value),
+    "video": lambda value: render_video(**value),
+    "music": lambda value: render_music(**value),
+    "news": lambda value: render_news(value),
+}
+
+
+def rule_from_dict(d):
+    '''从 ``dict`` 构造 :class:`KeywordRule` ，用于从文件或数据库加载规则
+
+    :param d: 包含 ``keyword`` , ``reply`` 字段，可选 ``match`` ,
+        ``priority`` , ``reply_type`` 字段。 ``reply_type`` 默认为 ``text`` ，
+        为 ``image`` , ``voice`` 时 ``reply`` 为media_id，为 ``news`` 时
+        ``reply`` 为图文列表，为 ``video`` , ``music`` 时 ``reply`` 为对应
+        ``render_*`` 方法的参数字典。 ``reply`` 为字符串而 ``reply_type``
+        不是文本类型时，按照json解析。
+    :rtype: KeywordRule
+    '''
+    reply_type = d.get("reply_type") or "text"
+    if reply_type not in _renderers:
+        raise ValueError("unknown reply type: %s" % reply_type)
+    reply = d["reply"]
+    if reply_type in ("video", "music", "news") and not isinstance(
+            reply, (list, dict)):
+        reply = json.loads(reply)
+    return KeywordRule(
+        d["keyword"], _renderers[reply_type](reply),
+        match=d.get("match") or "exact", priority=d.get("priority") or 0)
+
+
+class _Automaton(object):
+    '''Aho-Corasick自动机，关键词的输出为 ``(rank, length, prefix_only)`` ，
+    正则字面量的输出为字面量的序号'''
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+
+    def add(self, word, output):
+        state = 0
+        for ch in word:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            state = nxt
+        self.out[state] += (output,)
+
+    def build(self):
+        goto, fail, out = self.goto, self.fail, self.out
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                if fail[nxt] == nxt:
+                    fail[nxt] = 0
+                out[nxt] += out[fail[nxt]]
+
+    def found(self, text):
+        '''文本中出现的所有输出'''
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def best(self, text, best):
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for rank, length, prefix_only in out[state]:
+                if rank < best and (not prefix_only or length == i + 1):
+                    best = rank
+        return best
+
+
+_ASCII_FOLDS = {0x131: "i", 0x17f: "s"}
+
+
+class _CompiledRules(object):
+
+    def __init__(self, rules, ignore_case):
+        # 按优先级排序，排名越小越优先
+        self.rules = [
+            rule for _, _, rule in sorted(
+                (-rule.priority, order, rule)
+                for order, rule in enumerate(rules))]
+        self.ignore_case = ignore_case
+        self.exact = {}
+        self.automaton = None
+        regex_rules = []
+        for rank, rule in enumerate(self.rules):
+            keyword = rule.keyword
+            if rule.match == "regex":
+                regex_rules.append((rank, keyword))
+                continue
+            if ignore_case:
+                keyword = keyword.lower()
+            if rule.match == "exact":
+                self.exact.setdefault(keyword, rank)
+            else:
+                if self.automaton is None:
+                    self.automaton = _Automaton()
+                self.automaton.add(
+                    keyword, (rank, len(keyword), rule.match == "prefix"))
+        if self.automaton is not None:
+            self.automaton.build()
+        self.regexes = []
+        self.literals = None
+        self._compile_regexes(regex_rules)
+
+    def _compile_regexes(self, regex_rules):
+        # 每个正则单独编译，必需的字面量加入自动机，扫描一遍文本即可
+        # 排除字面量没有出现的正则
+        flags = re.I if self.ignore_case else 0
+        literals = {}
+        for rank, pattern in regex_rules:
+            # 忽略大小写时按小写的字面量筛选
+            literal = _required_literal(pattern, 0)
+            if literal is not None and self.ignore_case:
+                if any(ord(ch) > 127 for ch in literal):
+                    literal = None
+                else:
+                    literal = literal.lower()
+            if literal is not None:
+                literal = literals.setdefault(literal, len(literals))
+            self.regexes.append((re.compile(pattern, flags), rank, literal))
+        if literals:
+            self.literals = _Automaton()
+            for literal, index in literals.items():
+                self.literals.add(literal, index)
+            self.literals.build()
+
+    def match(self, text):
+        best = len(self.rules)
+        key = text.lower() if self.ignore_case else text
+        rank = self.exact.get(key)
+        if rank is not None:
+            best = rank
+        if self.automaton is not None:
+            best = self.automaton.best(key, best)
+        if self.regexes and self.regexes[0][1] < best:
+            found = ()
+            if self.literals is not None:
+                if self.ignore_case:
+                    # ı 和 ſ 忽略大小写时匹配 i 和 s ，小写后仍不相同
+                    key = key.translate(_ASCII_FOLDS)
+                found = self.literals.found(key)
+            for regex, rank, literal in self.regexes:
+                if rank >= best:
+                    break
+                if literal is not None and literal not in found:
+                    continue
+                if regex.search(text) is not None:
+                    best = rank
+                    break
+        if best < len(self.rules):
+            return self.rules[best]
+        return None
+
+
+class KeywordEngine(object):
+    '''关键词回复引擎，设置为 :attr:`MessageHandler.keywords` 后，
+    :meth:`MessageHandler.on_text` 自动使用此引擎回复
+
+    :param rules: :class:`KeywordRule` 列表
+    :param ignore_case: 是否忽略大小写，默认为 ``False``
+    :param check_interval: 使用 :meth:`load_file` 加载时，检查文件是否修改
+        的间隔秒数，为 ``None`` 时不自动检查
+    '''
+
+    def __init__(self, rules=(), ignore_case=False, check_interval=None):
+        self.ignore_case = ignore_case
+        self.check_interval = check_interval
+        self._compiled = _CompiledRules(rules, ignore_case)
+        self._path = None
+        self._mtime = None
+        self._checked_at = 0
+
+    def __len__(self):
+        return len(self._compiled.rules)
+
+    @property
+    def rules(self):
+        '''当前生效的规则列表，按优先级排列'''
+        return list(self._compiled.rules)
+
+    def load(self, rules):
+        '''编译并替换全部规则
+
+        :param rules: :class:`KeywordRule` 或 ``dict`` 列表，
+            ``dict`` 格式见 :func:`rule_from_dict`
+        '''
+        rules = [
+            rule if isinstance(rule, KeywordRule) else rule_from_dict(rule)
+            for rule in rules]
+        # 编译完成后再替换，替换是原子操作
+        self._compiled = _CompiledRules(rules, self.ignore_case)
+        logger.info("%d keyword rules loaded", len(rules))
+
+    def load_file(self, path):
+        '''从json文件加载规则，文件内容为 :func:`rule_from_dict` 格式的列表
+
+        :param path: 规则文件路径
+        '''
+        mtime = os.stat(path).st_mtime
+        with io.open(path, encoding="utf8") as fp:
+            rules = json.load(fp)
+        self.load(rules)
+        self._path = path
+        self._mtime = mtime
+        self._checked_at = time.time()
+
+    def reload_if_changed(self):
+        '''规则文件修改后重新加载
+
+        :returns: 是否重新加载了规则
+        '''
+        if self._path is None:
+            return False
+        self._checked_at = time.time()
+        try:
+            mtime = os.stat(self._path).st_mtime
+            if mtime == self._mtime:
+                return False
+            self.load_file(self._path)
+        except (OSError, IOError, ValueError, KeyError):
+            logger.exception(
+                "reload keyword rules from %s failed", self._path)
+            return False
+        return True
+
+    def match(self, text):
+        '''查找匹配文本的优先级最高的规则
+
+        :param text: 用户发送的文本
+        :rtype: KeywordRule
+        :returns: 匹配的规则，没有匹配时为 ``None``
+        '''
+        if (
+            self.check_interval is not None and
+            time.time() - self._checked_at > self.check_interval
+        ):
+            self.reload_if_changed()
+        if not text:
+            return None
+        return self._compiled.match(text)
+
+    def reply(self, handler, text):
+        '''使用匹配的规则回复消息
+
+        :param handler: :class:`~yawxt.MessageHandler` 对象
+        :param text: 用户发送的文本
+        :returns: 匹配的规则，没有匹配时为 ``None``
+        '''
+        rule = self.match(text)
+        if rule is not None:
+            self.apply(rule, handler, text)
+        return rule
+
+    def apply(self, rule, handler, text):
+        '''使用规则回复消息
+
+        :param rule: :meth:`match` 得到的规则
+        :param handler: :class:`~yawxt.MessageHandler` 对象
+        :param text: 用户发送的文本
+        :returns: 可调用对象回复的返回值，
+            :class:`~yawxt.asgi.AsyncMessageHandler` 中可以是协程
+        '''
+        if isinstance(rule.reply, RenderedReply):
+            return handler.reply_rendered(rule.reply)
+        return rule.reply(handler, text)
@@ -1,14 +1,18 @@
 # -*- coding:utf-8 -*-
 
 from __future__ import unicode_literals
+import re
 import time
 import hashlib
 import logging
+import itertools
 import xml.etree.ElementTree as ET
 
-__all__ = ["check_signature", "MessageHandler"]
+__all__ = ["check_signature", "route", "MessageHandler"]
 
-from .models import Location, Message
+from . import encoder
+from .models import Location, Message, INBOUND, REPLY
+from .parser import parse_xml
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +37,124 @@ def check_signature(token, timestamp, nonce, signature, time_error=600):
     return tmpStr == signature
 
 
-class MessageHandler(object):
+_route_counter = itertools.count()
+
+
+def _make_matcher(key, prefix, content, pattern):
+    checks = []
+    if prefix is not None:
+        checks.append(
+            lambda fields: (fields.get("Content") or "").startswith(prefix))
+    if content is not None:
+        checks.append(lambda fields: fields.get("Content") == content)
+    if pattern is not None:
+        regex = re.compile(pattern)
+        checks.append(
+            lambda fields: regex.search(fields.get("Content") or "")
+            is not None)
+    if key is not None and checks:
+        checks.insert(0, lambda fields: fields.get("EventKey") == key)
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+    return lambda fields: all(check(fields) for check in checks)
+
+
+def route(msg_type, key=None, prefix=None, content=None, pattern=None):
+    '''消息路由装饰器，把满足条件的消息交给被装饰的方法处理，
+    不满足条件时仍由默认的 ``on_`` 或 ``event_`` 方法处理
+
+    .. code-block:: python
+
+        class Handler(MessageHandler):
+
+            @route("event_CLICK", key="MENU_1")
+            def menu_1(self, click_key):
+                self.reply_text("menu 1")
+
+            @route("text", prefix="#")
+            def command(self, text):
+                self.reply_text("command: %s" % text[1:])
+
+    被装饰方法的参数与该消息类型默认处理方法的参数相同，没有默认处理方法
+    的消息类型则只传入 ``self`` ，不在内置类型中的消息或事件也可以使用
+    :func:`route` 注册处理方法。路由在类创建时编译为分发表，子类的路由
+    优先于父类，同一类中按定义顺序匹配， ``key`` 路由使用字典查找。
+    同一个方法可以使用多个 :func:`route` 装饰。
+
+    :param msg_type: 消息类型，与 :attr:`Message.msg_type` 相同，
+        如 ``text`` , ``event_CLICK``
+    :param key: 事件的EventKey等于此值时匹配
+    :param prefix: 文本消息以此前缀开头时匹配
+    :param content: 文本消息等于此值时匹配
+    :param pattern: 文本消息匹配此正则表达式时匹配（使用 ``re.search`` ）
+    '''
+    def decorator(func):
+        routes = func.__dict__.setdefault("_yawxt_routes", [])
+        routes.append((
+            next(_route_counter), msg_type, key,
+            _make_matcher(key, prefix, content, pattern)))
+        return func
+    return decorator
+
+
+# 微信的普通消息及事件类型，同名的 ``_`` 开头方法为默认处理方法，
+# 其他类型的消息使用 route 装饰器注册处理方法
+_MESSAGE_TYPES = (
+    "text", "image", "voice", "video", "shortvideo", "location", "link",
+    "subscribe", "unsubscribe", "SCAN", "LOCATION", "CLICK", "VIEW",
+    "TEMPLATESENDJOBFINISH", "MASSSENDJOBFINISH", "scancode_push",
+    "scancode_waitmsg", "pic_sysphoto", "pic_photo_or_album",
+    "pic_weixin", "location_select", "view_miniprogram")
+
+
+def _compile_dispatch_table(cls):
+    table = {}
+    for name in _MESSAGE_TYPES:
+        proc = getattr(cls, "_" + name, None)
+        if callable(proc):
+            # 与事件类型同名的处理方法，如 _CLICK 处理 event_CLICK
+            table[name] = table["event_" + name] = proc
+
+    routes = {}
+    mro = cls.__mro__
+    for name in dir(cls):
+        target = getattr(cls, name, None)
+        for seq, msg_type, key, matcher in getattr(
+                target, "_yawxt_routes", ()):
+            depth = next(
+                i for i, klass in enumerate(mro) if name in vars(klass))
+            routes.setdefault(msg_type, []).append(
+                ((depth, seq), key, matcher, target))
+
+    compiled = {}
+    for msg_type in set(table) | set(routes):
+        keyed = {}
+        matchers = []
+        for _, key, matcher, target in sorted(
+                routes.get(msg_type, ()), key=lambda r: r[0]):
+            if matcher is None and key is not None:
+                keyed.setdefault(key, target)
+            elif matcher is None:
+                matchers.append((lambda fields: True, target))
+            else:
+                matchers.append((matcher, target))
+        compiled[msg_type] = (
+            table.get(msg_type), keyed or None, tuple(matchers))
+    return compiled
+
+
+class _HandlerMeta(type):
+    '''创建 :class:`MessageHandler` 子类时编译消息分发表'''
+
+    def __init__(cls, name, bases, attrs):
+        super(_HandlerMeta, cls).__init__(name, bases, attrs)
+        cls._dispatch_table = _compile_dispatch_table(cls)
+
+
+class MessageHandler(_HandlerMeta(
+        str("_HandlerBase"), (object,), {"__slots__": ()})):
     '''微信消息处理基类，继承此类定义不同消息的处理函数
 
     #. 继承以 ``event_`` 开头的方法对event事件进行处理，这类消息一般不进行回复
@@ -45,45 +166,93 @@ class MessageHandler(object):
 
     #. 使用 :meth:`reply` 得到最终发送给微信服务器的文本字符串
 
+    #. 使用 :func:`route` 装饰器按EventKey或文本内容把消息路由到其他方法
+
     :param content: 从微信服务器接收的xml格式的消息字符串
     :param client: 微信公众号账号, :class:`WxClient` 对象，
         默认为 ``None`` ，不设置
     :param debug_to_wechat: 使用 reply_debug_text 可以将调试信息发送到用户微信
+    :param crypto: 安全模式的加解密对象 :class:`~yawxt.crypto.MessageCrypto` ，
+        设置后自动解密加密的消息，并加密回复的消息
+    :param query: 请求url的query_string参数字典，安全模式下用于检查签名，
+        需包含 ``msg_signature`` , ``timestamp`` , ``nonce``
+    :param event_log: :class:`~yawxt.eventlog.EventLogWriter` 对象，
+        设置后接收和回复的消息都写入事件日志
 
     :ivar openid: 发送消息用户的openid
     :ivar message: 接收到的消息对象，类型为 :class:`yawxt.Message`
+    :ivar fields: 消息除头部外的字段字典，如 ``{"Content": "hello"}``
+    :cvar keywords: 文本消息的关键词回复引擎，
+        :class:`~yawxt.keywords.KeywordEngine` 对象，默认为 ``None``
+
+    每条消息的状态都保存在 ``__slots__`` 中，子类同样声明 ``__slots__``
+    可以避免为每条消息创建实例字典。使用 :class:`~yawxt.Dispatcher`
+    处理消息时不会调用 ``__init__`` ，每条消息的初始化请放在 :meth:`before` 中。
     '''
 
+    __slots__ = (
+        "client", "_debug_to_wechat", "_user", "_reply", "_route",
+        "_processed", "_xml", "_crypto", "_crypto_query", "_event_log",
+        "fields",
+        "message", "reply_message", "openid")
+
+    keywords = None
+
     def __init__(self, content, client=None,
-                 debug_to_wechat=False):
+                 debug_to_wechat=False, query=None, **options):
+        self._setup(client, debug_to_wechat, **options)
+        self._process(content, query)
+
+    def _setup(self, client, debug_to_wechat=False, crypto=None,
+               event_log=None):
         self.client = client
         self._debug_to_wechat = debug_to_wechat
+        self._crypto = crypto
+        self._event_log = event_log
+        self._crypto_query = None
         self._user = None
 
-        self._reply = ''
-        self._reply_type = None
+        self._reply = None
+        self._route = None
         self._processed = False
-
-        self.message = Message.from_string(content)
+        self._xml = None
         self.reply_message = None
+
+    def _process(self, content, query=None):
+        self._parse(content, query)
+        self._before()
+        self._dispatch()
+
+    def _parse(self, content, query):
+        crypto = self._crypto
+        encrypt = crypto.find_encrypt(content) if crypto is not None else None
+        if encrypt is not None:
+            # 安全模式不需要解析外层的xml
+            fields = crypto.decrypt_fields(encrypt, query)
+            self._crypto_query = query
+        else:
+            fields = parse_xml(content)
+            if crypto is not None and "Encrypt" in fields:
+                fields = crypto.decrypt_fields(fields, query)
+                self._crypto_query = query
+        self.fields = fields
+        self.message = Message.from_fields(self.fields)
+        self.message.direction = INBOUND
         self.openid = self.message.from_id
+        if self._event_log is not None:
+            self._event_log.append(self.message)
         self.log(
             "message received %s, content: %s",
             self.message, self.message.content
         )
-        self._before()
 
-        self.xml = ET.fromstring(self.message.content)
-        if self.message.msg_type.startswith('event_'):
-            msg_type = self.message.msg_type[6:]
-        else:
-            msg_type = self.message.msg_type
-        proc = getattr(self, "_%s" % msg_type, None)
-        if proc is None:
-            self.log("unkown type found: %s", msg_type,
-                     level=logging.WARNING)
-        else:
-            proc()
+    @property
+    def xml(self):
+        '''消息内容的 ``ElementTree`` 元素，只在访问时解析，
+            一般使用 :attr:`fields` 即可'''
+        if self._xml is None:
+            self._xml = ET.fromstring(self.message.content)
+        return self._xml
 
     @property
     def user(self):
@@ -111,97 +280,124 @@ class MessageHandler(object):
             *args,
             **kwargs)
 
+    def _dispatch(self):
+        msg_type = self.message.msg_type
+        entry = self._dispatch_table.get(msg_type)
+        if entry is not None:
+            proc, keyed, matchers = entry
+            fields = self.fields
+            if keyed is not None:
+                self._route = keyed.get(fields.get("EventKey"))
+            if self._route is None:
+                for matcher, target in matchers:
+                    if matcher(fields):
+                        self._route = target
+                        break
+            if proc is not None:
+                return proc(self)
+            if self._route is not None:
+                return self._route(self)
+        if msg_type.startswith('event_'):
+            msg_type = msg_type[6:]
+        self.log("unkown type found: %s", msg_type,
+                 level=logging.WARNING)
+
+    def _emit(self, callback, *args):
+        '''调用消息处理方法，消息匹配 :func:`route` 时调用路由的方法'''
+        if self._route is not None:
+            return self._route(self, *args)
+        return callback(*args)
+
     def _before(self):
-        self.before()
+        return self.before()
 
     def _finish(self):
-        self.finish()
+        return self.finish()
 
     def _subscribe(self):
-        ele = self.xml.find("EventKey")
+        event_key = self.fields.get("EventKey")
         # 当不是扫码关注时，EventKey存在但内容为空
-        if ele is not None and ele.text:
+        if event_key:
             # event_key一定是以 "qrscene_" 开头的
-            event_key = int(ele.text[8:])
-            ticket = self.xml.find("Ticket").text
-            self.event_subscribe_from_qrcode(event_key, ticket)
+            event_key = int(event_key[8:])
+            ticket = self.fields["Ticket"]
+            return self._emit(
+                self.event_subscribe_from_qrcode, event_key, ticket)
         else:
-            self.event_subscribe()
+            return self._emit(self.event_subscribe)
 
     def _unsubscribe(self):
-        self.event_unsubscribe()
+        return self._emit(self.event_unsubscribe)
 
     def _LOCATION(self):
-        lat = float(self.xml.find('Latitude').text)
-        lon = float(self.xml.find('Longitude').text)
-        precision = float(self.xml.find('Precision').text)
+        lat = float(self.fields['Latitude'])
+        lon = float(self.fields['Longitude'])
+        precision = float(self.fields['Precision'])
         location = Location(
             lat, lon, precision, self.openid,
             self.message.create_time)
         self.log("location event: %r", location)
-        self.event_location(location)
+        return self._emit(self.event_location, location)
 
     def _CLICK(self):
-        click_key = self.xml.find('EventKey').text
+        click_key = self.fields['EventKey']
         self.log("click event: %s", click_key)
-        self.event_click(click_key)
+        return self._emit(self.event_click, click_key)
 
     def _VIEW(self):
-        view_key = self.xml.find('EventKey').text
+        view_key = self.fields['EventKey']
         self.log("view event: %s", view_key)
-        self.event_view(view_key)
+        return self._emit(self.event_view, view_key)
 
     def _SCAN(self):
-        scene_value = int(self.xml.find("EventKey").text)
-        ticket = self.xml.find("Ticket").text
-        self.event_scan(scene_value, ticket)
+        scene_value = int(self.fields["EventKey"])
+        ticket = self.fields["Ticket"]
+        return self._emit(self.event_scan, scene_value, ticket)
 
     def _TEMPLATESENDJOBFINISH(self):
-        status = self.xml.find("Status").text
-        self.event_template_send_job_finished(status)
+        status = self.fields["Status"]
+        return self._emit(self.event_template_send_job_finished, status)
 
     def _text(self):
-        text = self.xml.find('Content').text
-        self.on_text(text)
+        text = self.fields['Content']
+        return self._emit(self.on_text, text)
 
     def _image(self):
-        pic_url = self.xml.find('PicUrl').text
-        media_id = self.xml.find('MediaId').text
-        self.on_image(media_id, pic_url)
+        pic_url = self.fields['PicUrl']
+        media_id = self.fields['MediaId']
+        return self._emit(self.on_image, media_id, pic_url)
 
     def _voice(self):
-        media_id = self.xml.find('MediaId').text
-        voice_format = self.xml.find('Format').text
-        recognition_element = self.xml.find('Recognition')
-        if recognition_element is not None:
-            recognition = recognition_element.text
-        else:
+        media_id = self.fields['MediaId']
+        voice_format = self.fields['Format']
+        recognition = self.fields.get('Recognition')
+        if recognition is None:
             self.log("not set void to text, recognition is None")
-            recognition = None
-        self.on_voice(media_id, voice_format, recognition)
+        return self._emit(
+            self.on_voice, media_id, voice_format, recognition)
 
     def _video(self):
-        media_id = self.xml.find('MediaId').text
-        thumb_id = self.xml.find('ThumbMediaId').text
-        self.on_video(media_id, thumb_id)
+        media_id = self.fields['MediaId']
+        thumb_id = self.fields['ThumbMediaId']
+        return self._emit(self.on_video, media_id, thumb_id)
 
     def _shortvideo(self):
-        media_id = self.xml.find('MediaId').text
-        thumb_id = self.xml.find('ThumbMediaId').text
-        self.on_shortvideo(media_id, thumb_id)
+        media_id = self.fields['MediaId']
+        thumb_id = self.fields['ThumbMediaId']
+        return self._emit(self.on_shortvideo, media_id, thumb_id)
 
     def _location(self):
-        x = float(self.xml.find('Location_X').text)
-        y = float(self.xml.find('Location_Y').text)
-        scale = float(self.xml.find('Scale').text)
-        label = self.xml.find('Label').text
-        self.on_location(x, y, scale, label)
+        x = float(self.fields['Location_X'])
+        y = float(self.fields['Location_Y'])
+        scale = float(self.fields['Scale'])
+        label = self.fields['Label']
+        return self._emit(self.on_location, x, y, scale, label)
 
     def _link(self):
-        url = self.xml.find('Url').text
-        title = self.xml.find('Title').text
-        desc = self.xml.find('Description').text
-        self.on_link(url, title, desc)
+        url = self.fields['Url']
+        title = self.fields['Title']
+        desc = self.fields['Description']
+        return self._emit(self.on_link, url, title, desc)
 
     def event_location(self, location):
         '''上报用户地理位置事件
@@ -272,10 +468,14 @@ class MessageHandler(object):
         self.log("%s send status: %s", self.message.msg_id, status)
 
     def on_text(self, text):
-        '''接收到文本消息处理方法
+        '''接收到文本消息处理方法，设置了 :attr:`keywords` 时使用关键词
+        规则回复，子类覆盖此方法时可以调用父类方法保留关键词回复
 
         :param text: 接受到的文本
         '''
+        if self.keywords is not None and (
+                self.keywords.reply(self, text) is not None):
+            return
         if self._debug_to_wechat:
             self.reply_text(text)
 
@@ -345,8 +545,7 @@ class MessageHandler(object):
 
         :param text: 回复的文本字符串
         '''
-        self._reply_type = 'text'
-        self._reply = '<Content><![CDATA[%s]]></Content>' % text
+        self._reply = encoder.render_text(text)
 
     def reply_debug_text(self, text):
         '''debug_to_wechat为True时回复的debug文本消息，否则不回复
@@ -361,20 +560,14 @@ class MessageHandler(object):
 
         :param image_id: 图片的media_id
         '''
-        self._reply_type = 'image'
-        self._reply = (
-            '<Image><MediaId><![CDATA[%s]]>'
-            '</MediaId></Image>' % image_id)
+        self._reply = encoder.render_image(image_id)
 
     def reply_voice(self, voice_id):
         '''回复一条语言消息
 
         :param voice_id: 回复语音的media_id
         '''
-        self._reply_type = 'voice'
-        self._reply = (
-            '<Voice><MediaId><![CDATA[%s]]>'
-            '</MediaId></Voice>' % voice_id)
+        self._reply = encoder.render_voice(voice_id)
 
     def reply_video(self, video_id, title=None, desc=None):
         '''回复一条视频消息
@@ -383,15 +576,7 @@ class MessageHandler(object):
         :param title: 回复视频的标题，可不填
         :param desc: 回复视频的描述，可不填
         '''
-        self._reply_type = 'video'
-        texts = ["<Video>"]
-        texts.append("<MediaId><![CDATA[%s]]></MediaId>" % video_id)
-        if title:
-            texts.append("<Title><![CDATA[%s]]></Title>" % title)
-        if desc:
-            texts.append("<Description><![CDATA[%s]]></Description>" % desc)
-        texts.append("</Video>")
-        self._reply = "\n".join(texts)
+        self._reply = encoder.render_video(video_id, title, desc)
 
     def reply_music(self, music_id, title=None,
                     description=None, url=None, hqurl=None):
@@ -403,21 +588,8 @@ class MessageHandler(object):
         :param url: 歌曲的url地址
         :param hqurl: 歌曲的高清url地址
         '''
-        self._reply_type = 'music'
-        texts = ["<Music>"]
-        if title:
-            texts.append("<Title><![CDATA[%s]]></Title>" % title)
-        if description:
-            texts.append(
-                "<Description><![CDATA[%s]]></Description>" %
-                description)
-        if url:
-            texts.append("<MusicUrl><![CDATA[%s]]></MusicUrl>" % url)
-        if hqurl:
-            texts.append("<HQMusicUrl><![CDATA[%s]]></HQMusicUrl>" % hqurl)
-        texts.append("<ThumbMediaId><![CDATA[%s]]></ThumbMediaId>" % music_id)
-        texts.append("</Music>")
-        self._reply = '\n'.join(texts)
+        self._reply = encoder.render_music(
+            music_id, title, description, url, hqurl)
 
     def reply_news(self, articles):
         '''回复一条图文消息
@@ -426,27 +598,18 @@ class MessageHandler(object):
             每一个图文为一个 ``dict`` ，必须包含 ``title`` , ``description`` ,
             ``picurl`` , ``url`` 四个字段。消息最多包含8条，多余的会自动过滤。
         '''
-        items = []
-        for atc in articles[:8]:
-            items.append(self._get_article_text(**atc))
-        body = '<Articles>%s</Articles>' % ''.join(items)
-        tpl = ['<ArticleCount>%d</ArticleCount>' % len(articles)]
-        tpl.append(body)
-        self._reply_type = 'news'
-        self._reply = ''.join(tpl)
+        self._reply = encoder.render_news(articles)
+
+    def reply_rendered(self, rendered):
+        '''回复一条预先渲染的消息，渲染方法见 :mod:`yawxt.encoder`
+
+        :param rendered: :class:`~yawxt.encoder.RenderedReply` 对象
+        '''
+        self._reply = rendered
 
     def reply_empty(self):
         '''对本条消息不作任何回复'''
-        self._reply_type = None
-
-    def _get_article_text(self, title, description, picurl, url):
-        texts = ['<item>']
-        texts.append('<Title><![CDATA[%s]]></Title>' % title)
-        texts.append('<Description><![CDATA[%s]]></Description>' % description)
-        texts.append('<PicUrl><![CDATA[%s]]></PicUrl>' % picurl)
-        texts.append('<Url><![CDATA[%s]]></Url>' % url)
-        texts.append('</item>')
-        return '\n'.join(texts)
+        self._reply = None
 
     def finish(self):
         '''在回复完所有消息之后调用，此处可以使用类型为 :class:`Message` 的
@@ -457,23 +620,39 @@ class MessageHandler(object):
         pass
 
     def reply(self):
-        ''':returns: 事件或消息处理完成后最终回复给微信的文本内容
+        ''':returns: 事件或消息处理完成后最终回复给微信的UTF-8编码的xml内容
+        :rtype: bytes
 
         .. note:: 此方法只允许调用一次'''
 
+        reply_raw = self._render()
+        self._finish()
+        return reply_raw
+
+    def _render(self):
         if self._processed:
             raise Exception("MessageHandler.reply() 只能调用一次")
+        self._processed = True
 
-        if self._reply_type is None:
+        rendered = self._reply
+        if rendered is None:
             self.log("send empty, user will receive nothing")
-            reply_raw = ""
+            reply_raw = b""
         else:
             reply_message = Message(
                 self.message.from_id, self.message.to_id,
-                self._reply_type, self._reply, self.message.msg_id,
-            )
+                rendered.msg_type, rendered.content, self.message.msg_id,
+                direction=REPLY)
             self.log("send message: %s", reply_message)
             self.reply_message = reply_message
-            reply_raw = reply_message.build_xml()
-        self._finish()
+            if self._event_log is not None:
+                self._event_log.append(reply_message)
+            reply_raw = encoder.encode_message(
+                reply_message.to_id, reply_message.from_id,
+                reply_message.create_time, rendered.msg_type,
+                rendered.body, reply_message.msg_id)
+            if self._crypto_query is not None:
+                reply_raw = self._crypto.encrypt_message(
+                    reply_raw, self._crypto_query.get("nonce"),
+                    self._crypto_query.get("timestamp"))
         return reply_raw
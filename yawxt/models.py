@@ -2,22 +2,52 @@
 
 from __future__ import unicode_literals
 import time
-import xml.etree.ElementTree as ET
+import types
 
-__all__ = ["Message", "User", "Location"]
+from .encoder import encode_message
+from .parser import parse_xml, dump_xml
 
+__all__ = ["Message", "User", "Location", "INBOUND", "REPLY"]
 
-def pop_from_etree(xml, tag):
-    ele = xml.find(tag)
-    if ele is not None:
-        xml.remove(ele)
-        return ele
-    return None
+#: 接收的消息
+INBOUND = "inbound"
+#: 回复的消息
+REPLY = "reply"
 
 
-class DictAccess(object):
+def parse_tagids(value):
+    '''把逗号分割的标签id字符串或list转换为整型list，``None`` 时返回
+    ``None``'''
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        return [int(tagid) for tagid in value]
+    return [int(tagid) for tagid in str(value).split(",") if tagid]
 
-    __availabe_keys__ = set()
+
+class _ModelMeta(type):
+    '''模型类的元类， :mod:`yawxt.persistence` 在其上注册sqlalchemy的
+    ``inspect`` 和 :attr:`_column_hook` ，兼容直接查询模型类的旧代码'''
+
+    #: 访问类的字段（如 ``Location.create_time`` ）时调用，返回映射类的列
+    _column_hook = None
+
+    def __getattribute__(cls, name):
+        value = type.__getattribute__(cls, name)
+        if type(value) is types.MemberDescriptorType and (
+                _ModelMeta._column_hook is not None):
+            return _ModelMeta._column_hook(cls, name, value)
+        return value
+
+
+class DictAccess(_ModelMeta(str("_ModelBase"), (object,), {"__slots__": ()})):
+    '''使用 ``__slots__`` 保存字段，可以像 ``dict`` 一样按字段名访问。
+    需要保存到数据库时使用 :mod:`yawxt.persistence` 中对应的映射类转换，如
+    :meth:`yawxt.persistence.MessageRecord.from_model`
+    '''
+
+    __slots__ = ()
+    __availabe_keys__ = frozenset()
 
     def __init__(self, *args, **kwargs):
         for key in self.__availabe_keys__:
@@ -44,12 +74,18 @@ class DictAccess(object):
         return repr(d)
 
     def __eq__(self, value):
+        # 映射类的对象和原始对象字段相同时也相等
+        keys = self.__availabe_keys__
         return (
-            isinstance(value, self.__class__) and
-            all(getattr(self, k) == getattr(value, k)
-                for k in self.__availabe_keys__)
+            isinstance(value, DictAccess) and
+            value.__availabe_keys__ is keys and
+            all(getattr(self, k, None) == getattr(value, k, None)
+                for k in keys)
         )
 
+    def __ne__(self, value):
+        return not self == value
+
 
 class Message(DictAccess):
     '''微信消息类，包括接收消息和发送消息，事件也属于消息
@@ -61,6 +97,8 @@ class Message(DictAccess):
     :ivar create_time: 消息的创建时间，整型unix时间戳
     :ivar msg_type: 消息的类型，如 text, voice, 事件消息类型为event_加事件类型，如
         event_LOCATION, event_VIEW
+    :ivar direction: 消息方向，接收的消息为 :data:`INBOUND` ，回复的消息为
+        :data:`REPLY` ，不确定时为 ``None``
     :ivar content: 消息除去头部自动构成的xml字符串，例如：
 
         .. code-block:: xml
@@ -71,45 +109,60 @@ class Message(DictAccess):
             <Label><![CDATA[北京市东城区东长安街]]></Label>
 
     '''
-    __availabe_keys__ = set([
+    __availabe_keys__ = frozenset([
         "to_id", "from_id", "create_time",
-        "msg_id", "msg_type", "content"])
+        "msg_id", "msg_type", "content", "direction"])
+    __slots__ = (
+        "to_id", "from_id", "create_time", "msg_id", "msg_type", "content",
+        "direction")
 
     def __init__(self, to_id, from_id, msg_type,
-                 content, msg_id=None, create_time=None):
+                 content, msg_id=None, create_time=None, direction=None):
         self.to_id = to_id
         self.from_id = from_id
         self.msg_id = msg_id
         self.msg_type = msg_type
         self.content = content
         self.create_time = create_time or int(time.time())
+        self.direction = direction
 
     def __str__(self):
         return self.build_xml()
 
     @classmethod
-    def from_string(cls, xml_str):
+    def from_string(cls, xml_str, crypto=None, query=None):
         '''从文本字符串构造 :class:`Message` 对象
 
         :param xml_str: xml文本字符串
+        :param crypto: 安全模式的加解密对象
+            :class:`~yawxt.crypto.MessageCrypto` ，设置后自动解密加密消息
+        :param query: 请求url的query_string参数字典，解密时用于检查签名
+        :rtype:  Message
+        '''
+        fields = parse_xml(xml_str)
+        if crypto is not None and "Encrypt" in fields:
+            fields = crypto.decrypt_fields(fields, query)
+        return cls.from_fields(fields)
+
+    @classmethod
+    def from_fields(cls, fields):
+        '''从 :func:`~yawxt.parser.parse_xml` 解析得到的字段字典构造
+        :class:`Message` 对象，头部字段会从字典中移除，剩余的字段组成
+        :attr:`content`
+
+        :param fields: ``tag -> text`` 字典
         :rtype:  Message
         '''
-        if not isinstance(xml_str, bytes):
-            xml_str = xml_str.encode("utf8")
-        xml = ET.fromstring(xml_str)
-        to_id = pop_from_etree(xml, 'ToUserName').text
-        from_id = pop_from_etree(xml, 'FromUserName').text
-        msg_type = pop_from_etree(xml, 'MsgType').text
+        to_id = fields.pop('ToUserName')
+        from_id = fields.pop('FromUserName')
+        msg_type = fields.pop('MsgType')
         if msg_type == "event":
-            sub_type = pop_from_etree(xml, 'Event').text
-            msg_type = "event_%s" % sub_type
-        create_time = int(pop_from_etree(xml, 'CreateTime').text)
-        msg_id_node = pop_from_etree(xml, 'MsgId')
-        if msg_id_node is not None:
-            msg_id = int(msg_id_node.text)
-        else:
-            msg_id = None
-        return cls(to_id, from_id, msg_type, ET.tostring(xml).decode(),
+            msg_type = "event_%s" % fields.pop('Event')
+        create_time = int(fields.pop('CreateTime'))
+        msg_id = fields.pop('MsgId', None)
+        if msg_id is not None:
+            msg_id = int(msg_id)
+        return cls(to_id, from_id, msg_type, dump_xml(fields),
                    msg_id, create_time=create_time)
 
     def build_xml(self):
@@ -118,28 +171,16 @@ class Message(DictAccess):
         :returns: 此消息对应的微信xml格式消息字符串
         :rtype: str
         '''
-        texts = [
-            '''<xml>
-<ToUserName><![CDATA[%s]]></ToUserName>
-<FromUserName><![CDATA[%s]]></FromUserName>
-<CreateTime>%s</CreateTime>''' % (
-                self.to_id,
-                self.from_id, self.create_time)]
-
-        if self.msg_type.startswith("event_"):
-            msg_type = "event"
-            sub_type = self.msg_type[6:]
-            texts.append('''<MsgType><![CDATA[%s]]></MsgType>
-<Event><![CDATA[%s]]></Event>''' % (msg_type, sub_type))
-        else:
-            texts.append(
-                '''<MsgType><![CDATA[%s]]></MsgType>''' % self.msg_type)
-
-        if self.msg_id is not None:
-            texts.append("<MsgId>%s</MsgId>" % self.msg_id)
-        texts.append(self.content)
-        texts.append("</xml>")
-        return "\n".join(texts)
+        return self.build_bytes().decode("utf8")
+
+    def build_bytes(self):
+        '''生成此消息UTF-8编码的xml
+
+        :rtype: bytes
+        '''
+        return encode_message(
+            self.to_id, self.from_id, self.create_time, self.msg_type,
+            self.content.encode("utf8"), self.msg_id)
 
 
 class User(DictAccess):
@@ -161,13 +202,19 @@ class User(DictAccess):
     :ivar union: 只有在用户将公众号绑定到微信开放平台帐号后，才会出现该字段
     :ivar remark: 公众号运营者对粉丝的备注
     :ivar groupid: 用户所在的分组ID
-    :ivar tagid_list: 用户被打上的标签ID列表，是逗号分割的字符串
+    :ivar tagid_list: 用户被打上的标签ID列表，是逗号分割的字符串，
+        对象中保存为整型list :attr:`tagids`
+    :ivar update_time: 用户信息保存到数据库的时间，未保存时为 ``None``
     '''
-    __availabe_keys__ = set([
+    __availabe_keys__ = frozenset([
         "subscribe", "openid", "nickname", "sex", "city",
         "country", "province", "headimgurl", "subscribe_time",
         "unionid", "remark", "groupid", "tagid_list", "language"
     ])
+    __slots__ = (
+        "subscribe", "openid", "nickname", "sex", "city", "country",
+        "province", "headimgurl", "subscribe_time", "unionid", "remark",
+        "groupid", "_tagids", "language", "update_time")
 
     def __init__(self, _d=None, **kwargs):
         if _d is None:
@@ -175,22 +222,22 @@ class User(DictAccess):
         if kwargs:
             _d.update(kwargs)
         super(User, self).__init__(**_d)
+        self.update_time = None
 
     @property
     def tagids(self):
         '''类型为整型list的标签id，如 ``[1,2,3]`` , 对应的 :attr:`tagid_list` 为 `'1,2,3'`'''
-        return (
-            list(map(int, self.tagid_list.split(",")))
-            if self.tagid_list else []
-        )
+        return list(self._tagids) if self._tagids else []
+
+    def _get_tagid_list(self):
+        if self._tagids is None:
+            return None
+        return ",".join(map(str, self._tagids))
+
+    def _set_tagid_list(self, value):
+        self._tagids = parse_tagids(value)
 
-    def __setattr__(self, name, value):
-        if name == "tagid_list":
-            if isinstance(value, list):
-                value = ",".join(map(str, value))
-            elif value is not None:
-                value = str(value)
-        super(User, self).__setattr__(name, value)
+    tagid_list = property(_get_tagid_list, _set_tagid_list)
 
     def update(self, info):
         '''更新用户信息'''
@@ -210,9 +257,11 @@ class Location(DictAccess):
     :ivar openid: 在次位置的用户openid
     :ivar create_time:  用户在此位置的时间
     '''
-    __availabe_keys__ = set([
+    __availabe_keys__ = frozenset([
         "latitude", "longitude", "precision",
         "openid", "create_time"])
+    __slots__ = (
+        "latitude", "longitude", "precision", "openid", "create_time")
 
     def __init__(self, latitude, longitude, precision=None,
                  openid=None, create_time=None):
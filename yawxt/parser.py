@@ -0,0 +1,310 @@
+# -*- coding:utf-8 -*-
+
+'''微信推送消息的xml解析后端
+
+微信推送的消息都是 ``<xml>`` 根节点下一层平铺的元素，大部分内容使用CDATA包裹。
+本模块提供多种解析后端，统一把消息解析为 ``tag -> text`` 的有序字典：
+
+#. ``flat`` : 针对平铺结构的专用解析器，不构造元素树
+#. ``lxml`` : 基于 ``lxml.etree`` 的解析器，需要安装lxml
+#. ``etree`` : 基于标准库 ``xml.etree.ElementTree`` 的通用解析器
+#. ``expat`` : 基于标准库 ``xml.parsers.expat`` 的流式解析器
+
+除 ``etree`` 外的后端只处理平铺结构的消息，遇到嵌套元素（如 ``ScanCodeInfo`` ）时
+:func:`parse_xml` 会自动退回到 ``etree`` 后端。默认使用可用后端中最快的一个
+（速度对比见 ``benchmarks/bench_parser.py`` ），可以使用 :func:`set_backend` 指定。
+'''
+
+from __future__ import unicode_literals
+import re
+import sys
+import logging
+from collections import OrderedDict
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+__all__ = [
+    "parse_xml", "dump_xml", "get_backend", "set_backend",
+    "available_backends", "NestedElementError", "RawXML"]
+
+logger = logging.getLogger(__name__)
+
+try:
+    text_type = unicode  # noqa: F821
+except NameError:
+    text_type = str
+
+
+class NestedElementError(ValueError):
+    '''消息中包含嵌套元素或平铺解析器不支持的结构时抛出，
+    :func:`parse_xml` 捕获此异常后使用 ``etree`` 后端重新解析'''
+
+
+class RawXML(text_type):
+    '''``etree`` 后端中嵌套元素的值，保存该元素序列化后的xml文本，
+    :func:`dump_xml` 原样输出'''
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode("utf8")
+
+
+def _to_text(data):
+    if isinstance(data, bytes):
+        return data.decode("utf8")
+    return data
+
+
+class ParserBackend(object):
+    '''解析后端基类
+
+    :meth:`parse` 返回根节点下所有子元素 ``tag -> text`` 的有序字典，
+    空元素的值为 ``None`` ，与 ``ElementTree`` 的 ``text`` 一致
+    '''
+
+    name = None
+
+    def parse(self, data):
+        raise NotImplementedError()
+
+
+try:
+    _unichr = unichr  # noqa: F821
+except NameError:
+    _unichr = chr
+
+if sys.version_info >= (3, 7):
+    _dict = dict
+else:
+    _dict = OrderedDict
+
+_ENTITIES = {"lt": "<", "gt": ">", "amp": "&", "quot": '"', "apos": "'"}
+_entity_re = re.compile(r"&(#x[0-9a-fA-F]+|#[0-9]+|[a-z]+);")
+
+
+def _replace_entity(match):
+    name = match.group(1)
+    if name[:2] == "#x":
+        return _unichr(int(name[2:], 16))
+    if name[:1] == "#":
+        return _unichr(int(name[1:]))
+    try:
+        return _ENTITIES[name]
+    except KeyError:
+        raise NestedElementError("unknown entity: &%s;" % name)
+
+
+class FlatParser(ParserBackend):
+    '''平铺结构专用解析器，使用一个预编译的正则表达式一次找出所有
+    ``<Tag>text</Tag>`` 、 ``<Tag><![CDATA[text]]></Tag>`` 和 ``<Tag />`` 元素
+
+    解析后核对文档中 ``<`` 的个数与匹配到的元素是否一致，不一致说明存在
+    嵌套元素、属性、注释等平铺结构之外的内容，此时抛出
+    :class:`NestedElementError`
+    '''
+
+    name = "flat"
+
+    _element_re = re.compile(
+        r"<([A-Za-z_][\w.\-]*)>(?:<!\[CDATA\[(.*?)\]\]>|([^<]*))</\1>"
+        r"|<([A-Za-z_][\w.\-]*)\s*/>", re.S)
+
+    def parse(self, data):
+        if isinstance(data, bytes):
+            data = data.decode("utf8")
+        # 根节点的开始和结束标签
+        expected = 2
+        fields = _dict()
+        for tag, cdata, text, empty in self._element_re.findall(data):
+            if empty:
+                expected += 1
+                fields[empty] = None
+            elif cdata:
+                expected += 2
+                if "<" in cdata:
+                    expected += cdata.count("<")
+                fields[tag] = cdata
+            else:
+                expected += 2
+                if "&" in text:
+                    text = _entity_re.sub(_replace_entity, text)
+                fields[tag] = text or None
+        if expected != data.count("<") - data.count("<![CDATA["):
+            raise NestedElementError("not a flat wechat message")
+        return fields
+
+
+class ExpatParser(ParserBackend):
+    '''基于 ``xml.parsers.expat`` 的解析器，只跟踪两层元素深度'''
+
+    name = "expat"
+
+    def parse(self, data):
+        fields = _dict()
+        state = {"depth": 0, "tag": None, "texts": []}
+
+        def start(tag, attrs):
+            state["depth"] += 1
+            if state["depth"] > 2:
+                raise NestedElementError("nested element: %s" % tag)
+            if state["depth"] == 2:
+                state["tag"] = tag
+                state["texts"] = []
+
+        def end(tag):
+            if state["depth"] == 2:
+                fields[tag] = "".join(state["texts"]) or None
+            state["depth"] -= 1
+
+        def chars(text):
+            if state["depth"] == 2:
+                state["texts"].append(text)
+
+        parser = expat.ParserCreate("utf-8")
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = chars
+        parser.Parse(_to_bytes(data), True)
+        return fields
+
+
+class LxmlParser(ParserBackend):
+    '''基于 ``lxml.etree`` 的解析器，需要安装lxml'''
+
+    name = "lxml"
+
+    def __init__(self):
+        self._parser = lxml_etree.XMLParser(
+            resolve_entities=False, no_network=True)
+
+    def parse(self, data):
+        root = lxml_etree.fromstring(_to_bytes(data), self._parser)
+        fields = _dict()
+        for child in root:
+            if not isinstance(child.tag, (str, text_type)):
+                # 注释和处理指令的tag不是字符串
+                continue
+            if len(child):
+                raise NestedElementError("nested element: %s" % child.tag)
+            fields[child.tag] = child.text or None
+        return fields
+
+
+class EtreeParser(ParserBackend):
+    '''基于 ``xml.etree.ElementTree`` 的通用解析器，支持嵌套元素，
+    嵌套元素的值为 :class:`RawXML`
+    '''
+
+    name = "etree"
+
+    def parse(self, data):
+        root = ET.fromstring(_to_bytes(data))
+        fields = _dict()
+        for child in root:
+            if len(child):
+                child.tail = None
+                fields[child.tag] = RawXML(ET.tostring(child).decode("utf8"))
+            else:
+                fields[child.tag] = child.text or None
+        return fields
+
+
+#: 按照优先级排列的后端类，默认使用第一个可用的后端
+BACKENDS = OrderedDict([
+    ("flat", FlatParser),
+    ("lxml", LxmlParser),
+    ("etree", EtreeParser),
+    ("expat", ExpatParser),
+])
+
+_fallback = EtreeParser()
+_backend = None
+
+
+def available_backends():
+    '''当前环境可用的解析后端名称列表，按优先级排列
+
+    :rtype: list
+    '''
+    return [
+        name for name in BACKENDS
+        if name != "lxml" or lxml_etree is not None]
+
+
+def get_backend(name=None):
+    '''获取解析后端对象
+
+    :param name: 后端名称，为 ``None`` 时返回当前使用的后端
+    :rtype: ParserBackend
+    '''
+    global _backend
+    if name is None:
+        if _backend is None:
+            _backend = BACKENDS[available_backends()[0]]()
+        return _backend
+    if name not in available_backends():
+        raise ValueError("xml parser backend %s is not available" % name)
+    return BACKENDS[name]()
+
+
+def set_backend(name):
+    '''设置 :func:`parse_xml` 使用的解析后端
+
+    :param name: 后端名称，可选值见 :func:`available_backends`
+    '''
+    global _backend
+    _backend = get_backend(name)
+    logger.debug("use xml parser backend: %s", name)
+
+
+def parse_xml(data, backend=None):
+    '''解析微信推送的xml消息
+
+    :param data: xml文本， ``bytes`` 或 ``str``
+    :param backend: 使用的解析后端，默认为当前后端
+    :returns: 根节点下子元素 ``tag -> text`` 的有序字典
+    :rtype: OrderedDict
+    '''
+    if backend is None:
+        backend = get_backend()
+    try:
+        return backend.parse(data)
+    except NestedElementError:
+        return _fallback.parse(data)
+
+
+def _escape(text):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def dump_xml(fields):
+    '''把 :func:`parse_xml` 得到的字典序列化为xml文本，结果与
+    ``ElementTree.tostring`` 相同格式，文本内容不使用CDATA
+
+    :param fields: ``tag -> text`` 字典
+    :rtype: str
+    '''
+    texts = ["<xml>"]
+    for tag, text in fields.items():
+        if text is None:
+            texts.append("<%s />" % tag)
+        elif isinstance(text, RawXML):
+            texts.append(text)
+        else:
+            texts.append("<%s>%s</%s>" % (tag, _escape(text), tag))
+    texts.append("</xml>")
+    return "".join(texts)
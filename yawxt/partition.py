@@ -0,0 +1,391 @@
+# -*- coding:utf-8 -*-
+
+'''按月分表保存消息和地理位置，冷数据归档为压缩文件
+
+:class:`MonthlyPartitions` 把 ``wechat_message`` 和 ``wechat_location`` 的新数据
+按 ``create_time`` 所在月份（UTC）写入 ``wechat_message_201708`` 这样的月表，
+月表在第一次写入时自动创建，结构和索引与原表相同。设置为
+:class:`~yawxt.persistence.PersistMessageHandler` 的 ``partitions`` 和
+:class:`~yawxt.persistence.WriteBehindBuffer` 的 ``partitions`` 后，写入自动
+路由到对应的月表：
+
+.. code-block:: python
+
+    partitions = MonthlyPartitions(engine, archive_dir="/data/wechat-archive")
+    dispatcher = Dispatcher(
+        PersistMessageHandler, client, db_session_maker=Session,
+        partitions=partitions)
+
+    # 定期执行，把90天前的月表归档为压缩文件并删除
+    partitions.archive_before(time.time() - 90 * 86400)
+
+    for message in partitions.messages(since=start, until=end):
+        ...
+
+归档文件为gzip压缩的json lines，每行一条记录，文件名为
+``<月表名>.jsonl.gz`` ，可以用 :func:`read_archive` 读回
+:class:`~yawxt.Message` 或 :class:`~yawxt.Location` 对象。
+启用分表前 ``wechat_message`` 和 ``wechat_location`` 中已有的数据保持不变。
+'''
+
+from __future__ import unicode_literals
+import os
+import re
+import gzip
+import json
+import time
+import shutil
+import logging
+import calendar
+import threading
+
+from sqlalchemy import MetaData, select, inspect, text, false
+
+from .models import Message, Location
+from .persistence import message_table, location_table
+
+__all__ = ["MonthlyPartitions", "read_archive"]
+
+logger = logging.getLogger(__name__)
+
+_MODELS = {
+    message_table.name: Message,
+    location_table.name: Location,
+}
+
+_ARCHIVE_RE = re.compile(r"^(\w+)_(\d{6})\.jsonl\.gz$")
+
+
+def _month(create_time):
+    return time.strftime("%Y%m", time.gmtime(create_time))
+
+
+def _month_range(month):
+    year, mon = int(month[:4]), int(month[4:])
+    start = calendar.timegm((year, mon, 1, 0, 0, 0))
+    if mon == 12:
+        year, mon = year + 1, 0
+    return start, calendar.timegm((year, mon + 1, 1, 0, 0, 0))
+
+
+def _to_object(model, row):
+    if model is Message:
+        return Message(
+            row["to_id"], row["from_id"], row["msg_type"], row["content"],
+            row["msg_id"], row["create_time"], row["direction"])
+    return Location(
+        row["latitude"], row["longitude"], row["precision"], row["openid"],
+        row["create_time"])
+
+
+def read_archive(path):
+    '''读取归档文件
+
+    :param path: :meth:`MonthlyPartitions.archive` 生成的文件路径
+    :returns: :class:`~yawxt.Message` 或 :class:`~yawxt.Location` 对象的
+        迭代器，按原表中的id顺序
+    '''
+    m = _ARCHIVE_RE.match(os.path.basename(path))
+    if m is None or m.group(1) not in _MODELS:
+        raise ValueError("not an archive file: %s" % path)
+    model = _MODELS[m.group(1)]
+    with gzip.open(path, "rb") as fp:
+        for line in fp:
+            yield _to_object(model, json.loads(line.decode("utf8")))
+
+
+class MonthlyPartitions(object):
+    '''按月分表，可以在多个线程中同时使用
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :param archive_dir: 归档文件目录，不存在时自动创建，为 ``None`` 时不能
+        归档
+    :param tables: 分表的原表，默认为 ``wechat_message`` 和
+        ``wechat_location``
+    '''
+
+    def __init__(self, bind, archive_dir=None,
+                 tables=(message_table, location_table)):
+        self.bind = bind
+        self.archive_dir = archive_dir
+        self.tables = tuple(tables)
+        self.metadata = MetaData()
+        self._lock = threading.Lock()
+        self._created = {}
+        if archive_dir is not None and not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+        self.prepare()
+
+    def __contains__(self, table):
+        return table in self.tables
+
+    def _partition(self, table, month):
+        name = "%s_%s" % (table.name, month)
+        partition = self.metadata.tables.get(name)
+        if partition is None:
+            with self._lock:
+                partition = self.metadata.tables.get(name)
+                if partition is None:
+                    partition = table.to_metadata(self.metadata, name=name)
+                    for index in partition.indexes:
+                        index.name = index.name.replace(table.name, name, 1)
+        return partition
+
+    def prepare(self, now=None):
+        '''创建当前月和下个月的月表，创建时自动执行。写入时不存在的月表会在
+        写入的事务中创建，长期运行的进程可以每月定期执行，避免每次写入检查
+
+        :param now: 当前时间戳，默认为当前时间
+        '''
+        if now is None:
+            now = time.time()
+        next_month = _month_range(_month(now))[1]
+        for table in self.tables:
+            self.table(table, now)
+            self.table(table, next_month)
+
+    def table(self, table, create_time, bind=None):
+        '''数据所在的月表，不存在时创建
+
+        :param table: 原表，如 ``message_table``
+        :param create_time: 数据的时间戳
+        :param bind: 创建月表使用的 ``Connection`` ，默认使用 :attr:`bind`
+        :rtype: sqlalchemy ``Table``
+        '''
+        partition = self._partition(table, _month(create_time))
+        if partition.name in self._created:
+            return partition
+        if bind is not None:
+            # 在调用者的事务中创建，事务可能回滚，不记录为已创建
+            partition.create(bind, checkfirst=True)
+            return partition
+        with self._lock:
+            if partition.name not in self._created:
+                partition.create(self.bind, checkfirst=True)
+                self._created[partition.name] = True
+        return partition
+
+    def insert(self, bind, table, rows):
+        '''按月份把数据插入对应的月表，月表不存在时在同一个事务中创建
+
+        :param bind: sqlalchemy ``Connection`` 或 ``Session`` 对象，在其
+            事务中执行
+        :param table: 原表
+        :param rows: 列名到值的 ``dict`` 列表
+        '''
+        conn = bind.connection() if hasattr(bind, "get_bind") else bind
+        groups = {}
+        for row in rows:
+            create_time = row.get("create_time") or int(time.time())
+            groups.setdefault(
+                self.table(table, create_time, conn), []).append(row)
+        for partition, group in groups.items():
+            conn.execute(partition.insert(), group)
+
+    def months(self, table):
+        '''数据库中已有月表的月份，如 ``["201707", "201708"]``
+
+        :param table: 原表
+        :rtype: list
+        '''
+        pattern = re.compile(r"^%s_(\d{6})$" % re.escape(table.name))
+        return sorted(
+            m.group(1) for m in map(
+                pattern.match, inspect(self.bind).get_table_names()) if m)
+
+    def month_tables(self, table, since=None, until=None):
+        '''数据库中已有的月表，按月份排列
+
+        :param table: 原表
+        :param since: 只返回包含此时间之后数据的月表
+        :param until: 只返回包含此时间之前数据的月表
+        :rtype: list of sqlalchemy ``Table``
+        '''
+        tables = []
+        for month in self.months(table):
+            start, end = _month_range(month)
+            if (since is not None and end <= since) or (
+                    until is not None and start >= until):
+                continue
+            tables.append(self._partition(table, month))
+        return tables
+
+    def archived_months(self, table):
+        '''已归档的月份
+
+        :param table: 原表
+        :rtype: list
+        '''
+        if self.archive_dir is None:
+            return []
+        months = []
+        for name in os.listdir(self.archive_dir):
+            m = _ARCHIVE_RE.match(name)
+            if m and m.group(1) == table.name:
+                months.append(m.group(2))
+        return sorted(months)
+
+    def _export(self, partition, fp, last_id, batch_size):
+        count = 0
+        while True:
+            rows = self.bind.execute(
+                select([partition])
+                .where(partition.c.id > last_id)
+                .order_by(partition.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return last_id, count
+            fp.write(b"".join(
+                json.dumps(
+                    dict(row._mapping), ensure_ascii=False,
+                    separators=(",", ":")).encode("utf8") + b"\n"
+                for row in rows))
+            count += len(rows)
+            last_id = rows[-1].id
+
+    def archive(self, table, month, batch_size=10000):
+        '''把一个月表归档为压缩文件，写入完成并检查行数后删除月表。
+        归档后月表又写入了数据时，再次归档会追加到已有的归档文件中
+
+        :param table: 原表
+        :param month: 月份，如 ``"201708"``
+        :param batch_size: 每次从数据库读取的行数
+        :returns: 归档文件路径
+        '''
+        if self.archive_dir is None:
+            raise ValueError("archive_dir is not set")
+        if month not in self.months(table):
+            raise ValueError("no partition of %s for %s" % (table.name, month))
+        partition = self._partition(table, month)
+        path = os.path.join(
+            self.archive_dir, "%s.jsonl.gz" % partition.name)
+        tmp_path = path + ".tmp"
+        archived = 0
+        with open(tmp_path, "wb") as fp:
+            if os.path.exists(path):
+                # gzip文件可以直接拼接，读取时依次解压
+                with gzip.open(path, "rb") as old:
+                    archived = sum(1 for _ in old)
+                with open(path, "rb") as old:
+                    shutil.copyfileobj(old, fp)
+        count = 0
+        last_id = 0
+        try:
+            while True:
+                with gzip.open(tmp_path, "ab") as fp:
+                    last_id, written = self._export(
+                        partition, fp, last_id, batch_size)
+                count += written
+                with open(tmp_path, "rb") as fp:
+                    os.fsync(fp.fileno())
+                with gzip.open(tmp_path, "rb") as fp:
+                    total = sum(1 for _ in fp)
+                if total != archived + count:
+                    raise ValueError("archive %s: wrote %d of %d rows" % (
+                        path, total - archived, count))
+                if self._drop(partition, last_id, tmp_path, path):
+                    break
+                # 导出后又写入了数据，继续导出新的行
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._created.pop(partition.name, None)
+        logger.info("archive %d rows of %s to %s", count, partition.name, path)
+        return path
+
+    def _drop(self, partition, last_id, tmp_path, path):
+        dialect = self.bind.dialect
+        name = dialect.identifier_preparer.format_table(partition)
+        with self.bind.begin() as conn:
+            # 锁表后在删除月表的事务中检查没有导出之后写入的行
+            if dialect.name == "postgresql":
+                conn.execute(
+                    text("LOCK TABLE %s IN ACCESS EXCLUSIVE MODE" % name))
+            elif dialect.name in ("mysql", "mariadb"):
+                conn.execute(text("LOCK TABLES %s WRITE" % name))
+            else:
+                # sqlite开始写事务，其他连接不能再写入
+                conn.execute(partition.delete().where(false()))
+            try:
+                late = conn.execute(
+                    select([partition.c.id])
+                    .where(partition.c.id > last_id).limit(1)).first()
+                if late is None:
+                    partition.drop(conn)
+                    os.rename(tmp_path, path)
+            finally:
+                if dialect.name in ("mysql", "mariadb"):
+                    conn.execute(text("UNLOCK TABLES"))
+        return late is None
+
+    def archive_before(self, before, batch_size=10000):
+        '''归档所有在 ``before`` 之前结束的月表
+
+        :param before: 时间戳
+        :returns: 归档文件路径列表
+        '''
+        paths = []
+        for table in self.tables:
+            for month in self.months(table):
+                if _month_range(month)[1] <= before:
+                    paths.append(self.archive(table, month, batch_size))
+        return paths
+
+    def _iterate(self, table, since, until, batch_size):
+        model = _MODELS[table.name]
+        archived = set(self.archived_months(table))
+        live = set(self.months(table))
+
+        def in_range(create_time):
+            return (since is None or create_time >= since) and (
+                until is None or create_time < until)
+
+        for month in sorted(archived | live):
+            start, end = _month_range(month)
+            if (since is not None and end <= since) or (
+                    until is not None and start >= until):
+                continue
+            if month in archived:
+                path = os.path.join(
+                    self.archive_dir, "%s_%s.jsonl.gz" % (table.name, month))
+                for obj in read_archive(path):
+                    if in_range(obj.create_time):
+                        yield obj
+            if month not in live:
+                continue
+            # 归档后又写入的数据
+            partition = self._partition(table, month)
+            c = partition.c
+            last_id = 0
+            while True:
+                cond = c.id > last_id
+                if since is not None:
+                    cond = cond & (c.create_time >= since)
+                if until is not None:
+                    cond = cond & (c.create_time < until)
+                rows = self.bind.execute(
+                    select([partition]).where(cond)
+                    .order_by(c.id).limit(batch_size)).fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield _to_object(model, row._mapping)
+                last_id = rows[-1].id
+
+    def messages(self, since=None, until=None, batch_size=1000):
+        '''按月份顺序读取月表和归档文件中的消息
+
+        :param since: 开始时间戳，包含此时间
+        :param until: 结束时间戳，不包含此时间
+        :param batch_size: 每次从数据库读取的行数
+        :rtype: iterator of :class:`~yawxt.Message`
+        '''
+        return self._iterate(message_table, since, until, batch_size)
+
+    def locations(self, since=None, until=None, batch_size=1000):
+        '''按月份顺序读取月表和归档文件中的地理位置，参数见 :meth:`messages`
+
+        :rtype: iterator of :class:`~yawxt.Location`
+        '''
+        return self._iterate(location_table, since, until, batch_size)
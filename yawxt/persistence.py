@@ -1,14 +1,29 @@
 # -*- coding:utf-8 -*-
 
 from __future__ import unicode_literals
+import re
 import time
+import atexit
 import logging
+import warnings
+import threading
+from collections import OrderedDict
+
+try:
+    from queue import Queue, Empty
+except ImportError:  # pragma: no cover
+    from Queue import Queue, Empty
 
 try:
     from sqlalchemy import (
-        Table, Text, Column, Integer, String, Float, BigInteger)
+        Table, Text, Column, Integer, String, Float, BigInteger, Index,
+        inspect, select, func, or_, case, bindparam)
     from sqlalchemy.ext.declarative import declarative_base
-    from sqlalchemy.orm import mapper
+    from sqlalchemy.schema import CreateIndex
+    from sqlalchemy.exc import IntegrityError
+    from sqlalchemy.orm import mapper, synonym
+    from sqlalchemy import event, inspection
+    from sqlalchemy.orm.base import _inspect_mapped_class
 except ImportError:
     logging.error(
         "please install sqlalchemy"
@@ -16,14 +31,105 @@ except ImportError:
     raise
 
 from .message import MessageHandler
-from .models import User, Location, Message
+from .models import (
+    User, Location, Message, INBOUND, REPLY, parse_tagids, _ModelMeta)
+from .keywords import rule_from_dict
+from .parser import parse_xml
+from .geo import (
+    haversine, encode_geohash, bounding_box, geohash_cover)
 
 __all__ = [
-    "user_table", "message_table", "location_table",
-    "create_all", "PersistMessageHandler"]
+    "user_table", "user_tag_table", "message_table", "location_table",
+    "latest_location_table", "keyword_table", "message_stats_table",
+    "create_all", "migrate", "upsert_users", "load_keyword_rules",
+    "load_event_log", "save_latest_location", "rebuild_latest_locations",
+    "update_message_stats", "rebuild_message_stats", "message_stats",
+    "subscribe_stats", "purge_locations", "extract_payload",
+    "backfill_payload", "backfill_geohash", "users_near", "users_in_bbox",
+    "MessageRecord", "UserRecord", "LocationRecord", "sync_user_tags",
+    "rebuild_user_tags", "user_tags", "tag_members", "tag_intersection",
+    "tag_counts", "LocationPolicy", "UserCache", "LocationCache",
+    "WriteBehindBuffer", "PersistMessageHandler"]
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+
+def _location_geohash(context):
+    params = context.get_current_parameters()
+    latitude, longitude = params.get("latitude"), params.get("longitude")
+    if latitude is None or longitude is None:
+        return None
+    return encode_geohash(latitude, longitude)
+
+
+_PAYLOAD_FIELDS = [
+    ("text", "Content", None),
+    ("media_id", "MediaId", None),
+    ("event_key", "EventKey", None),
+    ("pic_url", "PicUrl", None),
+    ("location_x", "Location_X", float),
+    ("location_y", "Location_Y", float),
+    ("status", "Status", None),
+]
+
+
+def extract_payload(content):
+    '''从消息的 :attr:`~yawxt.Message.content` 中取出常用字段，保存到
+    ``wechat_message`` 表的同名列中，可以直接查询和建立索引：
+
+    ============== ===========================================
+    列             字段
+    ============== ===========================================
+    ``text``       文本消息的 ``Content``
+    ``media_id``   ``MediaId``
+    ``event_key``  ``EventKey``
+    ``pic_url``    ``PicUrl``
+    ``location_x`` ``Location_X`` ，地理位置事件为 ``Latitude``
+    ``location_y`` ``Location_Y`` ，地理位置事件为 ``Longitude``
+    ``status``     ``Status``
+    ============== ===========================================
+
+    :param content: xml文本，回复消息的内容可以没有 ``<xml>`` 根节点
+    :returns: 列名到值的 ``dict`` ，没有的字段为 ``None``
+    '''
+    payload = dict.fromkeys(name for name, _, _ in _PAYLOAD_FIELDS)
+    if not content:
+        return payload
+    if not content.startswith("<xml>"):
+        content = "<xml>%s</xml>" % content
+    try:
+        fields = parse_xml(content)
+    except Exception:
+        logger.warning("can not parse message content: %r", content[:200])
+        return payload
+    if "Location_X" not in fields and "Latitude" in fields:
+        fields["Location_X"] = fields["Latitude"]
+        fields["Location_Y"] = fields.get("Longitude")
+    for name, tag, convert in _PAYLOAD_FIELDS:
+        value = fields.get(tag)
+        if value is not None and convert is not None:
+            try:
+                value = convert(value)
+            except ValueError:
+                value = None
+        payload[name] = value
+    return payload
+
+
+def _payload_default(name):
+    # 通过ORM或未给出这些列的INSERT写入时，从content中提取，每行只解析一次
+    def default(context):
+        content = context.get_current_parameters().get("content")
+        cached = getattr(context, "_yawxt_payload", None)
+        if cached is None or cached[0] is not content:
+            cached = (content, extract_payload(content))
+            context._yawxt_payload = cached
+        return cached[1][name]
+    return default
+
+
 message_table = Table(
     "wechat_message", Base.metadata,
     Column('id', Integer, primary_key=True),
@@ -33,6 +139,19 @@ message_table = Table(
     Column("msg_type", String(50)),
     Column("create_time", Integer),
     Column("content", Text),
+    Column("direction", String(10)),
+    Column("text", Text, default=_payload_default("text")),
+    Column("media_id", String(128), default=_payload_default("media_id")),
+    Column("event_key", String(255), default=_payload_default("event_key")),
+    Column("pic_url", String(512), default=_payload_default("pic_url")),
+    Column("location_x", Float, default=_payload_default("location_x")),
+    Column("location_y", Float, default=_payload_default("location_y")),
+    Column("status", String(50), default=_payload_default("status")),
+    Index("ix_wechat_message_from_id_create_time", "from_id", "create_time"),
+    Index("ix_wechat_message_msg_id", "msg_id"),
+    Index("ix_wechat_message_msg_type_event_key", "msg_type", "event_key"),
+    Index("ix_wechat_message_media_id", "media_id"),
+    Index("ix_wechat_message_create_time", "create_time"),
 )
 
 user_table = Table(
@@ -52,7 +171,18 @@ user_table = Table(
     Column("remark", String(100)),
     Column("groupid", Integer),
     Column("tagid_list", String(100)),
-    Column("update_time", Integer, default=lambda: int(time.time()))
+    Column("update_time", Integer, default=lambda: int(time.time())),
+    Index("ux_wechat_user_openid", "openid", unique=True),
+    Index("ix_wechat_user_province_city_sex", "province", "city", "sex"),
+    Index("ix_wechat_user_subscribe_time", "subscribe_time"),
+    Index("ix_wechat_user_update_time", "update_time"),
+)
+
+user_tag_table = Table(
+    "wechat_user_tag", Base.metadata,
+    Column("openid", String(100), primary_key=True),
+    Column("tagid", Integer, primary_key=True, autoincrement=False),
+    Index("ix_wechat_user_tag_tagid_openid", "tagid", "openid"),
 )
 
 location_table = Table(
@@ -63,30 +193,153 @@ location_table = Table(
     Column("precision", Float),
     Column("create_time", Integer, default=lambda: int(time.time())),
     Column("openid", String(100)),
+    Column("geohash", String(12), default=_location_geohash),
+    Index("ix_wechat_location_openid_create_time", "openid", "create_time"),
+    Index("ix_wechat_location_geohash_create_time", "geohash", "create_time"),
+    Index("ix_wechat_location_create_time", "create_time"),
 )
 
-mapper(
-    Message, message_table,
-    properties=dict(
-        (key, getattr(message_table.c, key))
-        for key in Message.__availabe_keys__)
+latest_location_table = Table(
+    "wechat_latest_location", Base.metadata,
+    Column("openid", String(100), primary_key=True),
+    Column("latitude", Float),
+    Column("longitude", Float),
+    Column("precision", Float),
+    Column("create_time", Integer),
 )
 
-mapper(
-    User, user_table,
-    properties=dict(
-        (key, getattr(user_table.c, key))
-        for key in User.__availabe_keys__)
+keyword_table = Table(
+    "wechat_keyword", Base.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("keyword", String(255), nullable=False),
+    Column("match_type", String(20), default="exact"),
+    Column("priority", Integer, default=0),
+    Column("reply_type", String(20), default="text"),
+    Column("reply", Text),
+    Column("enabled", Integer, default=1),
 )
 
-mapper(
-    Location, location_table,
-    properties=dict(
-        (key, getattr(location_table.c, key))
-        for key in Location.__availabe_keys__)
+message_stats_table = Table(
+    "wechat_message_stats", Base.metadata,
+    Column("account", String(100), primary_key=True),
+    Column("bucket", Integer, primary_key=True, autoincrement=False),
+    Column("msg_type", String(50), primary_key=True),
+    Column("direction", String(10), primary_key=True),
+    Column("total", Integer, nullable=False, default=0),
+    Index("ix_wechat_message_stats_bucket", "bucket"),
 )
 
 
+class _Record(object):
+
+    @classmethod
+    def from_model(cls, obj):
+        '''从 :mod:`yawxt.models` 中的对象构造映射类的对象，已经是映射类的
+        对象时直接返回
+
+        :param obj: :class:`~yawxt.Message` , :class:`~yawxt.User` 或
+            :class:`~yawxt.Location` 对象
+        '''
+        if isinstance(obj, cls):
+            return obj
+        return cls(**dict((key, obj[key]) for key in obj))
+
+    def to_model(self):
+        '''转换为 :mod:`yawxt.models` 中不映射到数据库的对象'''
+        obj = self.__model__.__new__(self.__model__)
+        for key in self.__availabe_keys__:
+            setattr(obj, key, getattr(self, key))
+        return obj
+
+
+class MessageRecord(_Record, Message):
+    '''映射到 ``wechat_message`` 表的 :class:`~yawxt.Message` ，
+    :class:`PersistMessageHandler` 保存和查询消息时使用，需要单独保存时用
+    :meth:`from_model` 转换'''
+    __model__ = Message
+
+
+class UserRecord(_Record, User):
+    '''映射到 ``wechat_user`` 表的 :class:`~yawxt.User` ，
+    :attr:`PersistMessageHandler.user` 从数据库中查询时为此类的对象'''
+    __model__ = User
+
+    @classmethod
+    def from_model(cls, obj):
+        record = super(UserRecord, cls).from_model(obj)
+        if record is not obj:
+            record.update_time = obj.update_time
+        return record
+
+    def to_model(self):
+        user = super(UserRecord, self).to_model()
+        user.update_time = self.update_time
+        return user
+
+    def _set_tagid_list(self, value):
+        # 同时更新映射的字符串列和整型list
+        User._set_tagid_list(self, value)
+        self._tagid_list = User._get_tagid_list(self)
+
+    tagid_list = property(User._get_tagid_list, _set_tagid_list)
+
+
+class LocationRecord(_Record, Location):
+    '''映射到 ``wechat_location`` 表的 :class:`~yawxt.Location` '''
+    __model__ = Location
+
+
+mapper(MessageRecord, message_table)
+
+mapper(
+    UserRecord, user_table,
+    properties={
+        "_tagid_list": user_table.c.tagid_list,
+        "tagid_list": synonym(
+            "_tagid_list", descriptor=UserRecord.tagid_list),
+    })
+
+mapper(LocationRecord, location_table)
+
+
+# 兼容旧代码的 session.query(User) 和 User.openid ，下一个版本移除
+_RECORDS = dict(
+    (record.__model__, record)
+    for record in (MessageRecord, UserRecord, LocationRecord))
+
+
+def _deprecated_record(cls):
+    record = _RECORDS[cls]
+    warnings.warn(
+        "querying %s is deprecated, query %s instead" % (
+            cls.__name__, record.__name__),
+        DeprecationWarning, stacklevel=4)
+    return record
+
+
+@inspection._inspects(_ModelMeta)
+def _inspect_model(cls):
+    mapper = _inspect_mapped_class(cls)
+    if mapper is None and cls in _RECORDS:
+        return _inspect_mapped_class(_deprecated_record(cls))
+    return mapper
+
+
+def _model_column(cls, name, descriptor):
+    if cls in _RECORDS:
+        return getattr(_deprecated_record(cls), name)
+    return descriptor
+
+
+_ModelMeta._column_hook = staticmethod(_model_column)
+
+
+@event.listens_for(UserRecord, "load")
+@event.listens_for(UserRecord, "refresh")
+def _load_tagids(user, *args):
+    user._tagids = parse_tagids(user.__dict__.get("_tagid_list"))
+
+
 def create_all(bind):
     '''创建数据库及所有表
 
@@ -95,6 +348,1440 @@ def create_all(bind):
     Base.metadata.create_all(bind)
 
 
+def _dedupe_users(conn):
+    # MySQL不能在DELETE的子查询中直接读取同一个表（错误1093），
+    # 包装为派生表后会先物化
+    keep = (
+        select([func.max(user_table.c.id).label("id")])
+        .group_by(user_table.c.openid).alias("keep"))
+    return conn.execute(user_table.delete().where(
+        ~user_table.c.id.in_(select([keep.c.id])))).rowcount
+
+
+def _backfill_direction(bind, account_ids, batch_size):
+    c = message_table.c
+    last_id = bind.execute(select([func.max(c.id)])).scalar() or 0
+    count = 0
+    for start in range(0, last_id + 1, batch_size):
+        window = c.id.between(start, start + batch_size - 1)
+        with bind.begin() as conn:
+            for direction, cond in (
+                    (REPLY, c.from_id.in_(account_ids)),
+                    (INBOUND, ~c.from_id.in_(account_ids))):
+                count += conn.execute(
+                    message_table.update()
+                    .where(window & c.direction.is_(None) & cond)
+                    .values(direction=direction)).rowcount
+    return count
+
+
+def _add_columns(bind, inspector, table, name):
+    actions = []
+    columns = set(c["name"] for c in inspector.get_columns(name))
+    preparer = bind.dialect.identifier_preparer
+    for column in table.columns:
+        if column.name in columns:
+            continue
+        with bind.begin() as conn:
+            conn.exec_driver_sql("ALTER TABLE %s ADD COLUMN %s %s" % (
+                preparer.quote(name), preparer.format_column(column),
+                column.type.compile(dialect=bind.dialect)))
+        actions.append("add column %s.%s" % (name, column.name))
+    return actions
+
+
+def migrate(bind, account_ids=None, dedupe_users=False, batch_size=10000):
+    '''把已有数据库升级到当前的表结构，可以重复执行：
+
+    #. 创建缺少的表
+    #. 添加缺少的列，如 ``wechat_message.direction``
+    #. 创建缺少的索引，postgresql使用 ``CREATE INDEX CONCURRENTLY`` ，
+       不会锁表
+    #. 给出 ``account_ids`` 时，按批填充已有消息的 ``direction``
+    #. 新创建 ``wechat_user_tag`` 表时，从 ``wechat_user.tagid_list`` 生成
+    #. 新添加 ``wechat_location.geohash`` 列时，按批填充已有位置的geohash
+    #. 新添加 ``wechat_message.text`` 等列时，按批填充已有消息的
+       :func:`extract_payload` 字段
+
+    按月分表的月表只添加缺少的列。
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :param account_ids: 公众号原始ID（消息的ToUserName）列表，
+        从这些ID发出的消息为回复的消息
+    :param dedupe_users: ``wechat_user`` 表中openid重复时，是否只保留id最大
+        的一条，否则创建唯一索引会失败
+    :param batch_size: 填充 ``direction`` 时每个事务更新的行数
+    :returns: 执行的操作说明列表
+    '''
+    actions = []
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    Base.metadata.create_all(bind)
+    concurrently = bind.dialect.name == "postgresql"
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            actions.append("create table %s" % table.name)
+            if table is latest_location_table and (
+                    location_table.name in existing_tables):
+                actions.append("rebuild %d latest locations" % (
+                    rebuild_latest_locations(bind)))
+            if table is user_tag_table and (
+                    user_table.name in existing_tables):
+                actions.append("rebuild tags of %d users" % (
+                    rebuild_user_tags(bind, batch_size)))
+            continue
+        actions.extend(_add_columns(bind, inspector, table, table.name))
+        # MonthlyPartitions创建的月表
+        pattern = re.compile(r"^%s_\d{6}$" % re.escape(table.name))
+        for name in existing_tables:
+            if pattern.match(name):
+                actions.extend(_add_columns(bind, inspector, table, name))
+        indexes = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in indexes:
+                continue
+            if index.unique and table is user_table and dedupe_users:
+                with bind.begin() as conn:
+                    actions.append(
+                        "delete %d duplicated users" % _dedupe_users(conn))
+            if concurrently:
+                ddl = str(CreateIndex(index).compile(dialect=bind.dialect))
+                with bind.connect() as conn:
+                    conn.execution_options(
+                        isolation_level="AUTOCOMMIT").exec_driver_sql(
+                            ddl.replace("INDEX", "INDEX CONCURRENTLY", 1))
+            else:
+                index.create(bind)
+            actions.append("create index %s" % index.name)
+    if "add column %s.geohash" % location_table.name in actions:
+        actions.append("set geohash of %d locations" % (
+            backfill_geohash(bind, batch_size)))
+    if "add column %s.text" % message_table.name in actions:
+        actions.append("set payload of %d messages" % (
+            backfill_payload(bind, batch_size)))
+    if account_ids:
+        actions.append("set direction of %d messages" % (
+            _backfill_direction(bind, list(account_ids), batch_size)))
+    for action in actions:
+        logger.info("migrate: %s", action)
+    return actions
+
+
+def load_keyword_rules(bind):
+    '''从 ``wechat_keyword`` 表加载启用的关键词规则，用于
+    :meth:`~yawxt.keywords.KeywordEngine.load` ，例如
+
+    .. code-block:: python
+
+        engine.load(load_keyword_rules(engine))
+
+    :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session`` 对象
+    :rtype: list
+    '''
+    rows = bind.execute(
+        keyword_table.select()
+        .where(keyword_table.c.enabled != 0)
+        .order_by(keyword_table.c.id))
+    return [
+        rule_from_dict({
+            "keyword": row.keyword, "match": row.match_type,
+            "priority": row.priority, "reply_type": row.reply_type,
+            "reply": row.reply})
+        for row in rows]
+
+
+def load_event_log(bind, reader, batch_size=10000):
+    '''把事件日志中的消息批量导入 ``wechat_message`` 表，每批消息一条
+    ``INSERT`` 语句
+
+    .. code-block:: python
+
+        load_event_log(engine, EventLogReader("/var/log/wechat"))
+
+    :param bind: sqlalchemy ``Engine`` 或 ``Connection`` 对象
+    :param reader: :class:`~yawxt.eventlog.EventLogReader` 对象，或其他
+        :class:`~yawxt.Message` 对象的迭代器
+    :param batch_size: 每批导入的消息数
+    :returns: 导入的消息数
+    '''
+    insert = message_table.insert()
+    count = 0
+    batch = []
+    for message in reader:
+        batch.append(_message_row(message))
+        if len(batch) >= batch_size:
+            bind.execute(insert, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        bind.execute(insert, batch)
+        count += len(batch)
+    return count
+
+
+def _dialect(bind):
+    if hasattr(bind, "get_bind"):
+        bind = bind.get_bind()
+    return bind.dialect
+
+
+def _coalesce_columns(new):
+    # 微信返回的用户信息可能不完整（如取消关注时），空值不覆盖已有的值
+    values = dict(
+        (key, func.coalesce(new[key], user_table.c[key]))
+        for key in User.__availabe_keys__ if key != "openid")
+    values["update_time"] = new["update_time"]
+    return values
+
+
+def _upsert_statement(dialect):
+    name = dialect.name
+    if name == "sqlite":
+        import sqlite3
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            return None
+        from sqlalchemy.dialects.sqlite import insert
+    elif name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(user_table)
+        return stmt.on_duplicate_key_update(
+            **_coalesce_columns(stmt.inserted))
+    else:
+        return None
+    stmt = insert(user_table)
+    return stmt.on_conflict_do_update(
+        index_elements=[user_table.c.openid],
+        set_=_coalesce_columns(stmt.excluded))
+
+
+_upsert_statements = {}
+
+
+def _upsert_fallback(bind, rows):
+    c = user_table.c
+    for row in rows:
+        update = (
+            user_table.update().where(c.openid == row["openid"])
+            .values(**dict((k, v) for k, v in row.items() if v is not None)))
+        if bind.execute(update).rowcount:
+            continue
+        try:
+            bind.execute(user_table.insert().values(**row))
+        except IntegrityError:
+            # 其他进程同时插入了同一个用户
+            bind.execute(update)
+
+
+def upsert_users(bind, users, update_time=None, batch_size=1000):
+    '''插入或更新用户信息，每批用户一条语句，并发写入同一个用户时也不会
+    产生重复的行。sqlite和postgresql使用 ``INSERT ... ON CONFLICT`` ，
+    mysql使用 ``INSERT ... ON DUPLICATE KEY UPDATE`` ，其他数据库逐个
+    ``UPDATE`` ，不存在时再 ``INSERT`` 。用户信息中为 ``None`` 的字段不会
+    覆盖数据库中已有的值。
+
+    需要 ``wechat_user.openid`` 的唯一索引，已有的数据库请先执行 :func:`migrate`
+
+    :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session`` 对象，
+        使用 ``Session`` 时在其事务中执行，需要调用者提交
+    :param users: :class:`~yawxt.User` 对象或 ``dict`` 的列表
+    :param update_time: 更新时间，默认为当前时间
+    :param batch_size: 每条语句的最多用户数
+    :returns: 写入的用户数
+    '''
+    if update_time is None:
+        update_time = int(time.time())
+    rows = []
+    for user in users:
+        if isinstance(user, dict):
+            user = User(dict(user))
+        row = dict(
+            (key, getattr(user, key, None))
+            for key in User.__availabe_keys__)
+        row["update_time"] = update_time
+        rows.append(row)
+
+    dialect = _dialect(bind)
+    if dialect.name not in _upsert_statements:
+        _upsert_statements[dialect.name] = _upsert_statement(dialect)
+    stmt = _upsert_statements[dialect.name]
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        if stmt is None:
+            _upsert_fallback(bind, batch)
+        else:
+            bind.execute(stmt, batch)
+        sync_user_tags(bind, batch)
+    return len(rows)
+
+
+def sync_user_tags(bind, users):
+    '''把用户的 ``tagid_list`` 同步到 ``wechat_user_tag`` 表，
+    :func:`upsert_users` 写入用户时自动执行。 ``tagid_list`` 为 ``None``
+    的用户不修改
+
+    :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session`` 对象
+    :param users: :class:`~yawxt.User` 对象或 ``dict`` 的列表
+    :returns: 同步的用户数
+    '''
+    tags = {}
+    for user in users:
+        tagids = parse_tagids(user["tagid_list"])
+        if tagids is not None:
+            tags[user["openid"]] = set(tagids)
+    if not tags:
+        return 0
+    c = user_tag_table.c
+    bind.execute(user_tag_table.delete().where(c.openid.in_(list(tags))))
+    rows = [
+        {"openid": openid, "tagid": tagid}
+        for openid, tagids in tags.items() for tagid in sorted(tagids)]
+    if rows:
+        bind.execute(user_tag_table.insert(), rows)
+    return len(tags)
+
+
+def rebuild_user_tags(bind, batch_size=10000):
+    '''从 ``wechat_user.tagid_list`` 重新生成 ``wechat_user_tag`` ，
+    新表由 :func:`migrate` 创建时自动执行
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :param batch_size: 每个事务处理的用户数
+    :returns: 用户数
+    '''
+    c = user_table.c
+    count = 0
+    last_id = 0
+    bind.execute(user_tag_table.delete())
+    while True:
+        rows = bind.execute(
+            select([c.id, c.openid, c.tagid_list])
+            .where((c.id > last_id) & c.tagid_list.isnot(None))
+            .order_by(c.id).limit(batch_size)).fetchall()
+        if not rows:
+            return count
+        with bind.begin() as conn:
+            count += sync_user_tags(conn, [row._mapping for row in rows])
+        last_id = rows[-1].id
+
+
+def user_tags(bind, openid):
+    '''用户的标签id，按主键查询 ``wechat_user_tag``
+
+    :rtype: list of int
+    '''
+    c = user_tag_table.c
+    return [row.tagid for row in bind.execute(
+        select([c.tagid]).where(c.openid == openid).order_by(c.tagid))]
+
+
+def tag_members(bind, tagid):
+    '''有某个标签的用户，使用 ``(tagid, openid)`` 索引
+
+    :rtype: list of openid
+    '''
+    c = user_tag_table.c
+    return [row.openid for row in bind.execute(
+        select([c.openid]).where(c.tagid == tagid).order_by(c.openid))]
+
+
+def tag_intersection(bind, tagids):
+    '''同时有多个标签的用户
+
+    :param tagids: 标签id列表
+    :rtype: list of openid
+    '''
+    tagids = set(tagids)
+    if not tagids:
+        return []
+    c = user_tag_table.c
+    return [row.openid for row in bind.execute(
+        select([c.openid]).where(c.tagid.in_(tagids))
+        .group_by(c.openid)
+        .having(func.count() == len(tagids))
+        .order_by(c.openid))]
+
+
+def tag_counts(bind, tagids=None):
+    '''每个标签的用户数
+
+    :param tagids: 只统计这些标签，默认为全部标签
+    :returns: ``tagid -> 用户数`` 的 ``dict``
+    '''
+    c = user_tag_table.c
+    query = select([c.tagid, func.count()]).group_by(c.tagid)
+    if tagids is not None:
+        query = query.where(c.tagid.in_(list(tagids)))
+    return dict((tagid, count) for tagid, count in bind.execute(query))
+
+
+def _latest_location_statement(dialect):
+    name = dialect.name
+    c = latest_location_table.c
+    if name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(latest_location_table)
+        return stmt.on_duplicate_key_update(
+            latitude=stmt.inserted.latitude,
+            longitude=stmt.inserted.longitude,
+            precision=stmt.inserted.precision,
+            create_time=stmt.inserted.create_time)
+    if name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif name == "sqlite":
+        import sqlite3
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            return None
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(latest_location_table)
+    return stmt.on_conflict_do_update(
+        index_elements=[c.openid],
+        set_=dict(
+            latitude=stmt.excluded.latitude,
+            longitude=stmt.excluded.longitude,
+            precision=stmt.excluded.precision,
+            create_time=stmt.excluded.create_time),
+        where=c.create_time <= stmt.excluded.create_time)
+
+
+_latest_location_statements = {}
+
+
+def save_latest_location(bind, location):
+    '''更新用户最新的地理位置，比已保存的位置旧时不更新
+
+    :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session`` 对象
+    :param location: :class:`~yawxt.Location` 对象
+    '''
+    _save_latest_rows(bind, [_location_row(location)])
+
+
+def _save_latest_rows(bind, rows):
+    latest = OrderedDict()
+    for row in rows:
+        old = latest.get(row["openid"])
+        if old is None or old["create_time"] <= row["create_time"]:
+            latest[row["openid"]] = row
+    dialect = _dialect(bind)
+    if dialect.name not in _latest_location_statements:
+        _latest_location_statements[dialect.name] = (
+            _latest_location_statement(dialect))
+    stmt = _latest_location_statements[dialect.name]
+    if stmt is not None:
+        bind.execute(stmt, list(latest.values()))
+        return
+    for row in latest.values():
+        _save_latest_row(bind, row)
+
+
+def _save_latest_row(bind, row):
+    c = latest_location_table.c
+    update = (
+        latest_location_table.update()
+        .where((c.openid == row["openid"]) &
+               (c.create_time <= row["create_time"]))
+        .values(**row))
+    if bind.execute(update).rowcount:
+        return
+    try:
+        bind.execute(latest_location_table.insert().values(**row))
+    except IntegrityError:
+        # 已有更新的位置，或其他进程同时插入
+        bind.execute(update)
+
+
+def rebuild_latest_locations(bind):
+    '''从 ``wechat_location`` 重新生成 ``wechat_latest_location`` ，
+    用于已有数据的初始化，新表由 :func:`migrate` 创建时自动执行
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :returns: 用户数
+    '''
+    c = location_table.c
+    latest_ids = select([func.max(c.id)]).group_by(c.openid)
+    columns = ["openid", "latitude", "longitude", "precision", "create_time"]
+    with bind.begin() as conn:
+        conn.execute(latest_location_table.delete())
+        return conn.execute(
+            latest_location_table.insert().from_select(
+                columns,
+                select([c[name] for name in columns])
+                .where(c.id.in_(latest_ids)))).rowcount
+
+
+def _stats_key(message):
+    if not isinstance(message, dict):
+        message = dict(
+            (key, getattr(message, key)) for key in Message.__availabe_keys__)
+    direction = message.get("direction") or INBOUND
+    account = message["from_id" if direction == REPLY else "to_id"]
+    create_time = message.get("create_time") or int(time.time())
+    return (account or "", create_time - create_time % 3600,
+            message["msg_type"], direction)
+
+
+def _stats_statement(dialect):
+    c = message_stats_table.c
+    name = dialect.name
+    if name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(message_stats_table)
+        return stmt.on_duplicate_key_update(
+            total=c.total + stmt.inserted.total)
+    if name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif name == "sqlite":
+        import sqlite3
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            return None
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    stmt = insert(message_stats_table)
+    return stmt.on_conflict_do_update(
+        index_elements=[c.account, c.bucket, c.msg_type, c.direction],
+        set_=dict(total=c.total + stmt.excluded.total))
+
+
+_stats_statements = {}
+
+
+def _add_stats(bind, counts):
+    rows = [
+        {"account": account, "bucket": bucket, "msg_type": msg_type,
+         "direction": direction, "total": total}
+        for (account, bucket, msg_type, direction), total
+        in sorted(counts.items())]
+    if not rows:
+        return
+    dialect = _dialect(bind)
+    if dialect.name not in _stats_statements:
+        _stats_statements[dialect.name] = _stats_statement(dialect)
+    stmt = _stats_statements[dialect.name]
+    if stmt is not None:
+        bind.execute(stmt, rows)
+        return
+    c = message_stats_table.c
+    for row in rows:
+        update = (
+            message_stats_table.update()
+            .where((c.account == row["account"]) &
+                   (c.bucket == row["bucket"]) &
+                   (c.msg_type == row["msg_type"]) &
+                   (c.direction == row["direction"]))
+            .values(total=c.total + row["total"]))
+        if bind.execute(update).rowcount:
+            continue
+        try:
+            bind.execute(message_stats_table.insert().values(**row))
+        except IntegrityError:
+            bind.execute(update)
+
+
+def update_message_stats(bind, messages):
+    '''把消息计入 ``wechat_message_stats`` 表，按公众号、小时、消息类型和
+    方向累加消息数，同一批消息合并为一条语句
+
+    :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session`` 对象，
+        在其事务中执行
+    :param messages: :class:`~yawxt.Message` 对象或列名到值的 ``dict`` 列表
+    '''
+    counts = {}
+    for message in messages:
+        key = _stats_key(message)
+        counts[key] = counts.get(key, 0) + 1
+    _add_stats(bind, counts)
+
+
+def rebuild_message_stats(bind, since=None, until=None, table=message_table,
+                          batch_size=100000):
+    '''从消息表重新统计 ``[since, until)`` 范围内的整小时，替换
+    ``wechat_message_stats`` 中这些小时已有的统计，可以重复执行。用于已有
+    数据的初始化，或者修正写入失败造成的误差
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :param since: 开始时间戳，向下取整到小时，默认为最早的消息
+    :param until: 结束时间戳，向下取整到小时，默认为当前小时的开始，
+        即不重新统计当前小时
+    :param table: 消息表，可以是按月分表的月表
+    :param batch_size: 每批统计的消息id范围
+    :returns: 统计的消息数
+    '''
+    c = table.c
+    s = message_stats_table.c
+    if until is None:
+        until = time.time()
+    until = int(until) - int(until) % 3600
+    cond = c.create_time < until
+    stats_cond = s.bucket < until
+    if since is not None:
+        since = int(since) - int(since) % 3600
+        cond = cond & (c.create_time >= since)
+        stats_cond = stats_cond & (s.bucket >= since)
+    if table is not message_table:
+        # 月表只替换该月的统计
+        low, high = bind.execute(
+            select([func.min(c.create_time), func.max(c.create_time)])
+            .where(cond)).first()
+        if low is None:
+            return 0
+        stats_cond = stats_cond & s.bucket.between(
+            low - low % 3600, high - high % 3600)
+    direction = func.coalesce(c.direction, INBOUND)
+    account = case(
+        [(c.direction == REPLY, c.from_id)], else_=c.to_id)
+    bucket = c.create_time - c.create_time % 3600
+    low, high = bind.execute(
+        select([func.min(c.id), func.max(c.id)]).where(cond)).first()
+    with bind.begin() as conn:
+        conn.execute(message_stats_table.delete().where(stats_cond))
+    if low is None:
+        return 0
+    count = 0
+    for start in range(low, high + 1, batch_size):
+        window = c.id.between(start, start + batch_size - 1) & cond
+        counts = {}
+        for row in bind.execute(
+                select([account, bucket, c.msg_type, direction, func.count()])
+                .where(window)
+                .group_by(account, bucket, c.msg_type, direction)):
+            counts[(row[0] or "", row[1], row[2], row[3])] = row[4]
+            count += row[4]
+        with bind.begin() as conn:
+            _add_stats(conn, counts)
+    return count
+
+
+def _stats_bucket(interval, utc_offset):
+    bucket = message_stats_table.c.bucket
+    if interval == "hour":
+        return bucket
+    if interval == "day":
+        return bucket - (bucket + utc_offset) % 86400
+    raise ValueError("interval must be 'hour' or 'day': %r" % interval)
+
+
+def message_stats(bind, since, until, interval="day", account=None,
+                  msg_types=None, direction=INBOUND, utc_offset=28800):
+    '''按时间段和消息类型统计消息数，只查询 ``wechat_message_stats`` 表
+
+    .. code-block:: python
+
+        # 最近7天每天各类型的接收消息数
+        for day, msg_type, total in message_stats(
+                engine, time.time() - 7 * 86400, time.time()):
+            ...
+
+    :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session`` 对象
+    :param since: 开始时间戳，按小时统计，包含此时间所在的小时
+    :param until: 结束时间戳，不包含此时间之后开始的小时
+    :param interval: ``"day"`` 或 ``"hour"``
+    :param account: 公众号原始ID，默认为全部公众号
+    :param msg_types: 消息类型列表，默认为全部类型
+    :param direction: :data:`~yawxt.models.INBOUND` 或
+        :data:`~yawxt.models.REPLY` ，为 ``None`` 时统计全部消息
+    :param utc_offset: 按天统计时的时区，与UTC相差的秒数，默认为北京时间
+    :returns: ``(时间段开始的时间戳, 消息类型, 消息数)`` 的列表，按时间段和
+        消息类型排列
+    '''
+    s = message_stats_table.c
+    bucket = _stats_bucket(interval, utc_offset).label("period")
+    cond = (s.bucket >= int(since) - int(since) % 3600) & (s.bucket < until)
+    if account is not None:
+        cond = cond & (s.account == account)
+    if msg_types is not None:
+        cond = cond & s.msg_type.in_(list(msg_types))
+    if direction is not None:
+        cond = cond & (s.direction == direction)
+    rows = bind.execute(
+        select([bucket, s.msg_type, func.sum(s.total)])
+        .where(cond).group_by(bucket, s.msg_type)
+        .order_by(bucket, s.msg_type))
+    return [(row[0], row[1], int(row[2])) for row in rows]
+
+
+def subscribe_stats(bind, since, until, interval="day", account=None,
+                    utc_offset=28800):
+    '''按时间段统计关注和取消关注的人次，参数见 :func:`message_stats`
+
+    :returns: ``(时间段开始的时间戳, 关注数, 取消关注数)`` 的列表，按时间段
+        排列
+    '''
+    periods = OrderedDict()
+    for period, msg_type, total in message_stats(
+            bind, since, until, interval, account,
+            ["event_subscribe", "event_unsubscribe"], INBOUND, utc_offset):
+        counts = periods.setdefault(period, [0, 0])
+        counts[msg_type == "event_unsubscribe"] += total
+    return [(period, sub, unsub) for period, (sub, unsub) in periods.items()]
+
+
+def _source_tables(table, partitions, since=None, until=None):
+    # 启用分表前的数据仍在原表中，原表在前，月表按月份排列
+    tables = [table]
+    if partitions is not None and table in partitions:
+        tables.extend(partitions.month_tables(table, since, until))
+    return tables
+
+
+def _purge_downsampled(conn, table, window, keep_every, last_buckets):
+    c = table.c
+    rows = conn.execute(
+        select([c.id, c.openid, c.create_time])
+        .where(window).order_by(c.id))
+    ids = []
+    for id, openid, create_time in rows:
+        bucket = create_time - create_time % keep_every
+        if last_buckets.get(openid) == bucket:
+            ids.append(id)
+        else:
+            last_buckets[openid] = bucket
+    count = 0
+    for start in range(0, len(ids), 500):
+        count += conn.execute(
+            table.delete()
+            .where(c.id.in_(ids[start:start + 500]))).rowcount
+    return count
+
+
+def purge_locations(bind, before, keep_every=None, messages=True,
+                    batch_size=10000, partitions=None):
+    '''清理旧的地理位置，按id范围分批删除，每批一个事务，不会长时间锁表
+
+    .. code-block:: python
+
+        # 30天前的位置每个用户每小时只保留一个，地理位置事件消息全部删除
+        purge_locations(engine, time.time() - 30 * 86400, keep_every=3600)
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :param before: 时间戳， ``create_time`` 早于此时间的数据会被清理
+    :param keep_every: 降采样的间隔秒数，每个用户每个间隔内只保留最早的
+        一个位置；为 ``None`` 时删除全部旧位置
+    :param messages: 是否同时删除 ``wechat_message`` 表中的旧地理位置事件
+    :param batch_size: 每批处理的id范围
+    :param partitions: :class:`~yawxt.partition.MonthlyPartitions` 对象，
+        设置后同时清理 ``before`` 之前的月表
+    :returns: ``dict`` ， ``locations`` 和 ``messages`` 分别为删除的行数
+    '''
+    deleted = {"locations": 0, "messages": 0}
+    targets = [("locations", location_table, False)]
+    if messages:
+        targets.append(("messages", message_table, True))
+    for key, source, location_events in targets:
+        # 按时间顺序处理各表，降采样的间隔可以跨越月表
+        last_buckets = {}
+        for table in _source_tables(source, partitions, until=before):
+            c = table.c
+            old = c.create_time < before
+            if location_events:
+                old = old & (c.msg_type == "event_LOCATION")
+            low, high = bind.execute(
+                select([func.min(c.id), func.max(c.id)]).where(old)).first()
+            if low is None:
+                continue
+            for start in range(low, high + 1, batch_size):
+                window = c.id.between(start, start + batch_size - 1) & old
+                with bind.begin() as conn:
+                    if source is location_table and keep_every:
+                        deleted[key] += _purge_downsampled(
+                            conn, table, window, keep_every, last_buckets)
+                    else:
+                        deleted[key] += conn.execute(
+                            table.delete().where(window)).rowcount
+    logger.info("purge locations before %s: %s", before, deleted)
+    return deleted
+
+
+def backfill_payload(bind, batch_size=10000, raw_content=True,
+                     table=message_table, partitions=None):
+    '''按id范围分批从已有消息的 ``content`` 中取出 :func:`extract_payload`
+    的字段，新添加这些列时由 :func:`migrate` 自动执行
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :param batch_size: 每个事务处理的id范围
+    :param raw_content: 为 ``False`` 时同时清空已处理消息的 ``content`` ，
+        没有取出的其他字段（如 ``Ticket`` , ``Label`` ）会丢失
+    :param table: 消息表，可以是按月分表的月表
+    :param partitions: :class:`~yawxt.partition.MonthlyPartitions` 对象，
+        设置后同时填充 ``table`` 的全部月表
+    :returns: 填充的行数
+    '''
+    return sum(
+        _backfill_payload(bind, batch_size, raw_content, source)
+        for source in _source_tables(table, partitions))
+
+
+def _backfill_payload(bind, batch_size, raw_content, table):
+    c = table.c
+    names = [name for name, _, _ in _PAYLOAD_FIELDS]
+    empty = c.content.isnot(None)
+    for name in names:
+        empty = empty & c[name].is_(None)
+    values = dict((name, bindparam("_" + name)) for name in names)
+    if not raw_content:
+        values["content"] = None
+    update = table.update().where(c.id == bindparam("_id")).values(**values)
+    last_id = bind.execute(select([func.max(c.id)])).scalar() or 0
+    count = 0
+    for start in range(0, last_id + 1, batch_size):
+        with bind.begin() as conn:
+            rows = []
+            for id, content in conn.execute(
+                    select([c.id, c.content])
+                    .where(c.id.between(start, start + batch_size - 1) &
+                           empty)):
+                payload = extract_payload(content)
+                if raw_content and not any(
+                        v is not None for v in payload.values()):
+                    continue
+                row = dict(("_" + k, v) for k, v in payload.items())
+                row["_id"] = id
+                rows.append(row)
+            if rows:
+                conn.execute(update, rows)
+                count += len(rows)
+    return count
+
+
+def backfill_geohash(bind, batch_size=10000, partitions=None):
+    '''按id范围分批填充 ``wechat_location`` 中没有geohash的位置，
+    新添加列时由 :func:`migrate` 自动执行
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :param batch_size: 每个事务处理的id范围
+    :param partitions: :class:`~yawxt.partition.MonthlyPartitions` 对象，
+        设置后同时填充全部月表
+    :returns: 填充的行数
+    '''
+    return sum(
+        _backfill_geohash(bind, batch_size, table)
+        for table in _source_tables(location_table, partitions))
+
+
+def _backfill_geohash(bind, batch_size, table):
+    c = table.c
+    last_id = bind.execute(select([func.max(c.id)])).scalar() or 0
+    update = (
+        table.update()
+        .where(c.id == bindparam("_id"))
+        .values(geohash=bindparam("_geohash")))
+    count = 0
+    for start in range(0, last_id + 1, batch_size):
+        with bind.begin() as conn:
+            rows = [
+                {"_id": id, "_geohash": encode_geohash(latitude, longitude)}
+                for id, latitude, longitude in conn.execute(
+                    select([c.id, c.latitude, c.longitude])
+                    .where(c.id.between(start, start + batch_size - 1) &
+                           c.geohash.is_(None) &
+                           c.latitude.isnot(None) &
+                           c.longitude.isnot(None)))]
+            if rows:
+                conn.execute(update, rows)
+                count += len(rows)
+    return count
+
+
+def _locations_in_box(bind, box, since, until, max_cells, partitions):
+    min_lat, min_lon, max_lat, max_lon = box
+    prefixes = geohash_cover(min_lat, min_lon, max_lat, max_lon, max_cells)
+    for table in _source_tables(location_table, partitions, since, until):
+        c = table.c
+        # geohash前缀范围可以使用索引，"~" 大于geohash的所有字符
+        cells = [
+            (c.geohash >= prefix) & (c.geohash < prefix + "~")
+            for prefix in prefixes]
+        cond = or_(*cells) & c.latitude.between(min_lat, max_lat) & (
+            c.longitude.between(min_lon, max_lon))
+        if since is not None:
+            cond = cond & (c.create_time >= since)
+        if until is not None:
+            cond = cond & (c.create_time < until)
+        for row in bind.execute(
+                select([c.openid, c.latitude, c.longitude]).where(cond)):
+            yield row
+
+
+def users_near(bind, latitude, longitude, radius, since=None, until=None,
+               max_cells=16, partitions=None):
+    '''在时间范围内上报过距离某点 ``radius`` 米以内位置的用户，先按
+    geohash前缀使用索引筛选，再计算精确距离
+
+    .. code-block:: python
+
+        # 最近一小时在门店2公里内的用户
+        users = users_near(engine, 39.9, 116.4, 2000, since=time.time() - 3600)
+
+    :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session`` 对象
+    :param latitude: 中心点纬度
+    :param longitude: 中心点经度
+    :param radius: 半径，单位为米
+    :param since: 开始时间戳，包含此时间，为 ``None`` 时不限制
+    :param until: 结束时间戳，不包含此时间，为 ``None`` 时不限制
+    :param max_cells: 最多使用的geohash前缀数
+    :param partitions: :class:`~yawxt.partition.MonthlyPartitions` 对象，
+        设置后同时查询时间范围内的月表
+    :returns: ``(openid, 距离)`` 的列表，每个用户使用最近的位置，
+        按距离从近到远排列
+    '''
+    box = bounding_box(latitude, longitude, radius)
+    nearest = {}
+    for openid, lat, lon in _locations_in_box(
+            bind, box, since, until, max_cells, partitions):
+        distance = haversine(latitude, longitude, lat, lon)
+        if distance <= radius and distance < nearest.get(openid, radius + 1):
+            nearest[openid] = distance
+    return sorted(nearest.items(), key=lambda item: item[1])
+
+
+def users_in_bbox(bind, min_lat, min_lon, max_lat, max_lon, since=None,
+                  until=None, max_cells=16, partitions=None):
+    '''在时间范围内上报过经纬度范围内位置的用户，参数见 :func:`users_near` ，
+    经纬度范围不能跨越180度经线
+
+    :returns: openid的集合
+    :rtype: set
+    '''
+    return set(
+        row[0] for row in _locations_in_box(
+            bind, (min_lat, min_lon, max_lat, max_lon), since, until,
+            max_cells, partitions))
+
+
+def _message_row(message, raw_content=True):
+    row = dict(
+        (key, getattr(message, key)) for key in Message.__availabe_keys__)
+    row.update(extract_payload(message.content))
+    if not raw_content:
+        row["content"] = None
+    return row
+
+
+def _location_row(location):
+    return dict(
+        (key, getattr(location, key)) for key in Location.__availabe_keys__)
+
+
+def _insert(bind, table, rows, partitions=None):
+    if partitions is not None and table in partitions:
+        partitions.insert(bind, table, rows)
+    else:
+        bind.execute(table.insert(), rows)
+
+
+class WriteBehindBuffer(object):
+    '''消息和地理位置的延迟批量写入缓冲区
+
+    :class:`PersistMessageHandler` 设置 ``write_behind`` 后，接收的消息、
+    回复的消息和地理位置只放入缓冲区，回复消息不再等待数据库提交；后台线程
+    每 ``batch_size`` 条或每 ``flush_interval`` 秒在一个事务中批量插入。
+    进程正常退出时自动写入缓冲区中剩余的数据。
+
+    .. code-block:: python
+
+        buffer = WriteBehindBuffer(engine)
+        dispatcher = Dispatcher(
+            PersistMessageHandler, client,
+            db_session_maker=Session, write_behind=buffer)
+
+    :param bind: sqlalchemy ``Engine`` 对象
+    :param max_size: 缓冲区最多保存的行数，缓冲区满时写入方阻塞等待
+    :param batch_size: 每个事务最多插入的行数
+    :param flush_interval: 缓冲区中的数据最多等待的秒数
+    :param max_retries: 写入失败时的重试次数，仍然失败时丢弃该批数据
+    :param partitions: :class:`~yawxt.partition.MonthlyPartitions` 对象，
+        设置后消息和地理位置写入对应的月表
+    :param message_stats: 是否在同一个事务中把写入的消息计入
+        ``wechat_message_stats`` ，见 :func:`update_message_stats`
+    '''
+
+    def __init__(self, bind, max_size=10000, batch_size=500,
+                 flush_interval=1.0, max_retries=3, partitions=None,
+                 message_stats=False):
+        self.bind = bind
+        self.partitions = partitions
+        self.message_stats = message_stats
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.flushed = 0
+        self.dropped = 0
+        self._queue = Queue(max_size)
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="yawxt-write-behind")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, table, row):
+        '''放入一行数据
+
+        :param table: sqlalchemy ``Table`` 对象
+        :param row: 列名到值的 ``dict``
+        '''
+        if self._closed:
+            raise ValueError("write behind buffer is closed")
+        self._queue.put((table, row))
+
+    def add_message(self, message):
+        '''放入一条 :class:`~yawxt.Message` '''
+        self.put(message_table, _message_row(message))
+
+    def add_location(self, location, history=True):
+        '''放入一条 :class:`~yawxt.Location` ，同时更新用户最新的地理位置
+
+        :param history: 是否写入 ``wechat_location`` ，为 ``False`` 时只更新
+            ``wechat_latest_location``
+        '''
+        row = _location_row(location)
+        if history:
+            self.put(location_table, row)
+        self.put(latest_location_table, row)
+
+    def _run(self):
+        queue = self._queue
+        stop = False
+        while not stop:
+            try:
+                item = queue.get(timeout=self.flush_interval)
+            except Empty:
+                continue
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = queue.get(timeout=max(deadline - time.time(), 0))
+                except Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + stop):
+                queue.task_done()
+
+    def _write(self, batch):
+        tables = OrderedDict()
+        for table, row in batch:
+            tables.setdefault(table, []).append(row)
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.bind.begin() as conn:
+                    for table, rows in tables.items():
+                        if table is latest_location_table:
+                            _save_latest_rows(conn, rows)
+                        else:
+                            _insert(conn, table, rows, self.partitions)
+                    if self.message_stats and message_table in tables:
+                        update_message_stats(conn, tables[message_table])
+            except Exception:
+                logger.exception(
+                    "write %d rows failed, attempt %d", len(batch), attempt)
+                time.sleep(min(0.1 * 2 ** attempt, 5))
+            else:
+                self.flushed += len(batch)
+                return
+        self.dropped += len(batch)
+        logger.error("dropped %d rows after %d retries",
+                     len(batch), self.max_retries)
+
+    def flush(self):
+        '''等待缓冲区中已有的数据全部写入'''
+        self._queue.join()
+
+    def close(self):
+        '''写入缓冲区中的全部数据并停止后台线程'''
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+
+class _LRUCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get(self, key, valid=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and (valid is None or valid(entry)):
+                self._data[key] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def _put(self, key, entry):
+        with self._lock:
+            self._put_locked(key, entry)
+
+    def _put_locked(self, key, entry):
+        self._data.pop(key, None)
+        self._data[key] = entry
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, openid=None):
+        '''移除一个用户的缓存， ``openid`` 为 ``None`` 时清空缓存'''
+        with self._lock:
+            if openid is None:
+                self._data.clear()
+            else:
+                self._data.pop(openid, None)
+
+
+class UserCache(_LRUCache):
+    '''有上限的用户信息缓存，保存 ``openid -> (用户信息快照, update_time)`` ，
+    最久未使用的用户先被移出。设置为 :class:`PersistMessageHandler` 的
+    ``user_cache`` 后，用户信息未过期时不再查询数据库。
+
+    缓存只在当前进程中有效，多个进程时每个进程的缓存最多比数据库晚
+    ``user_refresh_days`` 天，关注和取消关注事件总会刷新用户信息并更新缓存。
+
+    :param max_size: 最多缓存的用户数
+    '''
+
+    def __init__(self, max_size=10000):
+        super(UserCache, self).__init__(max_size)
+
+    def get(self, openid, max_age=None):
+        '''获取缓存的用户信息
+
+        :param openid: 用户的openid
+        :param max_age: 允许的最大秒数，从 ``update_time`` 到现在超过此时间
+            的用户信息视为过期
+        :returns: :class:`~yawxt.User` 对象，不在缓存中或已过期时为 ``None``
+        '''
+        entry = self._get(openid, None if max_age is None else (
+            lambda entry: time.time() - entry[1] <= max_age))
+        if entry is None:
+            return None
+        user = User(dict(entry[0]))
+        user.update_time = entry[1]
+        return user
+
+    def put(self, user):
+        '''缓存用户信息的快照
+
+        :param user: :class:`~yawxt.User` 对象
+        '''
+        snapshot = dict((key, user[key]) for key in User.__availabe_keys__)
+        self._put(
+            user.openid, (snapshot, user.update_time or int(time.time())))
+
+
+class LocationCache(_LRUCache):
+    '''有上限的用户最新地理位置缓存，设置为 :class:`PersistMessageHandler`
+    的 ``location_cache`` 后， :attr:`~PersistMessageHandler.user_location`
+    优先从缓存中获取
+
+    :param max_size: 最多缓存的用户数
+    '''
+
+    def __init__(self, max_size=10000):
+        super(LocationCache, self).__init__(max_size)
+
+    def get(self, openid):
+        '''获取用户最新的地理位置
+
+        :rtype: :class:`~yawxt.Location` ，不在缓存中时为 ``None``
+        '''
+        entry = self._get(openid)
+        return Location(*entry) if entry is not None else None
+
+    def put(self, location):
+        '''缓存用户的地理位置，比已缓存的位置旧时不更新
+
+        :param location: :class:`~yawxt.Location` 对象
+        '''
+        entry = (
+            location.latitude, location.longitude, location.precision,
+            location.openid, location.create_time)
+        with self._lock:
+            # 检查和更新在同一个锁内，并发写入时不会用旧位置覆盖新位置
+            old = self._data.get(location.openid)
+            if old is None or old[4] <= entry[4]:
+                self._put_locked(location.openid, entry)
+
+
+class LocationPolicy(object):
+    '''地理位置上报的写入策略。开启上报地理位置后，微信每5秒左右推送一次
+    地理位置事件，设置为 :class:`PersistMessageHandler` 的
+    ``location_policy`` 后，与用户上一个位置相距小于 ``min_distance`` 米且
+    间隔小于 ``min_interval`` 秒的上报不写入 ``wechat_location`` ：
+
+    * ``merge`` 为 ``False`` 时丢弃，静止的用户每 ``min_interval`` 秒
+      保存一个位置
+    * ``merge`` 为 ``True`` 时合并到上一个位置，只更新
+      ``wechat_latest_location`` 的时间，静止的用户只保存一个位置
+
+    被丢弃或合并的上报默认也不保存到 ``wechat_message`` 表，
+    :meth:`~yawxt.MessageHandler.event_location` 仍然会被调用。
+
+    .. code-block:: python
+
+        dispatcher = Dispatcher(
+            PersistMessageHandler, client, db_session_maker=Session,
+            location_policy=LocationPolicy(min_distance=100),
+            location_cache=LocationCache())
+
+    :param min_distance: 距离阈值，单位为米
+    :param min_interval: 时间阈值，单位为秒
+    :param merge: 是否合并到上一个位置，否则丢弃
+    :param max_per_hour: 每个用户每小时最多保存的位置数，超过后丢弃，
+        为 ``None`` 时不限制；计数只在当前进程中有效
+    :param save_messages: 是否仍然保存被丢弃或合并的地理位置事件消息
+    '''
+
+    KEEP = "keep"
+    MERGE = "merge"
+    DROP = "drop"
+
+    def __init__(self, min_distance=50, min_interval=300, merge=False,
+                 max_per_hour=None, save_messages=False):
+        self.min_distance = min_distance
+        self.min_interval = min_interval
+        self.merge = merge
+        self.max_per_hour = max_per_hour
+        self.save_messages = save_messages
+        self._lock = threading.Lock()
+        self._hour = None
+        self._counts = {}
+
+    def check(self, location, last=None):
+        '''判断一次上报如何写入
+
+        :param location: 本次上报的 :class:`~yawxt.Location`
+        :param last: 用户上一个位置的 :class:`~yawxt.Location` ，没有时为
+            ``None``
+        :returns: :attr:`KEEP` , :attr:`MERGE` 或 :attr:`DROP`
+        '''
+        if last is not None and (
+                0 <= location.create_time - last.create_time <
+                self.min_interval) and haversine(
+                    last.latitude, last.longitude,
+                    location.latitude, location.longitude
+                ) < self.min_distance:
+            return self.MERGE if self.merge else self.DROP
+        if self.max_per_hour is not None:
+            hour = int(location.create_time // 3600)
+            with self._lock:
+                if hour != self._hour:
+                    self._hour = hour
+                    self._counts.clear()
+                count = self._counts.get(location.openid, 0)
+                if count >= self.max_per_hour:
+                    return self.DROP
+                self._counts[location.openid] = count + 1
+        return self.KEEP
+
+
+def _refresh_user(user, fetched, update_time):
+    # 通过映射对象更新，提交时按主键UPDATE查询得到的行
+    for key in User.__availabe_keys__:
+        val = fetched[key]
+        if val is not None:
+            setattr(user, key, val)
+    user.update_time = update_time
+
+
+def _touch_latest_location(location):
+    c = latest_location_table.c
+    return (
+        latest_location_table.update()
+        .where((c.openid == location.openid) &
+               (c.create_time <= location.create_time))
+        .values(create_time=location.create_time))
+
+
+def _history_location(bind, openid, partitions=None):
+    latest = None
+    for table in _source_tables(location_table, partitions):
+        c = table.c
+        row = bind.execute(
+            select([c.latitude, c.longitude, c.precision, c.openid,
+                    c.create_time])
+            .where(c.openid == openid)
+            .order_by(c.create_time.desc()).limit(1)).first()
+        if row is not None and (
+                latest is None or row.create_time > latest.create_time):
+            latest = row
+    return Location(*latest) if latest is not None else None
+
+
+def _reported_location(handler):
+    fields = handler.fields
+    return Location(
+        float(fields['Latitude']), float(fields['Longitude']),
+        float(fields['Precision']), handler.openid,
+        handler.message.create_time)
+
+
+# 以下函数是 PersistMessageHandler 和 asyncio 处理类共用的数据库操作，
+# session参数为同步的sqlalchemy Session，asyncio处理类通过
+# AsyncSession.run_sync调用
+
+
+def _lookup_location(session, handler):
+    cache = handler._location_cache
+    location = cache.get(handler.openid) if cache is not None else None
+    if location is None:
+        c = latest_location_table.c
+        row = session.execute(
+            latest_location_table.select()
+            .where(c.openid == handler.openid)).first()
+        if row is not None:
+            location = Location(
+                row.latitude, row.longitude, row.precision,
+                row.openid, row.create_time)
+        else:
+            location = _history_location(
+                session, handler.openid, handler._partitions)
+        if location is not None and cache is not None:
+            cache.put(location)
+    handler._user_location = location
+    handler.log("find user's location: %s", location)
+    return location
+
+
+def _checks_location(handler):
+    return handler._location_policy is not None and (
+        handler.message.msg_type == "event_LOCATION")
+
+
+def _check_location(handler, last):
+    # 按地理位置策略决定本次上报的处理方式，返回是否保存事件消息
+    policy = handler._location_policy
+    handler._location_action = policy.check(
+        _reported_location(handler), last)
+    return handler._location_action == policy.KEEP or policy.save_messages
+
+
+def _persist_message(session, handler, message):
+    if handler._write_behind is not None:
+        handler._write_behind.put(
+            message_table, _message_row(message, handler._raw_content))
+        return
+    if handler._message_stats:
+        update_message_stats(session, [message])
+    if handler._partitions is not None:
+        handler._partitions.insert(
+            session, message_table,
+            [_message_row(message, handler._raw_content)])
+    elif not handler._raw_content:
+        session.execute(message_table.insert(), _message_row(message, False))
+    else:
+        session.add(MessageRecord.from_model(message))
+
+
+def _persist_location(session, handler, location):
+    action = handler._location_action or LocationPolicy.KEEP
+    last = handler._user_location
+    handler._user_location = location
+    write_behind = handler._write_behind
+    if action == LocationPolicy.DROP:
+        handler.log("drop location: %s", location)
+        return
+    if action == LocationPolicy.MERGE:
+        # 只把上一个位置的时间更新为本次上报的时间
+        location = Location(
+            last.latitude, last.longitude, last.precision,
+            location.openid, location.create_time)
+        if write_behind is not None:
+            write_behind.add_location(location, history=False)
+        else:
+            session.execute(_touch_latest_location(location))
+            handler._session_writes = True
+        handler.log("merge location: %s", location)
+    elif write_behind is not None:
+        # 历史位置和最新位置在同一次批量写入中提交
+        write_behind.add_location(location)
+        handler.log("add location to write behind: %s", location)
+    else:
+        if handler._partitions is not None:
+            handler._partitions.insert(
+                session, location_table, [_location_row(location)])
+        else:
+            session.add(LocationRecord.from_model(location))
+        save_latest_location(session, location)
+        handler._session_writes = True
+        handler.log("add location to db: %s", location)
+    if handler._location_cache is not None:
+        handler._location_cache.put(location)
+
+
+def _max_age(refresh_interval):
+    return refresh_interval * 86400 - 3
+
+
+def _cached_user(handler, refresh_interval):
+    cache = handler._user_cache
+    if cache is None or refresh_interval <= 0:
+        return None
+    user = cache.get(handler.openid, _max_age(refresh_interval))
+    if user is not None:
+        handler.log("find user in cache: %s", user)
+    return user
+
+
+def _lookup_user(session, handler, refresh_interval):
+    # 返回数据库中的用户和是否需要从微信服务器刷新
+    user = session.query(UserRecord).filter_by(openid=handler.openid).first()
+    handler.log("find user in db: %s", user)
+    stale = user is None or refresh_interval <= 0 or (
+        time.time() - user.update_time) > _max_age(refresh_interval)
+    return user, stale
+
+
+def _persist_user(session, handler, user, fetched):
+    now = int(time.time())
+    handler._session_writes = True
+    if user is None:
+        upsert_users(session, [fetched], now)
+        user = fetched
+        user.update_time = now
+        handler.log("add user to db with dict: %s", user)
+    else:
+        _refresh_user(user, fetched, now)
+        sync_user_tags(session, [fetched])
+        handler.log("update user with dict: %s", fetched)
+    return user
+
+
+def _set_user(handler, user):
+    if handler._user_cache is not None:
+        handler._user_cache.put(user)
+    handler._user = user
+
+
+def _persist_reply(session, handler):
+    # 保存回复消息，返回是否需要提交
+    if handler.reply_message is not None:
+        _persist_message(session, handler, handler.reply_message)
+    return handler._write_behind is None or bool(
+        handler._session_writes or session.new or session.dirty)
+
+
 class PersistMessageHandler(MessageHandler):
     '''消息持久化类，继承此类自动将每一条消息、地理位置上报、
         发送消息用户资料保存到数据库
@@ -110,61 +1797,103 @@ class PersistMessageHandler(MessageHandler):
             processor = PersistMessageHandler(content, client,
                 db_session_maker = Session)
 
+    :param user_refresh_days: 从微信服务器刷新用户信息的间隔天数，默认为1天
+    :param write_behind: :class:`WriteBehindBuffer` 对象，设置后消息和
+        地理位置延迟批量写入，只有用户信息变化时才在回复前提交
+    :param user_cache: :class:`UserCache` 对象，设置后用户信息未过期时
+        不查询数据库， :attr:`user` 为缓存中用户信息的副本
+    :param location_cache: :class:`LocationCache` 对象
+    :param location_policy: :class:`LocationPolicy` 对象，设置后按策略
+        丢弃或合并相近的地理位置上报
+    :param partitions: :class:`~yawxt.partition.MonthlyPartitions` 对象，
+        设置后消息和地理位置写入对应的月表
+    :param raw_content: 是否保存消息的xml内容 ``content`` ，为 ``False``
+        时只保存 :func:`extract_payload` 取出的字段
+    :param message_stats: 是否把保存的消息计入 ``wechat_message_stats`` ，
+        设置 ``write_behind`` 时由 :class:`WriteBehindBuffer` 的
+        ``message_stats`` 参数决定
     '''
 
+    __slots__ = (
+        "db_session", "_user_location", "_refresh_interval", "_write_behind",
+        "_session_writes", "_user_cache", "_location_cache",
+        "_location_policy", "_location_action", "_partitions",
+        "_raw_content", "_message_stats")
+
     def __init__(self, content, client,  db_session_maker, **kwargs):
+        super(PersistMessageHandler, self).__init__(
+            content, client, db_session_maker=db_session_maker, **kwargs)
+
+    def _setup(self, client, debug_to_wechat=False,
+               db_session_maker=None, user_refresh_days=1,
+               write_behind=None, user_cache=None, location_cache=None,
+               location_policy=None, partitions=None, raw_content=True,
+               message_stats=False, **options):
+        super(PersistMessageHandler, self)._setup(
+            client, debug_to_wechat, **options)
         self.db_session = db_session_maker()
         self._user_location = None
-        self._refresh_interval = kwargs.pop("user_refresh_days", 1)
-        super(PersistMessageHandler, self).__init__(content, client, **kwargs)
+        self._refresh_interval = user_refresh_days
+        self._write_behind = write_behind
+        self._session_writes = False
+        self._user_cache = user_cache
+        self._location_cache = location_cache
+        self._location_policy = location_policy
+        self._location_action = None
+        self._partitions = partitions
+        self._raw_content = raw_content
+        self._message_stats = message_stats
 
     @property
     def user_location(self):
-        '''用户的地理位置，用户最后一次上报的位置，从数据库中获取
+        '''用户的地理位置，用户最后一次上报的位置，依次从
+        ``location_cache`` 、按openid主键查询的 ``wechat_latest_location``
+        表中获取，都没有时查询 ``wechat_location`` 和月表中的历史位置
 
         :type: :class:`~yawxt.Location`
         '''
         if not self._user_location:
-            self._user_location = (
-                self.db_session.query(Location)
-                .filter_by(openid=self.openid)
-                .order_by(Location.create_time.desc())
-                .first())
-            self.log("find user's location: %s", self._user_location)
+            _lookup_location(self.db_session, self)
         return self._user_location
 
     def _before(self):
+        self._save_message()
+        return self.before()
+
+    def _save_message(self):
         self.save_user_info()
-        self.db_session.add(self.message)
-        self.before()
+        if _checks_location(self) and not _check_location(
+                self, self.user_location):
+            return
+        self._store_message(self.message)
+
+    def _store_message(self, message):
+        _persist_message(self.db_session, self, message)
 
     def _subscribe(self):
         self.save_user_info(refresh_interval=0)
-        ele = self.xml.find("EventKey")
+        event_key = self.fields.get("EventKey")
         # 当不是扫码关注时，EventKey存在但内容为空
-        if ele is not None and ele.text:
+        if event_key:
             # event_key一定是以 "qrscene_" 开头的
-            event_key = int(ele.text[8:])
-            ticket = self.xml.find("Ticket").text
-            self.event_subscribe_from_qrcode(event_key, ticket)
+            event_key = int(event_key[8:])
+            ticket = self.fields["Ticket"]
+            return self._emit(
+                self.event_subscribe_from_qrcode, event_key, ticket)
         else:
-            self.event_subscribe()
+            return self._emit(self.event_subscribe)
 
     def _unsubscribe(self):
         self.save_user_info(refresh_interval=0)
-        self.event_unsubscribe()
+        return self._emit(self.event_unsubscribe)
 
     def _LOCATION(self):
-        lat = float(self.xml.find('Latitude').text)
-        lon = float(self.xml.find('Longitude').text)
-        precision = float(self.xml.find('Precision').text)
-        location = Location(
-            lat, lon, precision, self.openid,
-            self.message.create_time)
-        self.db_session.add(location)
-        self.log("add location to db: %s", location)
-        self._user_location = location
-        self.event_location(location)
+        location = _reported_location(self)
+        self._save_location(location)
+        return self._emit(self.event_location, location)
+
+    def _save_location(self, location):
+        _persist_location(self.db_session, self, location)
 
     def save_user_info(self, refresh_interval=None):
         '''保存或更新发送消息的用户的信息
@@ -176,35 +1905,31 @@ class PersistMessageHandler(MessageHandler):
         '''
         if refresh_interval is None:
             refresh_interval = self._refresh_interval
-
-        user = (self.db_session.query(User)
-                .filter_by(openid=self.openid).first())
-        self.log("find user in db: %s", user)
-        refresh = (
-            user is not None and
-            (time.time() - user.update_time) > refresh_interval * 86400 - 3
-        )
-        if refresh or user is None:
-            _user = self.client.get_user(self.openid)
-            if user is None:
-                user = _user
-                self.db_session.add(user)
-                self.log("add user to db with dict: %s", user)
-            else:
-                user.update(_user)
-                user.update_time = int(time.time())
-                self.log("update user with dict: %s", _user)
-        self._user = user
+        user = _cached_user(self, refresh_interval)
+        if user is not None:
+            self._user = user
+            return
+        user, stale = _lookup_user(self.db_session, self, refresh_interval)
+        if stale:
+            user = _persist_user(
+                self.db_session, self, user, self.client.get_user(self.openid))
+        _set_user(self, user)
 
     def _finish(self):
-        self.finish()
-
-        entities = [self.message, self._user]
-        if self.reply_message is not None:
-            self.db_session.add(self.reply_message)
-            entities.append(self.reply_message)
+        result = self.finish()
+        self._commit()
+        return result
 
-        self.db_session.commit()
-        for entity in entities:
-            self.db_session.refresh(entity)
-        self.db_session.close()
+    def _commit(self):
+        session = self.db_session
+        if self._write_behind is not None:
+            # 提交后不再查询，用户信息仍可以在session关闭后使用
+            session.expire_on_commit = False
+        if _persist_reply(session, self):
+            session.commit()
+            # 消息保存的是转换后的映射对象，只有查询得到的用户需要刷新
+            user = self._user
+            if self._write_behind is None and isinstance(
+                    user, UserRecord) and user in session:
+                session.refresh(user)
+        session.close()
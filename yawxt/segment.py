@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+
+'''按用户属性和标签筛选用户
+
+:class:`Segment` 把性别、地区、语言、关注时间和标签条件编译为
+``wechat_user`` 上的一条SQL查询，标签条件使用 ``wechat_user_tag`` 表的索引，
+按openid分段（keyset pagination）读取，内存占用只与每段的用户数有关：
+
+.. code-block:: python
+
+    segment = Segment(
+        sex=2, province="广东", subscribed_since=time.time() - 90 * 86400,
+        tags=[12], exclude_tags=[30])
+    for openid in segment.openids(engine):
+        client.send_template_message(openid, template_id, data)
+'''
+
+from __future__ import unicode_literals
+
+from sqlalchemy import select, exists, func
+
+from .persistence import user_table, user_tag_table
+
+__all__ = ["Segment"]
+
+
+def _values(value):
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return list(value)
+    return [value]
+
+
+class Segment(object):
+    '''用户筛选条件，所有条件同时满足，为 ``None`` 的条件不限制
+
+    :param sex: 性别，1为男性，2为女性，0为未知，可以是列表
+    :param province: 省份，可以是列表
+    :param city: 城市，可以是列表
+    :param language: 语言，如 ``"zh_CN"`` ，可以是列表
+    :param subscribed_since: 关注时间的开始时间戳，包含此时间
+    :param subscribed_until: 关注时间的结束时间戳，不包含此时间
+    :param tags: 必须全部包含的标签id列表
+    :param exclude_tags: 不能包含的标签id列表
+    :param subscribed: 是否只选择正在关注的用户，默认为 ``True``
+    '''
+
+    def __init__(self, sex=None, province=None, city=None, language=None,
+                 subscribed_since=None, subscribed_until=None, tags=None,
+                 exclude_tags=None, subscribed=True):
+        self.sex = sex
+        self.province = province
+        self.city = city
+        self.language = language
+        self.subscribed_since = subscribed_since
+        self.subscribed_until = subscribed_until
+        self.tags = sorted(set(tags or ()))
+        self.exclude_tags = sorted(set(exclude_tags or ()))
+        self.subscribed = subscribed
+
+    def where(self):
+        '''编译后的 ``WHERE`` 条件
+
+        :rtype: sqlalchemy表达式，没有条件时为 ``None``
+        '''
+        c = user_table.c
+        t = user_tag_table.c
+        conds = []
+        if self.subscribed:
+            conds.append(c.subscribe == 1)
+        for name in ("sex", "province", "city", "language"):
+            value = getattr(self, name)
+            if value is not None:
+                values = _values(value)
+                conds.append(
+                    c[name] == values[0] if len(values) == 1 else
+                    c[name].in_(values))
+        if self.subscribed_since is not None:
+            conds.append(c.subscribe_time >= self.subscribed_since)
+        if self.subscribed_until is not None:
+            conds.append(c.subscribe_time < self.subscribed_until)
+        if self.tags:
+            # 从 (tagid, openid) 索引得到同时有全部标签的用户
+            members = select([t.openid]).where(t.tagid.in_(self.tags))
+            if len(self.tags) > 1:
+                members = members.group_by(t.openid).having(
+                    func.count() == len(self.tags))
+            conds.append(c.openid.in_(members))
+        if self.exclude_tags:
+            conds.append(~exists().where(
+                (t.openid == c.openid) & t.tagid.in_(self.exclude_tags)))
+        if not conds:
+            return None
+        cond = conds[0]
+        for other in conds[1:]:
+            cond = cond & other
+        return cond
+
+    def query(self, after=None, limit=None):
+        '''按openid排序的查询
+
+        :param after: 只查询openid大于此值的用户
+        :param limit: 最多返回的用户数
+        :rtype: sqlalchemy ``Select``
+        '''
+        c = user_table.c
+        query = select([c.openid])
+        cond = self.where()
+        if after is not None:
+            page = c.openid > after
+            cond = page if cond is None else cond & page
+        if cond is not None:
+            query = query.where(cond)
+        return query.order_by(c.openid).limit(limit)
+
+    def count(self, bind):
+        '''满足条件的用户数
+
+        :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session``
+            对象
+        '''
+        query = select([func.count()]).select_from(user_table)
+        cond = self.where()
+        if cond is not None:
+            query = query.where(cond)
+        return bind.execute(query).scalar()
+
+    def batches(self, bind, batch_size=1000):
+        '''按openid顺序分段读取满足条件的用户，每段一条查询
+
+        :param bind: sqlalchemy ``Engine`` , ``Connection`` 或 ``Session``
+            对象
+        :param batch_size: 每段的用户数
+        :returns: 每段为一个openid列表的迭代器
+        '''
+        after = None
+        while True:
+            openids = [row[0] for row in bind.execute(
+                self.query(after, batch_size))]
+            if not openids:
+                return
+            yield openids
+            if len(openids) < batch_size:
+                return
+            after = openids[-1]
+
+    def openids(self, bind, batch_size=1000):
+        '''满足条件的用户openid，参数见 :meth:`batches`
+
+        :rtype: iterator of str
+        '''
+        for openids in self.batches(bind, batch_size):
+            for openid in openids:
+                yield openid
@@ -0,0 +1,359 @@
+# -*- coding:utf-8 -*-
+
+'''消息暂存队列，快速接收模式
+
+流量高峰时同步处理消息会超过微信服务器5秒的等待时间，微信重试又会加重负载。
+快速接收模式下，web入口检查签名后只把原始消息追加到本地sqlite文件
+:class:`Spool` 中并立即返回空回复， :class:`SpoolWorkerPool` 的工作线程再
+使用普通的 :class:`~yawxt.MessageHandler` 子类处理消息：
+
+.. code-block:: python
+
+    from yawxt.spool import Spool, SpoolWorkerPool
+    from yawxt.wsgi import WechatApp
+
+    spool = Spool("/var/lib/wechat/spool.db", max_pending=100000)
+    pool = SpoolWorkerPool(
+        spool, PersistMessageHandler, client, workers=8,
+        db_session_maker=Session)
+    pool.start()
+
+    app = WechatApp(PersistMessageHandler, "token", client, spool=spool)
+
+同一用户（ ``FromUserName`` ）的消息总是由同一个工作线程按接收顺序处理。
+消息处理完成后才从队列中删除，进程退出后未处理的消息在下次启动时重新处理，
+因此同一条消息可能被处理多次。快速接收模式下被动回复的消息不会发送给用户，
+需要回复的内容请使用客服消息或模板消息接口发送。
+'''
+
+from __future__ import unicode_literals
+import re
+import json
+import time
+import zlib
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+
+try:
+    from queue import Queue, Empty
+except ImportError:  # pragma: no cover
+    from Queue import Queue, Empty
+
+from .dispatcher import Dispatcher
+from .exceptions import SpoolFullError
+
+__all__ = ["Spool", "SpoolItem", "SpoolWorkerPool"]
+
+logger = logging.getLogger(__name__)
+
+_FROM_USER = re.compile(
+    br"<FromUserName>\s*(?:<!\[CDATA\[)?([^<\]]*)")
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    partition_key TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    content BLOB NOT NULL,
+    query TEXT,
+    failed INTEGER NOT NULL DEFAULT 0
+)'''
+
+SpoolItem = namedtuple(
+    "SpoolItem", ["id", "partition_key", "received_at", "content", "query"])
+'''队列中的一条消息'''
+
+
+def _partition_key(content, query):
+    openid = query.get("openid") if query else None
+    if openid:
+        return openid
+    m = _FROM_USER.search(content)
+    return m.group(1).decode("utf8") if m else ""
+
+
+class Spool(object):
+    '''基于sqlite的持久化消息队列，可以在多个线程中同时使用
+
+    :param path: sqlite数据库文件路径
+    :param max_pending: 待处理消息数的上限，达到上限后 :meth:`put` 抛出
+        :class:`~yawxt.SpoolFullError` ，为 ``None`` 时不限制
+    :param synchronous: sqlite的 ``synchronous`` 设置，默认为 ``NORMAL`` ，
+        进程崩溃不会丢失消息；需要防止断电丢失消息时设置为 ``FULL``
+    '''
+
+    def __init__(self, path, max_pending=None, synchronous="NORMAL"):
+        self.path = path
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError("invalid synchronous: %s" % synchronous)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=%s" % synchronous)
+        self._conn.execute(_SCHEMA)
+        self._conn.commit()
+        self._pending = self._conn.execute(
+            "SELECT COUNT(*) FROM spool WHERE failed = 0").fetchone()[0]
+
+    def __len__(self):
+        return self._pending
+
+    def put(self, content, query=None):
+        '''追加一条消息，提交后返回
+
+        :param content: 从微信服务器接收的xml格式的消息
+        :param query: 请求url的query_string参数字典，安全模式下需要保存
+        :returns: 消息在队列中的id
+        '''
+        if not isinstance(content, bytes):
+            content = content.encode("utf8")
+        row = (
+            _partition_key(content, query), time.time(),
+            sqlite3.Binary(content), json.dumps(query) if query else None)
+        with self._lock:
+            # 检查和插入在同一个锁内，并发写入时不会超过上限
+            if self.max_pending is not None and (
+                    self._pending >= self.max_pending):
+                raise SpoolFullError(
+                    "%d messages pending in spool" % self._pending)
+            cursor = self._conn.execute(
+                "INSERT INTO spool (partition_key, received_at, content, "
+                "query) VALUES (?, ?, ?, ?)", row)
+            self._conn.commit()
+            self._pending += 1
+        self._event.set()
+        return cursor.lastrowid
+
+    def fetch(self, after_id=0, limit=100):
+        '''按接收顺序读取待处理的消息，不会从队列中删除
+
+        :param after_id: 只读取id大于此值的消息
+        :param limit: 最多读取的消息数
+        :rtype: list of :class:`SpoolItem`
+        '''
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, partition_key, received_at, content, query "
+                "FROM spool WHERE id > ? AND failed = 0 ORDER BY id LIMIT ?",
+                (after_id, limit)).fetchall()
+        return [
+            SpoolItem(
+                id, key, received_at, bytes(content),
+                json.loads(query) if query else None)
+            for id, key, received_at, content, query in rows]
+
+    def wait(self, timeout):
+        '''等待新消息追加到队列中，最多等待 ``timeout`` 秒'''
+        self._event.wait(timeout)
+        self._event.clear()
+
+    def _update(self, sql, ids):
+        count = 0
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                count += self._conn.execute(
+                    sql % ",".join("?" * len(chunk)), chunk).rowcount
+            self._conn.commit()
+            self._pending -= count
+
+    def ack(self, ids):
+        '''从队列中删除已处理的消息
+
+        :param ids: 消息id列表
+        '''
+        if ids:
+            self._update(
+                "DELETE FROM spool WHERE failed = 0 AND id IN (%s)", ids)
+
+    def fail(self, ids):
+        '''将处理失败的消息标记为失败，不再读取
+
+        :param ids: 消息id列表
+        '''
+        if ids:
+            self._update(
+                "UPDATE spool SET failed = 1 WHERE failed = 0 AND id IN (%s)",
+                ids)
+
+    def retry_failed(self):
+        '''把处理失败的消息重新追加到队列末尾
+
+        :returns: 重新追加的消息数
+        '''
+        with self._lock:
+            count = self._conn.execute(
+                "INSERT INTO spool (partition_key, received_at, content, "
+                "query) SELECT partition_key, received_at, content, query "
+                "FROM spool WHERE failed = 1 ORDER BY id").rowcount
+            self._conn.execute("DELETE FROM spool WHERE failed = 1")
+            self._conn.commit()
+            self._pending += count
+        self._event.set()
+        return count
+
+    def stats(self):
+        '''队列状态
+
+        :returns: ``dict`` ， ``pending`` 为待处理消息数， ``failed`` 为
+            处理失败的消息数， ``lag`` 为最早的待处理消息已等待的秒数
+        '''
+        with self._lock:
+            failed = self._conn.execute(
+                "SELECT COUNT(*) FROM spool WHERE failed = 1").fetchone()[0]
+            oldest = self._conn.execute(
+                "SELECT received_at FROM spool WHERE failed = 0 "
+                "ORDER BY id LIMIT 1").fetchone()
+        return {
+            "pending": self._pending,
+            "failed": failed,
+            "lag": time.time() - oldest[0] if oldest else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SpoolWorkerPool(object):
+    '''从 :class:`Spool` 中读取消息并使用消息处理类处理的工作线程池
+
+    一个读取线程按顺序读取消息，按 ``FromUserName`` 分配到各工作线程的
+    有界队列中，工作线程处理完成后批量从 :class:`Spool` 中删除。工作线程
+    处理不过来时读取线程阻塞，待处理的消息留在 :class:`Spool` 中，
+    达到 ``max_pending`` 后web入口返回503。
+
+    :param spool: :class:`Spool` 对象
+    :param handler_cls: :class:`~yawxt.MessageHandler` 或其子类
+    :param client: 微信公众号账号, :class:`~yawxt.WxClient` 对象
+    :param workers: 工作线程数
+    :param batch_size: 每次从 :class:`Spool` 读取和删除的消息数
+    :param queue_size: 每个工作线程队列的长度
+    :param poll_interval: 没有新消息时的等待秒数
+    :param options: 消息处理类的其他参数，见 :class:`~yawxt.Dispatcher`
+    '''
+
+    def __init__(self, spool, handler_cls, client=None, workers=4,
+                 batch_size=100, queue_size=1000, poll_interval=0.5,
+                 **options):
+        self.spool = spool
+        self.dispatcher = Dispatcher(handler_cls, client, **options)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._queues = [Queue(queue_size) for _ in range(workers)]
+        self._threads = []
+        self._stopping = threading.Event()
+        self._drain = True
+        self._stats_lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+
+    def start(self):
+        '''启动读取线程和工作线程'''
+        if self._threads:
+            raise RuntimeError("worker pool already started")
+        self._stopping.clear()
+        self._threads = [threading.Thread(
+            target=self._read, name="yawxt-spool-reader")]
+        self._threads.extend(
+            threading.Thread(
+                target=self._work, args=(queue,),
+                name="yawxt-spool-worker-%d" % i)
+            for i, queue in enumerate(self._queues))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, drain=True, timeout=None):
+        '''停止线程池
+
+        :param drain: 为 ``True`` 时处理完 :class:`Spool` 中所有待处理的消息
+            再停止，否则处理完已分配给工作线程的消息后停止
+        :param timeout: 等待每个线程结束的秒数
+        '''
+        self._drain = drain
+        self._stopping.set()
+        self.spool._event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def partition(self, key):
+        '''用户消息分配到的工作线程序号
+
+        :param key: 用户的openid
+        '''
+        return zlib.crc32(key.encode("utf8")) % len(self._queues)
+
+    def _read(self):
+        last_id = 0
+        queues = self._queues
+        while True:
+            if self._stopping.is_set() and not self._drain:
+                break
+            items = self.spool.fetch(last_id, self.batch_size)
+            if not items:
+                if self._stopping.is_set():
+                    break
+                self.spool.wait(self.poll_interval)
+                continue
+            for item in items:
+                queues[self.partition(item.partition_key)].put(item)
+                last_id = item.id
+        for queue in queues:
+            queue.put(None)
+
+    def _work(self, queue):
+        done, failed = [], []
+        while True:
+            if done or failed:
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    self._ack(done, failed)
+                    done, failed = [], []
+                    continue
+            else:
+                item = queue.get()
+            if item is None:
+                break
+            try:
+                self.dispatcher(item.content, item.query)
+            except Exception:
+                logger.exception("process spooled message %d failed", item.id)
+                failed.append(item.id)
+            else:
+                done.append(item.id)
+            self.last_lag = time.time() - item.received_at
+            if len(done) + len(failed) >= self.batch_size:
+                self._ack(done, failed)
+                done, failed = [], []
+        self._ack(done, failed)
+
+    def _ack(self, done, failed):
+        self.spool.ack(done)
+        self.spool.fail(failed)
+        with self._stats_lock:
+            self.processed += len(done)
+            self.failed += len(failed)
+
+    def stats(self):
+        '''线程池和队列的状态
+
+        :returns: :meth:`Spool.stats` 的内容，以及 ``processed`` 已处理的
+            消息数， ``failed`` 处理失败的消息数（包括以前失败的），
+            ``last_lag`` 最近处理的一条消息从接收到处理完成的秒数，
+            ``queued`` 各工作线程队列中的消息数
+        '''
+        stats = self.spool.stats()
+        stats.update({
+            "processed": self.processed,
+            "last_lag": self.last_lag,
+            "queued": [queue.qsize() for queue in self._queues],
+        })
+        return stats
@@ -0,0 +1,158 @@
+# -*- coding:utf-8 -*-
+
+'''不依赖web框架的WSGI应用
+
+:class:`WechatApp` 只做微信消息接口需要的几件事：检查签名、处理接入验证的
+echostr、读取消息体、返回回复的xml，可以直接交给任意WSGI服务器运行：
+
+.. code-block:: python
+
+    from yawxt.wsgi import WechatApp
+
+    app = WechatApp(
+        PersistMessageHandler, "token", client,
+        db_session_maker=Session)
+
+    # gunicorn module:app
+
+也可以挂载到已有的web应用中某个路径下，应用本身不检查请求路径。
+'''
+
+from __future__ import unicode_literals
+import logging
+
+try:
+    from urllib.parse import unquote_plus
+except ImportError:  # pragma: no cover
+    from urllib import unquote_plus
+
+from .dispatcher import Dispatcher
+from .exceptions import MessageCryptoError, SpoolFullError
+from .message import check_signature
+
+__all__ = ["WechatApp"]
+
+logger = logging.getLogger(__name__)
+
+_XML_TYPE = (str("Content-Type"), str("application/xml; charset=utf-8"))
+_TEXT_TYPE = (str("Content-Type"), str("text/plain; charset=utf-8"))
+_EMPTY_HEADERS = [_TEXT_TYPE, (str("Content-Length"), str("0"))]
+
+_STATUS_OK = str("200 OK")
+_STATUS_BAD_REQUEST = str("400 Bad Request")
+_STATUS_FORBIDDEN = str("403 Forbidden")
+_STATUS_NOT_ALLOWED = str("405 Method Not Allowed")
+_STATUS_LENGTH_REQUIRED = str("411 Length Required")
+_STATUS_TOO_LARGE = str("413 Request Entity Too Large")
+_STATUS_UNAVAILABLE = str("503 Service Unavailable")
+
+_QUERY_KEYS = frozenset([
+    "signature", "timestamp", "nonce", "echostr", "msg_signature",
+    "encrypt_type", "openid"])
+
+
+def _parse_query(query_string):
+    '''只解析微信会用到的参数，一般不需要url解码'''
+    query = {}
+    if not query_string:
+        return query
+    for pair in query_string.split("&"):
+        key, sep, value = pair.partition("=")
+        if key in _QUERY_KEYS:
+            if "%" in value or "+" in value:
+                value = unquote_plus(value)
+            query[key] = value
+    return query
+
+
+class WechatApp(object):
+    '''微信消息接口的WSGI应用
+
+    :param handler_cls: :class:`~yawxt.MessageHandler` 或其子类
+    :param token: 公众号后台填写的token
+    :param client: 微信公众号账号, :class:`~yawxt.WxClient` 对象
+    :param debug_to_wechat: 使用 reply_debug_text 可以将调试信息发送到用户微信
+    :param max_body_size: 消息体的最大字节数，超过时返回413，默认为64KB
+    :param time_error: 与微信服务器时间的误差允许秒数，见
+        :func:`~yawxt.check_signature`
+    :param spool: 快速接收模式的消息队列 :class:`~yawxt.spool.Spool` ，
+        设置后消息追加到队列中立即返回空回复，队列满时返回503
+    :param options: 消息处理类的其他参数，见 :class:`~yawxt.Dispatcher` ，
+        安全模式下传入 ``crypto``
+    '''
+
+    def __init__(self, handler_cls, token, client=None, debug_to_wechat=False,
+                 max_body_size=65536, time_error=600, spool=None,
+                 **options):
+        self.token = token
+        self.max_body_size = max_body_size
+        self.time_error = time_error
+        self.spool = spool
+        self.dispatcher = Dispatcher(
+            handler_cls, client, debug_to_wechat, **options)
+
+    def check(self, query):
+        '''检查请求url中的签名
+
+        :param query: url query_string参数字典
+        :rtype: bool
+        '''
+        try:
+            return check_signature(
+                self.token, query.get("timestamp"), query.get("nonce"),
+                query.get("signature"), self.time_error)
+        except ValueError:
+            return False
+
+    def read_body(self, environ):
+        '''读取消息体，返回 ``(status, body)`` ，读取失败时body为 ``None``'''
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or -1)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return _STATUS_LENGTH_REQUIRED, None
+        if length > self.max_body_size:
+            return _STATUS_TOO_LARGE, None
+        body = environ["wsgi.input"].read(length)
+        if len(body) != length:
+            return _STATUS_BAD_REQUEST, None
+        return _STATUS_OK, body
+
+    def __call__(self, environ, start_response):
+        query = _parse_query(environ.get("QUERY_STRING"))
+        if not self.check(query):
+            start_response(_STATUS_FORBIDDEN, _EMPTY_HEADERS)
+            return []
+        method = environ["REQUEST_METHOD"]
+        if method == "POST":
+            status, body = self.read_body(environ)
+            if body is None:
+                start_response(status, _EMPTY_HEADERS)
+                return []
+            if self.spool is not None:
+                try:
+                    self.spool.put(body, query)
+                except SpoolFullError as e:
+                    logger.warning("message rejected: %s", e)
+                    status = _STATUS_UNAVAILABLE
+                start_response(status, _EMPTY_HEADERS)
+                return []
+            try:
+                reply = self.dispatcher(body, query)
+            except MessageCryptoError as e:
+                logger.warning("invalid encrypted message: %s", e)
+                start_response(_STATUS_BAD_REQUEST, _EMPTY_HEADERS)
+                return []
+            start_response(_STATUS_OK, [
+                _XML_TYPE, (str("Content-Length"), str(len(reply)))])
+            return [reply]
+        if method == "GET":
+            echostr = query.get("echostr", "").encode("utf8")
+            start_response(_STATUS_OK, [
+                _TEXT_TYPE, (str("Content-Length"), str(len(echostr)))])
+            return [echostr]
+        start_response(_STATUS_NOT_ALLOWED, [
+            _TEXT_TYPE, (str("Content-Length"), str("0")),
+            (str("Allow"), str("GET, POST"))])
+        return []